@@ -0,0 +1,72 @@
+"""
+Compares two collapsed stack profiles written with --profiler, by self and
+total (inclusive) share per frame.
+
+  python -m benchmarks.compare_profiles out/profiles/download-A.collapsed out/profiles/download-B.collapsed
+"""
+import argparse
+import sys
+
+
+def readCollapsed(path):
+  stacks = {}
+  with open(path, "r", encoding="utf-8") as fp:
+    for line in fp:
+      line = line.rstrip("\n")
+      if not line:
+        continue
+      stack, value = line.rsplit(" ", 1)
+      stacks[stack] = stacks.get(stack, 0) + int(value)
+  return stacks
+
+
+def frameTotals(stacks):
+  """
+  Returns total weight, and self and inclusive weight per frame.
+  """
+  total = sum(stacks.values())
+  self_weights = {}
+  total_weights = {}
+  for stack, value in stacks.items():
+    frames = stack.split(";")
+    self_weights[frames[-1]] = self_weights.get(frames[-1], 0) + value
+    # Count recursive frames only once per stack
+    for frame in set(frames):
+      total_weights[frame] = total_weights.get(frame, 0) + value
+  return total, self_weights, total_weights
+
+
+def compare(a, b, top=20, by="self"):
+  total_a, self_a, incl_a = frameTotals(a)
+  total_b, self_b, incl_b = frameTotals(b)
+  weights_a, weights_b = (self_a, self_b) if by == "self" else (incl_a, incl_b)
+
+  rows = []
+  for frame in set(weights_a) | set(weights_b):
+    share_a = weights_a.get(frame, 0) / total_a if total_a else 0
+    share_b = weights_b.get(frame, 0) / total_b if total_b else 0
+    rows.append((frame, share_a, share_b, share_b - share_a))
+  rows.sort(key=lambda r: abs(r[3]), reverse=True)
+  return total_a, total_b, rows[:top]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog="python -m benchmarks.compare_profiles")
+  parser.add_argument('before', type=str, help='collapsed stacks of the baseline')
+  parser.add_argument('after', type=str, help='collapsed stacks to compare')
+  parser.add_argument('--top', type=int, default=20, help='number of frames to show')
+  parser.add_argument('--by', type=str, choices=['self', 'total'], default='self',
+                      help='compare self or inclusive share of frames')
+  args = parser.parse_args(argv)
+
+  total_a, total_b, rows = compare(readCollapsed(args.before), readCollapsed(args.after), top=args.top, by=args.by)
+  print("Total weight: {} -> {} ({:+.1f}%)".format(total_a, total_b,
+                                                    (total_b - total_a) / total_a * 100 if total_a else 0))
+  print("{:>8} {:>8} {:>8}  frame ({} share)".format("before", "after", "delta", args.by))
+  for frame, share_a, share_b, delta in rows:
+    print("{:7.2f}% {:7.2f}% {:+7.2f}%  {}".format(share_a * 100, share_b * 100, delta * 100, frame))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of formatting DATEV rows (output.printRecords) and their
+amounts and dates, against the previous per-field implementation.
+
+  python -m benchmarks.datev_rows --rows 1000000
+"""
+import argparse
+import decimal
+import io
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from stripe_datev import config, output
+
+
+def legacyPrintRows(fp, records):
+  for record in records:
+    record["Belegdatum"] = record["date"].astimezone(config.accounting_tz).strftime("%d%m")
+    record["Buchungstext"] = "\"{}\"".format(record["Buchungstext"][:60])
+    recordValues = [record.get(f, '') for f in output.fields]
+    fp.write(";".join(recordValues))
+    fp.write("\n")
+
+
+def legacyFormatDecimal(d):
+  return "{0:.2f}".format(d).replace(",", "").replace(".", ",")
+
+
+def generateRecords(count, seed=0):
+  """
+  Records shaped like those of invoices.createAccountingRecords(), with
+  amounts in cents.
+  """
+  rng = random.Random(seed)
+  start = config.accounting_tz.localize(datetime(2023, 1, 1))
+  # Each invoice or transaction has several records on the same date
+  dates = [start + timedelta(minutes=rng.randrange(365 * 24 * 60)) for _ in range(max(count // 4, 1))]
+  records = []
+  for idx in range(count):
+    cents = rng.randint(-50000, 500000)
+    record = {
+      "date": dates[idx // 4],
+      "Umsatz (ohne Soll/Haben-Kz)": cents,
+      "Soll/Haben-Kennzeichen": "S" if cents >= 0 else "H",
+      "WKZ Umsatz": "EUR",
+      "Konto": str(10000 + idx % 500),
+      "Gegenkonto (ohne BU-Schlüssel)": "8400",
+      "Buchungstext": "Erlös Rechnung RE-{:06d} / Kunde {}".format(idx, idx % 500),
+      "Belegfeld 1": "RE-{:06d}".format(idx),
+    }
+    if idx % 3 == 0:
+      record["BU-Schlüssel"] = "9"
+      record["EU-Land u. UStID"] = "DE123456789"
+    if idx % 5 == 0:
+      record["Belegfeld 2"] = "0105"
+    records.append(record)
+  return records
+
+
+def timed(fn, *args):
+  started = time.perf_counter()
+  result = fn(*args)
+  return time.perf_counter() - started, result
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog="python -m benchmarks.datev_rows")
+  parser.add_argument('--rows', type=int, default=100000, help='number of records')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args(argv)
+
+  records = generateRecords(args.rows, seed=args.seed)
+  amounts = [record.pop("Umsatz (ohne Soll/Haben-Kz)") for record in records]
+  decimals = [decimal.Decimal(cents) / 100 for cents in amounts]
+
+  results = []
+  legacy_s, legacy_amounts = timed(lambda: [legacyFormatDecimal(d) for d in decimals])
+  decimal_s, decimal_amounts = timed(lambda: [output.formatDecimal(d) for d in decimals])
+  results.append(("amounts", legacy_s, decimal_s, legacy_amounts == decimal_amounts))
+  # As in balance.createAccountingRecords(), from the cents of the API
+  legacy_s, legacy_amounts = timed(lambda: [legacyFormatDecimal(decimal.Decimal(cents) / 100) for cents in amounts])
+  cents_s, cents_amounts = timed(lambda: [output.formatCents(cents) for cents in amounts])
+  results.append(("amounts from cents", legacy_s, cents_s, legacy_amounts == cents_amounts))
+
+  for record, amount in zip(records, cents_amounts):
+    record["Umsatz (ohne Soll/Haben-Kz)"] = amount
+
+  legacy_fp, fp = io.StringIO(), io.StringIO()
+  # Both mutate the records, and the Buchungstext must be quoted only once
+  legacy_records = [dict(record) for record in records]
+  legacy_s, _ = timed(legacyPrintRows, legacy_fp, legacy_records)
+  # Includes the header lines and the checks of the dates of all records
+  rows_s, _ = timed(output.printRecords, fp, records)
+  results.append(("rows", legacy_s, rows_s, legacy_fp.getvalue() == fp.getvalue().split("\n", 2)[2]))
+
+  print("{} rows".format(args.rows))
+  identical = True
+  for name, before_s, after_s, same in results:
+    identical = identical and same
+    print("  {} {:8.3f}s -> {:8.3f}s  {:5.1f}x  {}".format(
+      name.ljust(20), before_s, after_s, before_s / after_s if after_s else 0,
+      "identical" if same else "DIFFERENT"))
+
+  return 0 if identical else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,494 @@
+"""
+Local stand-in for the Stripe API endpoints used by stripe_datev, serving a
+synthetic dataset, for load and concurrency tests without touching Stripe.
+
+  python -m benchmarks.fake_stripe --invoices 5000 --months 2023-01:2023-12 --latency 0.05 --rate-limit 0.02
+  python stripe-datev-cli.py --api-base http://127.0.0.1:12111 download 2023 5
+
+Supports `created` filters, cursors (starting_after / ending_before), `limit`,
+`expand`, configurable latency and randomly injected HTTP 429 responses.
+Report runs of the itemized balance change report succeed immediately, their
+CSV file is generated from the dataset's balance transactions.
+FakeStripeHTTPClient serves the same dataset in-process, without a socket.
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+from benchmarks import synthetic
+
+receipts_base = "https://pay.stripe.com"
+
+
+def parseQuery(query):
+  """
+  Parses form encoded Stripe parameters (`created[gte]=1`, `expand[0]=x`)
+  into nested dicts and lists.
+  """
+  params = {}
+  for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+    parts = re.findall(r"[^\[\]]+|\[\]", key)
+    target = params
+    for idx, part in enumerate(parts):
+      last = idx == len(parts) - 1
+      if last:
+        if isinstance(target, list):
+          target.append(value)
+        else:
+          target[part] = value
+      else:
+        is_list = parts[idx + 1] == "[]" or parts[idx + 1].isdigit()
+        if isinstance(target, list):
+          target.append([] if is_list else {})
+          target = target[-1]
+        else:
+          target = target.setdefault(part, [] if is_list else {})
+  return params
+
+
+def matchesCreated(obj, created):
+  if not isinstance(created, dict):
+    return created is None or obj["created"] == int(created)
+  for op, value in created.items():
+    value = int(value)
+    if (op == "gte" and obj["created"] < value) or (op == "gt" and obj["created"] <= value) or \
+        (op == "lte" and obj["created"] > value) or (op == "lt" and obj["created"] >= value):
+      return False
+  return True
+
+
+class FakeStripe(object):
+
+  def __init__(self, store, base_url="http://127.0.0.1:12111", latency=0, rate_limit=0, seed=0):
+    self.store = store
+    self.base_url = base_url
+    self.latency = latency
+    self.rate_limit = rate_limit
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.report_runs = {}
+    # Collection name -> (size when sorted, objects newest first, ID -> index)
+    self.sorted = {}
+    self.routes = [
+      ("GET", r"/v1/invoices", self.listInvoices),
+      ("GET", r"/v1/invoices/(in_\w+)", self.retrieve),
+      ("GET", r"/v1/invoices/(in_\w+)/lines", self.listInvoiceLines),
+      ("GET", r"/v1/balance_transactions", self.listBalanceTransactions),
+      ("GET", r"/v1/balance_transactions/(txn_\w+)", self.retrieve),
+      ("GET", r"/v1/charges", self.listCharges),
+      ("GET", r"/v1/charges/(ch_\w+)", self.retrieve),
+      ("GET", r"/v1/customers", self.listCustomers),
+      ("GET", r"/v1/customers/(cus_\w+)", self.retrieve),
+      ("POST", r"/v1/customers/(cus_\w+)", self.modifyCustomer),
+      ("GET", r"/v1/customers/(cus_\w+)/tax_ids", self.listTaxIds),
+      ("GET", r"/v1/credit_notes", self.listCreditNotes),
+      ("GET", r"/v1/events", self.listEvents),
+      ("GET", r"/v1/account", self.retrieveAccount),
+      ("GET", r"/v1/checkout/sessions", self.listCheckoutSessions),
+      ("GET", r"/v1/tax_rates/(txr_\w+)", self.retrieve),
+      ("GET", r"/v1/reporting/report_types/(balance_change_from_activity\.itemized\.3)", self.retrieveReportType),
+      ("POST", r"/v1/reporting/report_runs", self.createReportRun),
+      ("GET", r"/v1/reporting/report_runs/(frr_\w+)", self.retrieveReportRun),
+      ("GET", r"/v1/files/(file_\w+)/contents", self.fileContents),
+      ("GET", r"/invoice/(in_\w+)/pdf", self.invoicePdf),
+      ("GET", r"/receipts/(ch_\w+)", self.receipt),
+    ]
+
+  def handle(self, method, url, body=None):
+    """
+    Returns status, content and headers of the response to a request.
+    """
+    if self.latency:
+      time.sleep(self.latency)
+    if self.rate_limit:
+      with self.lock:
+        limited = self.random.random() < self.rate_limit
+      if limited:
+        return self.error(429, "rate_limit_error", "Too many requests hit the API too quickly.")
+
+    parsed = urllib.parse.urlsplit(url)
+    params = parseQuery(parsed.query)
+    if body:
+      params.update(parseQuery(body if isinstance(body, str) else body.decode("utf-8")))
+    for route_method, pattern, handler in self.routes:
+      match = re.fullmatch(pattern, parsed.path)
+      if route_method == method.upper() and match:
+        return handler(params, *match.groups())
+    return self.error(404, "invalid_request_error", "Unrecognized request URL ({} {})".format(method.upper(), parsed.path))
+
+  def error(self, status, type, message):
+    return status, json.dumps({"error": {"type": type, "message": message}}), self.headers()
+
+  def headers(self, content_type="application/json"):
+    with self.lock:
+      request_id = "req_{:016x}".format(self.random.getrandbits(64))
+    return {"Content-Type": content_type, "Request-Id": request_id}
+
+  def json(self, obj):
+    # Receipt and PDF links point to this server
+    content = json.dumps(obj).replace(receipts_base, self.base_url)
+    return 200, content, self.headers()
+
+  def expandPaths(self, params, prefix=None):
+    paths = params.get("expand", [])
+    if prefix is None:
+      return paths
+    return [path[len(prefix):] for path in paths if path.startswith(prefix)]
+
+  def page(self, params, objects, url):
+    """
+    Page of a list embedded in an object (e.g. invoice lines), in its order.
+    """
+    limit = min(100, int(params.get("limit", 10)))
+    if "starting_after" in params:
+      start = next((idx + 1 for idx, obj in enumerate(objects) if obj["id"] == params["starting_after"]), len(objects))
+      data = objects[start:start + limit]
+      has_more = start + limit < len(objects)
+    elif "ending_before" in params:
+      end = next((idx for idx, obj in enumerate(objects) if obj["id"] == params["ending_before"]), 0)
+      data = objects[max(0, end - limit):end]
+      has_more = end - limit > 0
+    else:
+      data = objects[:limit]
+      has_more = limit < len(objects)
+    return self.listResponse(params, data, has_more, url)
+
+  def listResponse(self, params, data, has_more, url):
+    expand = self.expandPaths(params, "data.")
+    return self.json({
+      "object": "list",
+      "data": [self.store.expand(obj, expand) for obj in data],
+      "has_more": has_more,
+      "url": url,
+    })
+
+  def sortedCollection(self, name):
+    """
+    Objects of a collection of the store newest first, like Stripe lists them,
+    and the index of each ID. Sorted once, and again only after objects were
+    added.
+    """
+    collection = getattr(self.store, name)
+    with self.lock:
+      size, objects, index = self.sorted.get(name, (None, None, None))
+      if size != len(collection):
+        objects = sorted(collection.values(), key=lambda o: (o.get("created", 0), o["id"]), reverse=True)
+        index = {obj["id"]: idx for idx, obj in enumerate(objects)}
+        self.sorted[name] = (len(collection), objects, index)
+    return objects, index
+
+  def listCollection(self, params, name, url, match=lambda obj: True):
+    """
+    Page of the objects of a collection that match, from the cursor on,
+    without filtering the whole collection.
+    """
+    objects, index = self.sortedCollection(name)
+    limit = min(100, int(params.get("limit", 10)))
+    data = []
+    if "ending_before" in params:
+      idx = index.get(params["ending_before"], 0) - 1
+      while idx >= 0 and len(data) <= limit:
+        if match(objects[idx]):
+          data.append(objects[idx])
+        idx -= 1
+      return self.listResponse(params, list(reversed(data[:limit])), len(data) > limit, url)
+
+    idx = 0
+    if "starting_after" in params:
+      idx = index.get(params["starting_after"], len(objects) - 1) + 1
+    while idx < len(objects) and len(data) <= limit:
+      if match(objects[idx]):
+        data.append(objects[idx])
+      idx += 1
+    return self.listResponse(params, data[:limit], len(data) > limit, url)
+
+  def retrieve(self, params, id):
+    obj = self.store.get(id)
+    if obj is None:
+      return self.error(404, "invalid_request_error", "No such object: '{}'".format(id))
+    return self.json(self.store.expand(obj, self.expandPaths(params)))
+
+  def listInvoices(self, params):
+    return self.listCollection(params, "invoices", "/v1/invoices", lambda invoice: (
+      matchesCreated(invoice, params.get("created", None))
+      and params.get("status", invoice["status"]) == invoice["status"]
+      and params.get("customer", invoice["customer"]) == invoice["customer"]))
+
+  def listInvoiceLines(self, params, id):
+    invoice = self.store.get(id)
+    if invoice is None:
+      return self.error(404, "invalid_request_error", "No such invoice: '{}'".format(id))
+    return self.page(params, invoice["lines"]["data"], invoice["lines"]["url"])
+
+  def listBalanceTransactions(self, params):
+    return self.listCollection(params, "balance_transactions", "/v1/balance_transactions", lambda tx: (
+      matchesCreated(tx, params.get("created", None))
+      and params.get("type", tx["type"]) == tx["type"]))
+
+  def listCharges(self, params):
+    return self.listCollection(params, "charges", "/v1/charges", lambda ch: matchesCreated(ch, params.get("created", None)))
+
+  def listCustomers(self, params):
+    return self.listCollection(params, "customers", "/v1/customers", lambda cus: (
+      matchesCreated(cus, params.get("created", None))
+      and params.get("email", cus["email"]) == cus["email"]))
+
+  def modifyCustomer(self, params, id):
+    cus = self.store.get(id)
+    if cus is None:
+      return self.error(404, "invalid_request_error", "No such customer: '{}'".format(id))
+    with self.lock:
+      metadata = dict(cus["metadata"])
+      for key, value in params.get("metadata", {}).items():
+        if value == "":
+          metadata.pop(key, None)
+        else:
+          metadata[key] = value
+      cus["metadata"] = metadata
+      self.addEvent("customer.updated", cus)
+    return self.json(self.store.expand(cus, self.expandPaths(params)))
+
+  def addEvent(self, type, obj):
+    event_id = "evt_{:016x}".format(len(self.store.events) + 1)
+    self.store.add({
+      "id": event_id,
+      "object": "event",
+      "type": type,
+      "created": int(time.time()),
+      "data": {"object": dict(obj)},
+    })
+
+  def listEvents(self, params):
+    types = params.get("types", [params["type"]] if "type" in params else None)
+    return self.listCollection(params, "events", "/v1/events", lambda event: (
+      matchesCreated(event, params.get("created", None))
+      and (types is None or event["type"] in types)))
+
+  def retrieveAccount(self, params):
+    # Created before all customers
+    return self.json({
+      "id": "acct_fake",
+      "object": "account",
+      "created": min([cus["created"] for cus in self.store.customers.values()], default=0) - 24 * 60 * 60,
+    })
+
+  def listTaxIds(self, params, id):
+    tax_ids = self.store.tax_ids.get(id, None)
+    if tax_ids is None:
+      return self.error(404, "invalid_request_error", "No such customer: '{}'".format(id))
+    return self.page(params, tax_ids["data"], tax_ids["url"])
+
+  def listCreditNotes(self, params):
+    return self.listCollection(params, "credit_notes", "/v1/credit_notes", lambda cn: (
+      matchesCreated(cn, params.get("created", None))
+      and params.get("invoice", cn["invoice"]) == cn["invoice"]))
+
+  def listCheckoutSessions(self, params):
+    return self.listCollection(params, "checkout_sessions", "/v1/checkout/sessions", lambda session: (
+      params.get("payment_intent", session["payment_intent"]) == session["payment_intent"]))
+
+  def retrieveReportType(self, params, id):
+    return self.json({
+      "id": id,
+      "object": "reporting.report_type",
+      "data_available_start": min([tx["created"] for tx in self.store.balance_transactions.values()], default=0),
+      "data_available_end": int(time.time()),
+    })
+
+  def reportRun(self, id):
+    run = self.report_runs[id]
+    return {
+      "id": id,
+      "object": "reporting.report_run",
+      "report_type": run["report_type"],
+      "parameters": run["parameters"],
+      "status": "succeeded",
+      "result": {
+        "id": "file_{}".format(id[4:]),
+        "object": "file",
+        "url": "{}/v1/files/file_{}/contents".format(self.base_url, id[4:]),
+      },
+    }
+
+  def createReportRun(self, params):
+    with self.lock:
+      id = "frr_{:08d}".format(len(self.report_runs) + 1)
+      self.report_runs[id] = {"report_type": params.get("report_type"), "parameters": params.get("parameters", {})}
+    return self.json(dict(self.reportRun(id), status="pending", result=None))
+
+  def retrieveReportRun(self, params, id):
+    if id not in self.report_runs:
+      return self.error(404, "invalid_request_error", "No such report run: '{}'".format(id))
+    return self.json(self.reportRun(id))
+
+  def reportRow(self, tx):
+    def amount(cents):
+      return "{:.2f}".format(cents / 100)
+
+    def created(timestamp):
+      return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    source = self.store.get(tx["source"]) if tx["source"] else None
+    charge = None
+    if source is not None and source["object"] == "charge":
+      charge = source
+    elif source is not None and source["object"] == "refund":
+      charge = self.store.get(source["charge"])
+    return {
+      "balance_transaction_id": tx["id"],
+      "created_utc": created(tx["created"]),
+      "currency": tx["currency"],
+      "gross": amount(tx["amount"]),
+      "fee": amount(tx["fee"]),
+      "net": amount(tx["net"]),
+      "reporting_category": tx["reporting_category"],
+      "source_id": tx["source"] or "",
+      "description": tx["description"] or "",
+      "customer_facing_amount": amount(charge["amount"]) if charge else "",
+      "customer_facing_currency": charge.get("currency", tx["currency"]) if charge else "",
+      "customer_id": (charge["customer"] or "") if charge else "",
+      "charge_id": charge["id"] if charge else "",
+      "invoice_id": (charge["invoice"] or "") if charge else "",
+    }
+
+  def fileContents(self, params, id):
+    run = self.report_runs.get("frr_{}".format(id[5:]), None)
+    if run is None:
+      return 404, "Not found", self.headers("text/plain")
+    interval = {"gte": run["parameters"]["interval_start"], "lt": run["parameters"]["interval_end"]}
+    txs = sorted([tx for tx in self.store.balance_transactions.values() if matchesCreated(tx, interval)],
+                 key=lambda tx: (tx["created"], tx["id"]))
+    columns = run["parameters"]["columns"]
+    content = io.StringIO()
+    writer = csv.DictWriter(content, columns, extrasaction="ignore", lineterminator="\n")
+    writer.writeheader()
+    for tx in txs:
+      writer.writerow(self.reportRow(tx))
+    return 200, content.getvalue(), self.headers("text/csv")
+
+  def invoicePdf(self, params, id):
+    if self.store.get(id) is None:
+      return 404, "Not found", self.headers("text/plain")
+    return 200, "%PDF-1.4\n% Invoice {}\n%%EOF\n".format(id).encode("latin-1"), self.headers("application/pdf")
+
+  def receipt(self, params, id):
+    if self.store.get(id) is None:
+      return 404, "Not found", self.headers("text/plain")
+    return 200, "<html><body>Receipt {}</body></html>".format(id), self.headers("text/html")
+
+
+class FakeStripeHTTPClient(stripe.HTTPClient):
+  """
+  Stripe HTTP client answering all requests from a FakeStripe, in-process.
+  """
+
+  name = "fake-stripe"
+
+  def __init__(self, fake):
+    super().__init__()
+    self.fake = fake
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    status, content, headers = self.fake.handle(method, url, post_data)
+    return content, status, headers
+
+  def close(self):
+    pass
+
+
+def makeHandler(fake):
+
+  class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, method):
+      length = int(self.headers.get("Content-Length", 0) or 0)
+      body = self.rfile.read(length).decode("utf-8") if length > 0 else None
+      status, content, headers = fake.handle(method, self.path, body)
+      if isinstance(content, str):
+        content = content.encode("utf-8")
+      self.send_response(status)
+      for key, value in headers.items():
+        self.send_header(key, value)
+      if status == 429:
+        self.send_header("Retry-After", "1")
+      self.send_header("Content-Length", str(len(content)))
+      self.end_headers()
+      self.wfile.write(content)
+
+    def do_GET(self):
+      self.respond("GET")
+
+    def do_POST(self):
+      self.respond("POST")
+
+    def do_DELETE(self):
+      self.respond("DELETE")
+
+    def log_message(self, format, *args):
+      pass
+
+  return Handler
+
+
+def serve(fake, host="127.0.0.1", port=12111):
+  """
+  Starts serving fake in a background thread, returns the server.
+  """
+  server = ThreadingHTTPServer((host, port), makeHandler(fake))
+  server.daemon_threads = True
+  fake.base_url = "http://{}:{}".format(host, server.server_address[1])
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
+
+
+def generateMonths(months, invoice_count, seed=0):
+  """
+  Store with invoice_count invoices per month, months as "YYYY-MM:YYYY-MM".
+  """
+  first, last = months.split(":") if ":" in months else (months, months)
+  year, month = map(int, first.split("-"))
+  last_year, last_month = map(int, last.split("-"))
+  store = None
+  while (year, month) <= (last_year, last_month):
+    store = synthetic.generate(year, month, invoice_count, seed=seed, store=store)
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+  return store
+
+
+def main():
+  parser = argparse.ArgumentParser(prog="python -m benchmarks.fake_stripe")
+  parser.add_argument('--invoices', type=int, default=1000, help='synthetic invoices per month')
+  parser.add_argument('--months', type=str, default="2023-05", help='month or range of months (YYYY-MM:YYYY-MM)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--host', type=str, default="127.0.0.1")
+  parser.add_argument('--port', type=int, default=12111)
+  parser.add_argument('--latency', type=float, default=0, help='seconds of latency added to every request')
+  parser.add_argument('--rate-limit', type=float, default=0, help='ratio of requests answered with HTTP 429')
+  args = parser.parse_args()
+
+  store = generateMonths(args.months, args.invoices, seed=args.seed)
+  fake = FakeStripe(store, latency=args.latency, rate_limit=args.rate_limit, seed=args.seed)
+  server = serve(fake, args.host, args.port)
+  print("Serving {} synthetic objects on {}".format(store.count(), fake.base_url))
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+
+if __name__ == '__main__':
+  main()
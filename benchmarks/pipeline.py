@@ -0,0 +1,186 @@
+"""
+End-to-end throughput benchmark of the accounting pipeline on synthetic data,
+without network access.
+
+  python -m benchmarks.pipeline --invoices 10000
+  python -m benchmarks.pipeline --invoices 10000 --golden benchmarks/golden.json
+
+With --golden, the SHA-256 of every output file is compared with the given
+file (which is created if it does not exist yet), to prove that an
+optimization produces byte-identical output.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import synthetic
+from stripe_datev import balance, charges, csv, invoices, output, profile
+
+
+class Stages(object):
+
+  def __init__(self, trace_memory):
+    self.trace_memory = trace_memory
+    self.results = []
+
+  @contextlib.contextmanager
+  def stage(self, name, count):
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+      yield
+    result = {
+      "stage": name,
+      "objects": count,
+      "wall_s": time.perf_counter() - wall,
+      "cpu_s": time.process_time() - cpu,
+    }
+    result["objects_per_s"] = count / result["wall_s"] if result["wall_s"] > 0 else None
+    if self.trace_memory:
+      result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    self.results.append(result)
+
+
+def maxRssMb():
+  rss = profile.maxRssBytes()
+  return rss / 2**20 if rss is not None else None
+
+
+def normalizedHash(path):
+  """
+  SHA-256 of a file, ignoring the creation timestamp in DATEV headers.
+  """
+  with open(path, "rb") as fp:
+    content = fp.read()
+  if content.startswith(b'"EXTF"'):
+    header, rest = content.split(b"\n", 1)
+    fields = header.split(b";")
+    fields[5] = b""
+    content = b";".join(fields) + b"\n" + rest
+  return hashlib.sha256(content).hexdigest()
+
+
+def runPipeline(store, out_dir, year, month, stages):
+  with stages.stage("construct", store.count()):
+    synthetic.primeCaches(store)
+    invs, balance_transactions = synthetic.pipelineInputs(store)
+
+  with stages.stage("invoices.createRevenueItems", len(invs)):
+    revenue_items = invoices.createRevenueItems(invs)
+
+  with stages.stage("charges.createRevenueItems", len(balance_transactions)):
+    direct_charges = list(filter(lambda charge: not charges.chargeHasInvoice(charge),
+                                 balance.extractCharges(balance_transactions)))
+    revenue_items += charges.createRevenueItems(direct_charges)
+
+  with stages.stage("invoices.to_csv", len(invs)):
+    with open(os.path.join(out_dir, "overview-{:04d}-{:02d}.csv".format(year, month)), "w", encoding="utf-8") as fp:
+      csv.write_csv(fp, invoices.to_csv_lines(invs))
+
+  with stages.stage("invoices.to_recognized_month_csv2", len(revenue_items)):
+    with open(os.path.join(out_dir, "monthly_recognition-{:04d}-{:02d}.csv".format(year, month)), "w", encoding="utf-8") as fp:
+      csv.write_csv(fp, invoices.to_recognized_month_csv2_lines(revenue_items))
+
+  with stages.stage("invoices.createAccountingRecords", len(revenue_items)):
+    records = []
+    for revenue_item in revenue_items:
+      records += invoices.createAccountingRecords(revenue_item)
+
+  with stages.stage("balance.createAccountingRecords", len(balance_transactions)):
+    balance_records = balance.createAccountingRecords(balance_transactions)
+
+  with stages.stage("output.writeRecords", len(records) + len(balance_records)):
+    this_month = "{:04d}-{:02d}".format(year, month)
+    records_by_month = {}
+    for record in records:
+      records_by_month.setdefault(record["date"].strftime("%Y-%m"), []).append(record)
+    for record_month, month_records in sorted(records_by_month.items()):
+      if record_month == this_month:
+        name = "EXTF_{}_Revenue.csv".format(this_month)
+      else:
+        name = "EXTF_{}_Revenue_From_{}.csv".format(record_month, this_month)
+      output.writeRecords(os.path.join(out_dir, name), month_records,
+                          bezeichung="Stripe Revenue {} from {}".format(record_month, this_month))
+    output.writeRecords(os.path.join(out_dir, "EXTF_{}_Balance.csv".format(this_month)),
+                        balance_records, bezeichung="Stripe Balance {}".format(this_month))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog="python -m benchmarks.pipeline")
+  parser.add_argument('--invoices', type=int, default=1000, help='number of synthetic invoices')
+  parser.add_argument('--charges', type=float, default=0.1, help='direct charges relative to invoices')
+  parser.add_argument('--year', type=int, default=2023)
+  parser.add_argument('--month', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--out', type=str, help='output directory (default: temporary directory)')
+  parser.add_argument('--golden', type=str, help='file with output hashes to compare with (created if missing)')
+  parser.add_argument('--trace-memory', action='store_true', help='report peak traced memory per stage (slower)')
+  parser.add_argument('--json', action='store_true', help='print the report as JSON')
+  args = parser.parse_args(argv)
+
+  stages = Stages(args.trace_memory)
+  if args.trace_memory:
+    tracemalloc.start()
+
+  started = time.perf_counter()
+  with stages.stage("generate", args.invoices):
+    store = synthetic.generate(args.year, args.month, args.invoices,
+                               seed=args.seed, charge_ratio=args.charges)
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    out_dir = args.out or tmp_dir
+    if not os.path.exists(out_dir):
+      os.makedirs(out_dir)
+    runPipeline(store, out_dir, args.year, args.month, stages)
+    hashes = {name: normalizedHash(os.path.join(out_dir, name)) for name in sorted(os.listdir(out_dir))}
+
+  report = {
+    "invoices": args.invoices,
+    "objects": store.count(),
+    "total_wall_s": time.perf_counter() - started,
+    "max_rss_mb": maxRssMb(),
+    "stages": stages.results,
+    "outputs": hashes,
+  }
+
+  golden_ok = True
+  if args.golden:
+    if os.path.exists(args.golden):
+      with open(args.golden, "r", encoding="utf-8") as fp:
+        golden = json.load(fp)
+      golden_ok = golden == hashes
+      report["golden"] = "match" if golden_ok else "MISMATCH"
+    else:
+      with open(args.golden, "w", encoding="utf-8") as fp:
+        json.dump(hashes, fp, indent=2, sort_keys=True)
+      report["golden"] = "written"
+
+  if args.json:
+    print(json.dumps(report, indent=2))
+  else:
+    print("{} objects ({} invoices), total {:.2f}s, max RSS {} MB".format(
+      report["objects"], args.invoices, report["total_wall_s"],
+      "{:.0f}".format(report["max_rss_mb"]) if report["max_rss_mb"] is not None else "n/a"))
+    for result in stages.results:
+      print("  {} {:8.3f}s {:>12} obj/s{}".format(
+        result["stage"].ljust(36), result["wall_s"],
+        "{:.0f}".format(result["objects_per_s"]) if result["objects_per_s"] else "-",
+        "  peak {:.1f} MB".format(result["peak_traced_mb"]) if "peak_traced_mb" in result else ""))
+    for name, digest in hashes.items():
+      print("  {} {}".format(digest[:16], name))
+    if args.golden:
+      print("Golden output:", report["golden"])
+
+  return 0 if golden_ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,435 @@
+import calendar
+import random
+from datetime import datetime
+
+import stripe
+
+from stripe_datev import config, projections
+
+countries = [
+  # country, vat_region, weight
+  ("DE", "DE", 50),
+  ("FR", "EU", 10),
+  ("NL", "EU", 8),
+  ("AT", "EU", 5),
+  ("US", "World", 15),
+  ("GB", "World", 7),
+  ("CH", "World", 5),
+]
+
+products = [
+  ("Njord Analytics", 4900),
+  ("Njord Player", 9900),
+  ("Njord Analytics & Njord Player", 14900),
+  ("Fleet Race reports", 49900),
+  ("Season pass", 119900),
+]
+
+months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# Prefix of object IDs and the collection they are stored in
+collections = {
+  "cus": "customers",
+  "in": "invoices",
+  "ch": "charges",
+  "txn": "balance_transactions",
+  "po": "payouts",
+  "re": "refunds",
+  "tr": "transfers",
+  "txr": "tax_rates",
+  "cs": "checkout_sessions",
+  "cn": "credit_notes",
+  "evt": "events",
+}
+
+
+class Store(object):
+  """
+  Synthetic Stripe objects as they are returned by the API without any
+  expansions: references to other objects are IDs.
+  """
+
+  def __init__(self):
+    for name in collections.values():
+      setattr(self, name, {})
+    # Only returned by the API when expanded
+    self.tax_ids = {}
+
+  def add(self, obj):
+    getattr(self, collections[obj["id"].split("_")[0]])[obj["id"]] = obj
+    return obj
+
+  def get(self, id):
+    if not isinstance(id, str) or "_" not in id:
+      return None
+    collection = collections.get(id.split("_")[0], None)
+    if collection is None:
+      return None
+    return getattr(self, collection).get(id, None)
+
+  def count(self):
+    return sum(len(getattr(self, name)) for name in collections.values())
+
+  def expand(self, obj, paths):
+    """
+    Returns a copy of obj with the given (dotted) expand paths resolved, like
+    the `expand` request parameter does.
+    """
+    obj = dict(obj)
+    for path in paths:
+      self._expandPath(obj, path.split("."))
+    return obj
+
+  def _expandPath(self, obj, parts):
+    field, rest = parts[0], parts[1:]
+    if field == "tax_ids" and obj.get("object", None) == "customer":
+      if "tax_ids" not in obj:
+        obj["tax_ids"] = self.tax_ids.get(obj["id"], self.emptyList(
+          "/v1/customers/{}/tax_ids".format(obj["id"])))
+      return
+    value = obj.get(field, None)
+    if isinstance(value, str):
+      resolved = self.get(value)
+      if resolved is None:
+        return
+      value = obj[field] = dict(resolved)
+    if isinstance(value, dict) and len(rest) > 0:
+      if value.get("object", None) == "list" and rest[0] == "data":
+        value = obj[field] = dict(value, data=[dict(item) for item in value["data"]])
+        for item in value["data"]:
+          self._expandPath(item, rest[1:])
+      else:
+        self._expandPath(value, rest)
+
+  def emptyList(self, url):
+    return {"object": "list", "data": [], "has_more": False, "url": url}
+
+
+def toStripe(klass, obj):
+  return klass.construct_from(obj, stripe.api_key or "sk_test_synthetic")
+
+
+def generate(year, month, invoice_count, seed=0, charge_ratio=0.1, customer_ratio=0.3, store=None):
+  """
+  Generates a deterministic, consistent set of customers, invoices, charges
+  and balance transactions for one month in the accounting timezone. All
+  invoices are finalized, and all balance transactions are created within the
+  month. Direct charges (without invoice) are generated in addition,
+  charge_ratio relative to invoice_count.
+
+  Pass the store of a previous call to add another month, reusing its
+  customers.
+  """
+  rng = random.Random("{}-{}-{}".format(seed, year, month) if store is not None else seed)
+  if store is None:
+    store = Store()
+  invoice_offset = len(store.invoices)
+  direct_offset = len(store.checkout_sessions)
+  payout_offset = max((int(id[3:]) for id in store.payouts), default=0)
+  tz = config.accounting_tz
+
+  month_start = int(tz.localize(datetime(year, month, 1)).timestamp())
+  month_end = int(tz.localize(datetime(year, month, calendar.monthrange(year, month)[1], 23, 59, 59)).timestamp())
+
+  def timeInMonth(after=None):
+    return rng.randint(after or month_start, month_end)
+
+  store.add({"id": "txr_DE19", "object": "tax_rate", "percentage": 19.0,
+             "inclusive": False, "country": "DE", "display_name": "USt."})
+
+  customer_count = max(1, int(invoice_count * customer_ratio))
+  country_weights = [c[2] for c in countries]
+  customer_ids = list(store.customers.keys())
+  for idx in range(len(customer_ids), customer_count):
+    country, vat_region, _ = rng.choices(countries, weights=country_weights)[0]
+    customer_id = "cus_{:08d}".format(idx)
+    tax_exempt = "none" if vat_region == "DE" or rng.random() < 0.2 else "reverse"
+    store.add({
+      "id": customer_id,
+      "object": "customer",
+      "created": month_start - rng.randint(0, 3 * 365 * 24 * 60 * 60),
+      "name": "Customer {}".format(idx),
+      "description": None if rng.random() < 0.7 else "Sailing Team {}".format(idx),
+      "email": "customer{}@example.com".format(idx),
+      "address": {
+        "line1": "Street {}".format(idx),
+        "line2": None,
+        "postal_code": "{:05d}".format(idx % 100000),
+        "city": "City",
+        "country": country,
+        "state": None,
+      },
+      "shipping": None,
+      "metadata": {"accountNumber": str(10100 + idx)},
+      "tax_exempt": tax_exempt,
+      "livemode": False,
+    })
+    tax_ids = []
+    if vat_region == "EU" and tax_exempt == "reverse":
+      tax_ids.append({
+        "id": "txi_{:08d}".format(idx),
+        "object": "tax_id",
+        "type": "eu_vat",
+        "value": "{}{:09d}".format(country, idx),
+        "verification": {"status": "verified"},
+      })
+    store.tax_ids[customer_id] = {"object": "list", "data": tax_ids, "has_more": False,
+                                  "url": "/v1/customers/{}/tax_ids".format(customer_id)}
+    customer_ids.append(customer_id)
+
+  def addChargeTransaction(charge):
+    fee = int(round(charge["amount"] * 0.014)) + 25
+    charge["balance_transaction"] = "txn_{}".format(charge["id"][3:])
+    store.add({
+      "id": "txn_{}".format(charge["id"][3:]),
+      "object": "balance_transaction",
+      "type": "charge",
+      "reporting_category": "charge",
+      "created": charge["created"],
+      "amount": charge["amount"],
+      "fee": fee,
+      "net": charge["amount"] - fee,
+      "currency": "eur",
+      "description": charge["description"],
+      "fee_details": [{"amount": fee, "currency": "eur", "description": "Stripe processing fees", "type": "stripe_fee"}],
+      "source": charge["id"],
+      "status": "available",
+    })
+
+  for idx in range(invoice_offset, invoice_offset + invoice_count):
+    customer_id = rng.choice(customer_ids)
+    cus = store.customers[customer_id]
+    taxed = cus["address"]["country"] == "DE"
+    created = timeInMonth()
+    finalized_at = min(month_end, created + rng.randint(0, 60 * 60))
+    is_subscription = rng.random() < 0.6
+
+    lines = []
+    subtotal = 0
+    tax = 0
+    for line_idx in range(rng.choice([1, 1, 1, 2, 3])):
+      name, price = rng.choice(products)
+      quantity = rng.choice([1, 1, 2, 5])
+      amount = price * quantity
+      line = {
+        "id": "il_{:08d}_{}".format(idx, line_idx),
+        "object": "line_item",
+        "amount": amount,
+        "currency": "eur",
+        "quantity": quantity,
+        "discount_amounts": [],
+        "tax_amounts": [],
+      }
+      kind = rng.random()
+      if is_subscription or kind < 0.4:
+        # Prepaid period, monthly or yearly
+        period_days = 365 if rng.random() < 0.3 else 30
+        line["period"] = {"start": created, "end": created + period_days * 24 * 60 * 60}
+        line["description"] = "{} × {}".format(quantity, name)
+      elif kind < 0.8:
+        # Period only in the description, parsed by dateparser
+        line["period"] = {"start": created, "end": created}
+        start_month = datetime.fromtimestamp(created, tz).month
+        line["description"] = "{}, valid {} 1st {} - {} 28th {}".format(
+          name, months[start_month - 1], year, months[(start_month + 1) % 12], year + (1 if start_month >= 11 else 0))
+      else:
+        line["period"] = {"start": created, "end": created}
+        line["description"] = "{} (one-off)".format(name)
+      if rng.random() < 0.1:
+        discount = amount // 10
+        line["discount_amounts"].append({"amount": discount, "discount": "di_{:08d}".format(idx)})
+        amount -= discount
+      if taxed:
+        line_tax = int(round(amount * 0.19))
+        line["tax_amounts"].append({"amount": line_tax, "inclusive": False, "tax_rate": "txr_DE19"})
+        tax += line_tax
+      subtotal += amount
+      lines.append(line)
+
+    total = subtotal + tax
+    status_transitions = {
+      "finalized_at": finalized_at,
+      "paid_at": None,
+      "voided_at": None,
+      "marked_uncollectible_at": None,
+    }
+    outcome = rng.random()
+    if outcome < 0.03:
+      status = "void"
+      status_transitions["voided_at"] = timeInMonth(finalized_at)
+    elif outcome < 0.05:
+      status = "uncollectible"
+      status_transitions["marked_uncollectible_at"] = timeInMonth(finalized_at)
+    elif outcome < 0.8:
+      status = "paid"
+      status_transitions["paid_at"] = timeInMonth(finalized_at)
+    else:
+      status = "open"
+
+    invoice_id = "in_{:08d}".format(idx)
+    store.add({
+      "id": invoice_id,
+      "object": "invoice",
+      "number": "SYN-{:06d}".format(idx),
+      "created": created,
+      "due_date": finalized_at + 14 * 24 * 60 * 60,
+      "status": status,
+      "status_transitions": status_transitions,
+      "customer": customer_id,
+      "customer_tax_exempt": cus["tax_exempt"],
+      "automatic_tax": {"enabled": False},
+      "subtotal": subtotal,
+      "tax": tax if taxed else None,
+      "total": total,
+      "amount_paid": total if status == "paid" else 0,
+      "post_payment_credit_notes_amount": 0,
+      "total_tax_amounts": [{"amount": tax, "inclusive": False, "tax_rate": "txr_DE19"}] if taxed else [],
+      "subscription": "sub_{:08d}".format(idx) if is_subscription else None,
+      "metadata": {},
+      "currency": "eur",
+      "livemode": False,
+      "invoice_pdf": "https://pay.stripe.com/invoice/{}/pdf".format(invoice_id),
+      "lines": {
+        "object": "list",
+        "data": lines,
+        "has_more": False,
+        "total_count": len(lines),
+        "url": "/v1/invoices/{}/lines".format(invoice_id),
+      },
+    })
+
+    if status == "paid":
+      charge_id = "ch_{:08d}".format(idx)
+      addChargeTransaction(store.add({
+        "id": charge_id,
+        "object": "charge",
+        "amount": total,
+        "created": status_transitions["paid_at"],
+        "customer": customer_id,
+        "invoice": invoice_id,
+        "description": "Payment for Invoice",
+        "payment_intent": "pi_{:08d}".format(idx),
+        "receipt_number": None,
+        "receipt_url": "https://pay.stripe.com/receipts/{}".format(charge_id),
+        "refunded": False,
+        "refunds": {"object": "list", "data": [], "has_more": False, "url": "/v1/charges/{}/refunds".format(charge_id)},
+      }))
+
+  for idx in range(direct_offset, direct_offset + int(invoice_count * charge_ratio)):
+    customer_id = rng.choice(customer_ids)
+    taxed = store.customers[customer_id]["address"]["country"] == "DE"
+    name, price = rng.choice(products)
+    amount = int(round(price * 1.19)) if taxed else price
+    charge_id = "ch_d{:07d}".format(idx)
+    payment_intent = "pi_d{:07d}".format(idx)
+    created = timeInMonth()
+    start_month = datetime.fromtimestamp(created, tz).month
+    store.add({
+      "id": "cs_d{:07d}".format(idx),
+      "object": "checkout.session",
+      "payment_intent": payment_intent,
+      "amount_total": amount,
+      "total_details": {"amount_tax": amount - price if taxed else 0, "amount_discount": 0, "amount_shipping": 0},
+      "line_items": {
+        "object": "list",
+        "data": [{"id": "li_d{:07d}".format(idx), "object": "item", "description": "{}, {} {}".format(name, months[start_month - 1], year)}],
+        "has_more": False,
+        "url": "/v1/checkout/sessions/cs_d{:07d}/line_items".format(idx),
+      },
+    })
+    addChargeTransaction(store.add({
+      "id": charge_id,
+      "object": "charge",
+      "amount": amount,
+      "created": created,
+      "customer": customer_id,
+      "invoice": None,
+      "description": None,
+      "payment_intent": payment_intent,
+      "receipt_number": "{:04d}-{:04d}".format(idx // 10000, idx % 10000),
+      "receipt_url": "https://pay.stripe.com/receipts/{}".format(charge_id),
+      "refunded": False,
+      "refunds": {"object": "list", "data": [], "has_more": False, "url": "/v1/charges/{}/refunds".format(charge_id)},
+    }))
+
+  # One payout per day with the net balance of that day's charges
+  nets_by_day = {}
+  for tx in store.balance_transactions.values():
+    if tx["created"] < month_start or tx["created"] > month_end or tx["type"] != "charge":
+      continue
+    day = datetime.fromtimestamp(tx["created"], tz).day
+    nets_by_day[day] = nets_by_day.get(day, 0) + tx["net"]
+  for day, net in sorted(nets_by_day.items()):
+    payout_id = "po_{:08d}".format(payout_offset + day)
+    created = int(tz.localize(datetime(year, month, day, 23, 0)).timestamp())
+    store.add({"id": payout_id, "object": "payout", "amount": net, "created": created})
+    store.add({
+      "id": "txn_po{:06d}".format(payout_offset + day),
+      "object": "balance_transaction",
+      "type": "payout",
+      "reporting_category": "payout",
+      "created": created,
+      "amount": -net,
+      "fee": 0,
+      "net": -net,
+      "currency": "eur",
+      "description": "STRIPE PAYOUT",
+      "fee_details": [],
+      "source": payout_id,
+      "status": "available",
+    })
+
+  store.add({
+    "id": "txn_fee{:04d}{:02d}".format(year, month),
+    "object": "balance_transaction",
+    "type": "stripe_fee",
+    "reporting_category": "fee",
+    "created": month_end - 60 * 60,
+    "amount": -rng.randint(1000, 100000),
+    "fee": 0,
+    "net": 0,
+    "currency": "eur",
+    "description": "Billing - Usage Fee ({}-{:02d})".format(year, month),
+    "fee_details": [],
+    "source": None,
+    "status": "available",
+  })
+
+  return store
+
+
+invoice_expand = ["customer", "customer.tax_ids"]
+balance_transaction_expand = ["source", "source.customer",
+                              "source.customer.tax_ids", "source.invoice", "source.charge",
+                              "source.charge.customer", "source.charge.invoice",
+                              "source.source_transaction", "source.source_transaction.invoice",
+                              "source.destination", "source.destination_payment"]
+
+
+def pipelineInputs(store):
+  """
+  Converts the store into the projections of (expanded) Stripe objects that
+  the download command passes to the pipeline: invoices and balance
+  transactions in ascending order of creation.
+  """
+  invoices = [projections.invoice(toStripe(stripe.Invoice, store.expand(invoice, invoice_expand)))
+              for invoice in sorted(store.invoices.values(), key=lambda i: (i["created"], i["id"]))]
+  balance_transactions = [projections.balanceTransaction(toStripe(stripe.BalanceTransaction,
+                                                                  store.expand(tx, balance_transaction_expand)))
+                          for tx in sorted(store.balance_transactions.values(), key=lambda t: (t["created"], t["id"]))]
+  return invoices, balance_transactions
+
+
+def primeCaches(store):
+  """
+  Fills the module level caches of stripe_datev with the objects that would
+  otherwise be retrieved one by one, so the pipeline runs without network.
+  """
+  from stripe_datev import charges, invoices
+
+  for tax_rate in store.tax_rates.values():
+    invoices.tax_rates_cached[tax_rate["id"]] = toStripe(stripe.TaxRate, tax_rate)
+  for session in store.checkout_sessions.values():
+    charges.checkoutSessionsByPaymentIntent[session["payment_intent"]] = toStripe(
+      stripe.checkout.Session, session)
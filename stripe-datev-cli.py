@@ -12,9 +12,27 @@ import \
   stripe_datev.recognition, \
   stripe_datev.output, \
   stripe_datev.config, \
-  stripe_datev.balance
+  stripe_datev.balance, \
+  stripe_datev.snapshot, \
+  stripe_datev.profile, \
+  stripe_datev.client, \
+  stripe_datev.checkpoint, \
+  stripe_datev.stages, \
+  stripe_datev.preflight, \
+  stripe_datev.quarantine, \
+  stripe_datev.reporting, \
+  stripe_datev.projections, \
+  stripe_datev.journal, \
+  stripe_datev.csv, \
+  stripe_datev.opos, \
+  stripe_datev.deferred, \
+  stripe_datev.pivots, \
+  stripe_datev.parquet, \
+  stripe_datev.validation
+import json
 import os
 import os.path
+import time
 import requests
 import dotenv
 import pytz
@@ -32,14 +50,28 @@ out_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'out')
 if stripe.api_key.startswith("sk_test"):
   out_dir = os.path.join(out_dir, "test")
 if not os.path.exists(out_dir):
-  os.mkdir(out_dir)
+  os.makedirs(out_dir)
 
 
 class StripeDatevCli(object):
 
+  # Don't download receipts and invoice PDFs, set when replaying a snapshot
+  offline = False
+  # Recording or replaying a snapshot
+  snapshotting = False
+  checkpoint = None
+  # Continuing an interrupted run (--resume)
+  resume = False
+
+  # Commands that only read local files and make no Stripe API calls
+  local_commands = ['journal', 'balances', 'deferred', 'pivots']
+
   def run(self, argv):
     parser = argparse.ArgumentParser(
       description='Stripe utility',
+      # -h is passed on to the subcommand
+      add_help=False,
+      allow_abbrev=False,
     )
     parser.add_argument('command', type=str, help='Subcommand to run', choices=[
       'download',
@@ -48,22 +80,123 @@ class StripeDatevCli(object):
       'list_accounts',
       'opos',
       'fees',
-      'preview'
+      'preview',
+      'reprocess',
+      'journal',
+      'balances',
+      'deferred',
+      'pivots'
     ])
 
-    args = parser.parse_args(argv[1:2])
-    getattr(self, args.command)(argv[2:])
+    parser.add_argument('--record', action='store_true',
+                        help='write all Stripe API responses to a snapshot in out/snapshots')
+    parser.add_argument('--replay', type=str, metavar='SNAPSHOT',
+                        help='serve Stripe API responses from a snapshot written with --record, without network access')
 
-  def download(self, argv):
-    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py download")
-    parser.add_argument('year', type=int, help='year to download data for')
-    parser.add_argument('month', type=int, help='month to download data for')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='log the Stripe API responses and completed output files to out/runs, so that an interrupted run can be continued with --resume')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run with the same arguments from its checkpoint in out/runs (implies --checkpoint)')
 
-    args = parser.parse_args(argv)
+    parser.add_argument('--profile', action='store_true',
+                        help='write a JSON report with timings, Stripe API calls and cache hits to out/profiles')
+    parser.add_argument('--profiler', type=str, choices=['cprofile', 'sample'],
+                        help='run under cProfile or a sampling profiler, write collapsed stacks to out/profiles')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='trace memory allocations, write the top allocation sites to out/profiles')
+    parser.add_argument('--api-base', type=str, metavar='URL', default=os.environ.get("STRIPE_API_BASE", None),
+                        help='Stripe API base URL, e.g. of a local stand-in (default: $STRIPE_API_BASE or Stripe)')
 
-    year = int(args.year)
-    month = int(args.month)
+    if argv[1:2] in (["-h"], ["--help"]):
+      parser.print_help()
+      return
 
+    args, rest = parser.parse_known_args(argv[1:])
+
+    if args.api_base:
+      stripe.api_base = args.api_base
+      print("Using Stripe API at {}".format(stripe.api_base))
+
+    self.offline = self.offline or args.replay is not None
+    self.snapshotting = args.record or args.replay is not None
+    if args.replay is not None:
+      stripe_datev.snapshot.replay(args.replay)
+      print("Replaying Stripe API responses from {}".format(args.replay))
+    elif args.record:
+      snapshot_dir = os.path.join(out_dir, "snapshots")
+      if not os.path.exists(snapshot_dir):
+        os.mkdir(snapshot_dir)
+      snapshot_path = os.path.join(
+        snapshot_dir, stripe_datev.snapshot.snapshotFileName(args.command))
+      stripe_datev.snapshot.record(snapshot_path)
+      print("Recording Stripe API responses to {}".format(
+        os.path.relpath(snapshot_path, os.getcwd())))
+
+    if args.profile or args.profiler or args.tracemalloc:
+      profile_dir = os.path.join(out_dir, "profiles")
+      if not os.path.exists(profile_dir):
+        os.mkdir(profile_dir)
+      profile_prefix = os.path.join(profile_dir, "{}-{}".format(
+        args.command, datetime.now().strftime("%Y%m%d-%H%M%S")))
+    if args.profile:
+      stripe_datev.profile.install()
+    if args.replay is None and args.command not in self.local_commands:
+      # Outermost, so that profiles see every attempt
+      stripe_datev.client.install()
+
+    self.resume = args.resume
+    if (args.checkpoint or args.resume) and args.replay is None and args.command not in self.local_commands:
+      self.checkpoint = stripe_datev.checkpoint.Run(
+        os.path.join(out_dir, "runs"), args.command, rest, resume=args.resume)
+      checkpointed = self.checkpoint.install()
+      if args.resume:
+        print("Resuming from {} with {} checkpointed request(s) and {} completed output file(s)".format(
+          os.path.relpath(self.checkpoint.dir, os.getcwd()), checkpointed, len(self.checkpoint.state["outputs"])))
+
+    try:
+      with stripe_datev.profile.profiler(args.profiler, profile_prefix if args.profiler or args.tracemalloc else None,
+                                         trace_memory=args.tracemalloc) as profiler_files:
+        with stripe_datev.profile.phase(args.command):
+          getattr(self, args.command)(rest)
+      if self.checkpoint is not None:
+        self.checkpoint.complete()
+    finally:
+      if stripe.default_http_client is not None:
+        stripe.default_http_client.close()
+      if args.profile:
+        stripe_datev.profile.writeReport(profile_prefix + ".json")
+        profiler_files.append(profile_prefix + ".json")
+      if args.profile or args.profiler or args.tracemalloc:
+        for path in profiler_files:
+          print("Wrote profile to {}".format(os.path.relpath(path, os.getcwd())))
+
+  def downloadFile(self, url, filePath):
+    if self.offline:
+      return
+    print("Downloading {} to {}".format(url, filePath))
+    for attempt in range(stripe_datev.client.maxRetries() + 1):
+      if attempt > 0:
+        time.sleep(stripe_datev.client.backoffSeconds(attempt))
+      started = time.perf_counter()
+      r = requests.get(url)
+      stripe_datev.profile.recordRequest("GET", url, time.perf_counter() - started, r.status_code, len(r.content))
+      if r.status_code != 429 and r.status_code < 500:
+        break
+    if r.status_code != 200:
+      print("HTTP status {}".format(r.status_code))
+      return
+    with stripe_datev.checkpoint.atomicOpen(filePath, "wb") as fp:
+      fp.write(r.content)
+    self.outputCompleted(filePath)
+
+  def outputCompleted(self, filePath):
+    if self.checkpoint is not None and os.path.exists(filePath):
+      self.checkpoint.output(os.path.relpath(filePath, out_dir))
+
+  def periodBounds(self, year, month):
+    """
+    Start and end of a month, or of the year if month is 0.
+    """
     if month > 0:
       fromTime = stripe_datev.config.accounting_tz.localize(
         datetime(year, month, 1, 0, 0, 0, 0))
@@ -74,126 +207,341 @@ class StripeDatevCli(object):
         datetime(year, 1, 1, 0, 0, 0, 0))
       toTime = stripe_datev.config.accounting_tz.localize(
         datetime(year + 1, 1, 1, 0, 0, 0, 0))
+    return fromTime, toTime
+
+  def download(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py download")
+    parser.add_argument('year', type=int, help='year to download data for')
+    parser.add_argument('month', type=int, help='month to download data for')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate all outputs, even if their inputs are unchanged')
+    parser.add_argument('--no-preflight', action='store_true',
+                        help='skip validating the customers of the period before processing')
+    parser.add_argument('--fill-account-numbers', action='store_true',
+                        help='assign account numbers to customers of the period that have none, instead of aborting')
+    parser.add_argument('--quarantine', action='store_true',
+                        help='leave out objects that fail to process and list them in out/errors, instead of aborting')
+    parser.add_argument('--balance-report', action='store_true',
+                        help='retrieve balance transactions with one Stripe report run instead of listing them')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write all datasets with typed columns to out/parquet, partitioned by month (requires pyarrow)')
+
+    args = parser.parse_args(argv)
+    if args.parquet and not stripe_datev.parquet.available():
+      raise Exception("--parquet requires pyarrow (pip install pyarrow)")
+
+    year = int(args.year)
+    month = int(args.month)
+
+    fromTime, toTime = self.periodBounds(year, month)
     print("Retrieving data between {} and {} (inclusive, {})".format(fromTime.strftime(
       "%Y-%m-%d"), (toTime - timedelta(0, 1)).strftime("%Y-%m-%d"), stripe_datev.config.accounting_tz))
     thisMonth = fromTime.astimezone(
       stripe_datev.config.accounting_tz).strftime("%Y-%m")
 
-    invoices = list(
-      reversed(list(stripe_datev.invoices.listFinalizedInvoices(fromTime, toTime))))
-    print("Retrieved {} invoice(s), total {} EUR".format(
-      len(invoices), sum([decimal.Decimal(i.total) / 100 for i in invoices])))
+    cache_dir = os.path.join(out_dir, "cache")
+    if not os.path.exists(cache_dir):
+      os.mkdir(cache_dir)
 
-    revenue_items = stripe_datev.invoices.createRevenueItems(invoices)
+    # Stages whose inputs and outputs are unchanged since the last run are skipped
+    stages = stripe_datev.stages.Manifest(os.path.join(
+      cache_dir, "stages-{:04d}-{:02d}.json".format(year, month)), out_dir, force=args.force)
+    download_stages = ["overview", "monthly_recognition", "datev_revenue", "datev_balance", "warnings"]
 
-    balance_transactions = list(reversed(list(stripe_datev.balance.listBalanceTransactions(
-      fromTime, toTime))))
-    charges = stripe_datev.balance.extractCharges(balance_transactions)
-    print("Retrieved {} balance transaction(s), {} charge(s), total {} EUR".format(len(
-      balance_transactions), len(charges), sum([decimal.Decimal(charge.amount) / 100 for charge in charges])))
+    # A closed period is not fetched again if the events since the last fetch
+    # show no change to any of its objects
+    fetch_inputs = stripe_datev.stages.fingerprint([year, month])
+    fetched_at = int(time.time())
+    if not self.snapshotting and not args.parquet and fetched_at >= toTime.timestamp():
+      with stripe_datev.profile.phase("fingerprints"):
+        journal = self.openJournal()
+        unchanged = stages.unchangedSinceFetch(fetch_inputs, download_stages, toTime) and all(
+          journal.hasScope(scope) for scope in stripe_datev.journal.periodScopes("revenue", year, month) +
+          stripe_datev.journal.periodScopes("balance", year, month))
+        journal.close()
+      if unchanged:
+        print("Skipping download, no changes since the last one at {}".format(datetime.fromtimestamp(
+          stages.data("fetch")["fetched_at"], timezone.utc).astimezone(stripe_datev.config.accounting_tz).isoformat()))
+        for stage in download_stages:
+          for path in stages.stages[stage]["outputs"]:
+            self.outputCompleted(os.path.join(out_dir, path))
+        for warning in stages.data("warnings"):
+          print(warning)
+        return
+    stages.forget("fetch")
+
+    with stripe_datev.profile.phase("invoices"):
+      padding_cache_path = os.path.join(cache_dir, "invoices_lookback.json")
+      # A snapshot lists the whole look-back window, so that replaying it
+      # doesn't depend on the state of the cache
+      padding_cache = stripe_datev.invoices.loadPaddingCache(padding_cache_path) if not self.snapshotting else None
+
+      invoices = list(
+        reversed(list(stripe_datev.invoices.listFinalizedInvoices(fromTime, toTime, padding_cache=padding_cache))))
+      if padding_cache is not None:
+        stripe_datev.invoices.savePaddingCache(padding_cache_path, padding_cache)
+      print("Retrieved {} invoice(s), total {} EUR".format(
+        len(invoices), sum([decimal.Decimal(i.total) / 100 for i in invoices])))
+
+    # Objects are processed one at a time, so that failing ones can be quarantined
+    quarantine = stripe_datev.quarantine.Quarantine(enabled=args.quarantine)
+
+    # The customers of the invoices are checked before the balance transactions
+    # are listed, those of the charges with the customers listed with them
+    if not args.no_preflight:
+      with stripe_datev.profile.phase("preflight"):
+        issues = stripe_datev.preflight.check(
+          invoices, [], fill_account_numbers=args.fill_account_numbers, quarantine=quarantine.enabled)
+        invoices = quarantine.apply(
+          "revenue_items", lambda invoice: stripe_datev.preflight.passed(invoice, invoice.customer, issues), invoices)
+
+    with stripe_datev.profile.phase("balance_transactions"):
+      listBalanceTransactions = stripe_datev.reporting.listBalanceTransactions if args.balance_report \
+          else stripe_datev.balance.listBalanceTransactions
+      balance_transactions = list(reversed(list(listBalanceTransactions(fromTime, toTime))))
+      charges = stripe_datev.balance.extractCharges(balance_transactions)
+      print("Retrieved {} balance transaction(s), {} charge(s), total {} EUR".format(len(
+        balance_transactions), len(charges), sum([decimal.Decimal(charge.amount) / 100 for charge in charges])))
+
+    if not args.no_preflight:
+      with stripe_datev.profile.phase("preflight"):
+        issues = stripe_datev.preflight.check(
+          [], charges, fill_account_numbers=args.fill_account_numbers, quarantine=quarantine.enabled)
+        # Direct charges of customers with issues are missing from the revenue, too
+        quarantine.apply("revenue_items", lambda charge: stripe_datev.preflight.passed(charge, charge.customer, issues),
+                         [charge for charge in charges if not stripe_datev.charges.chargeHasInvoice(charge)])
+        balance_transactions = quarantine.apply(
+          "balance", lambda tx: stripe_datev.preflight.passed(
+            tx, tx.source.customer if tx["type"] in ["charge", "payment"] else None, issues), balance_transactions)
+        charges = stripe_datev.balance.extractCharges(balance_transactions)
 
     direct_charges = list(filter(
       lambda charge: not stripe_datev.charges.chargeHasInvoice(charge), charges))
-    revenue_items += stripe_datev.charges.createRevenueItems(direct_charges)
 
-    overview_dir = os.path.join(out_dir, "overview")
-    if not os.path.exists(overview_dir):
-      os.mkdir(overview_dir)
+    with stripe_datev.profile.phase("fingerprints"):
+      invoices_inputs = stripe_datev.stages.fingerprint(invoices)
+      revenue_inputs = stripe_datev.stages.fingerprint(invoices, direct_charges)
+      balance_inputs = stripe_datev.stages.fingerprint(balance_transactions)
+
+    revenue_items = None
+
+    def getRevenueItems():
+      nonlocal revenue_items
+      if revenue_items is None:
+        with stripe_datev.profile.phase("revenue_items"):
+          revenue_items = quarantine.applyFlat(
+            "revenue_items", lambda invoice: stripe_datev.invoices.createRevenueItems([invoice]), invoices)
+        with stripe_datev.profile.phase("charges"):
+          revenue_items += quarantine.applyFlat(
+            "revenue_items", lambda charge: stripe_datev.charges.createRevenueItems([charge]), direct_charges)
+      return revenue_items
 
-    with open(os.path.join(overview_dir, "overview-{:04d}-{:02d}.csv".format(year, month)), "w", encoding="utf-8") as fp:
-      fp.write(stripe_datev.invoices.to_csv(invoices))
-      print("Wrote {} invoices      to {}".format(
-        str(len(invoices)).rjust(4, " "), os.path.relpath(fp.name, os.getcwd())))
+    def recordStage(stage, inputs, outputs, *quarantine_stages):
+      # Stages with quarantined objects are incomplete
+      if not any(len(quarantine.ids(quarantine_stage)) > 0 for quarantine_stage in quarantine_stages):
+        stages.record(stage, inputs, outputs)
 
-    monthly_recognition_dir = os.path.join(out_dir, "monthly_recognition")
-    if not os.path.exists(monthly_recognition_dir):
-      os.mkdir(monthly_recognition_dir)
+    def skipped(stage):
+      print("Skipping {}, inputs unchanged".format(stage))
+      for path in stages.stages[stage]["outputs"]:
+        self.outputCompleted(os.path.join(out_dir, path))
 
-    with open(os.path.join(monthly_recognition_dir, "monthly_recognition-{}.csv".format(thisMonth)), "w", encoding="utf-8") as fp:
-      fp.write(stripe_datev.invoices.to_recognized_month_csv2(revenue_items))
-      print("Wrote {} revenue items to {}".format(
-        str(len(revenue_items)).rjust(4, " "), os.path.relpath(fp.name, os.getcwd())))
+    with stripe_datev.profile.phase("overview"):
+      overview_dir = os.path.join(out_dir, "overview")
+      if not os.path.exists(overview_dir):
+        os.mkdir(overview_dir)
+
+      overview_path = os.path.join(overview_dir, "overview-{:04d}-{:02d}.csv".format(year, month))
+      if quarantine.enabled:
+        getRevenueItems()
+      if len(quarantine.ids("revenue_items")) == 0 and stages.upToDate("overview", invoices_inputs):
+        skipped("overview")
+      else:
+        # Only invoices that can be processed are listed
+        getRevenueItems()
+        with stripe_datev.checkpoint.atomicOpen(overview_path, "w", encoding="utf-8") as fp:
+          stripe_datev.csv.write_csv(fp, stripe_datev.invoices.to_csv_lines(
+            [invoice for invoice in invoices if invoice.id not in quarantine.ids("revenue_items")]))
+        self.outputCompleted(overview_path)
+        recordStage("overview", invoices_inputs, [overview_path], "revenue_items")
+        print("Wrote {} invoices      to {}".format(
+          str(len(invoices)).rjust(4, " "), os.path.relpath(overview_path, os.getcwd())))
+
+    with stripe_datev.profile.phase("monthly_recognition"):
+      monthly_recognition_dir = os.path.join(out_dir, "monthly_recognition")
+      if not os.path.exists(monthly_recognition_dir):
+        os.mkdir(monthly_recognition_dir)
+
+      monthly_recognition_path = os.path.join(
+        monthly_recognition_dir, stripe_datev.pivots.recognitionFileName(year, month))
+      if len(quarantine.ids("revenue_items")) == 0 and stages.upToDate("monthly_recognition", revenue_inputs):
+        skipped("monthly_recognition")
+      else:
+        with stripe_datev.checkpoint.atomicOpen(monthly_recognition_path, "w", encoding="utf-8") as fp:
+          stripe_datev.csv.write_csv(fp, stripe_datev.invoices.to_recognized_month_csv2_lines(getRevenueItems()))
+        self.outputCompleted(monthly_recognition_path)
+        recordStage("monthly_recognition", revenue_inputs, [monthly_recognition_path], "revenue_items")
+        print("Wrote {} revenue items to {}".format(
+          str(len(getRevenueItems())).rjust(4, " "), os.path.relpath(monthly_recognition_path, os.getcwd())))
 
     datevDir = os.path.join(out_dir, 'datev')
     if not os.path.exists(datevDir):
       os.mkdir(datevDir)
 
-    # Datev Revenue
+    # DATEV files are written from the journal
 
-    records = []
-    for revenue_item in revenue_items:
-      records += stripe_datev.invoices.createAccountingRecords(revenue_item)
+    journal = self.openJournal()
+    command = " ".join(["download"] + argv)
+    revenue_scopes = stripe_datev.journal.periodScopes("revenue", year, month)
+    balance_scopes = stripe_datev.journal.periodScopes("balance", year, month)
 
-    records_by_month = {}
-    for record in records:
-      month = record["date"].strftime("%Y-%m")
-      records_by_month[month] = records_by_month.get(month, []) + [record]
+    # Datev Revenue
 
-    for month, records in records_by_month.items():
-      if month == thisMonth:
-        name = "EXTF_{}_Revenue.csv".format(thisMonth)
+    with stripe_datev.profile.phase("datev_revenue"):
+      if len(quarantine.ids("revenue_items")) == 0 and stages.upToDate("datev_revenue", revenue_inputs) \
+          and all(journal.hasScope(scope) for scope in revenue_scopes):
+        skipped("datev_revenue")
       else:
-        name = "EXTF_{}_Revenue_From_{}.csv".format(month, thisMonth)
-      stripe_datev.output.writeRecords(os.path.join(
-        datevDir, name), records, bezeichung="Stripe Revenue {} from {}".format(month, thisMonth))
+        entries = quarantine.applyFlat(
+          "accounting_records",
+          lambda revenue_item: stripe_datev.journal.entries(
+            revenue_item["id"], stripe_datev.invoices.createAccountingRecords(revenue_item)),
+          getRevenueItems(), id=lambda revenue_item: revenue_item["id"])
+        ranges = self.recognitionRanges([revenue_item for revenue_item in getRevenueItems()
+                                         if revenue_item["id"] not in quarantine.ids("accounting_records")])
+        journal.appendPeriod(revenue_scopes, entries, self.revenueScopeOf(getRevenueItems()), command=command,
+                             ranges=ranges)
+
+        written = self.writeRevenueRecords(datevDir, thisMonth, journal.records(scope=revenue_scopes))
+        recordStage("datev_revenue", revenue_inputs, written, "revenue_items", "accounting_records")
 
     # Datev Balance
 
-    balance_records = stripe_datev.balance.createAccountingRecords(
-      balance_transactions)
+    with stripe_datev.profile.phase("datev_balance"):
+      if stages.upToDate("datev_balance", balance_inputs) and all(journal.hasScope(scope) for scope in balance_scopes):
+        skipped("datev_balance")
+      else:
+        entries = quarantine.applyFlat(
+          "balance", lambda tx: stripe_datev.journal.entries(tx.id, stripe_datev.balance.createAccountingRecords([tx])),
+          balance_transactions)
+        journal.appendPeriod(balance_scopes, entries, self.balanceScopeOf(balance_transactions), command=command)
+
+        written = self.writeBalanceRecords(datevDir, thisMonth, journal.records(scope=balance_scopes))
+        recordStage("datev_balance", balance_inputs, written, "balance")
+
+    if args.parquet:
+      with stripe_datev.profile.phase("parquet"):
+        parquetDir = os.path.join(out_dir, "parquet")
+        # Like the journal, files are kept per accounting month of the period, so
+        # that a year replaces the files of its months and vice versa
+        periods = [scope[len("revenue-"):] for scope in revenue_scopes]
 
-    stripe_datev.output.writeRecords(os.path.join(datevDir, "EXTF_{}_Balance.csv".format(
-      thisMonth)), balance_records, bezeichung="Stripe Balance {}".format(thisMonth))
+        def periodOf(date):
+          return min(max(stripe_datev.journal.accountingMonth(date), periods[0]), periods[-1])
+
+        written = {}
+        for period in periods:
+          period_revenue_items = [revenue_item for revenue_item in getRevenueItems()
+                                  if periodOf(revenue_item["created"]) == period]
+          datasets = {
+            "invoices": stripe_datev.parquet.invoiceRows([
+              invoice for invoice in invoices if invoice.id not in quarantine.ids("revenue_items") and periodOf(
+                datetime.fromtimestamp(invoice.status_transitions.finalized_at, timezone.utc)) == period]),
+            "revenue_items": stripe_datev.parquet.revenueItemRows(period_revenue_items),
+            "recognition": stripe_datev.parquet.recognitionRows(period_revenue_items),
+            "accounting_records": stripe_datev.parquet.accountingRecordRows(
+              "revenue", journal.entries(scope="revenue-" + period)) +
+            stripe_datev.parquet.accountingRecordRows("balance", journal.entries(scope="balance-" + period)),
+            "balance_transactions": stripe_datev.parquet.balanceTransactionRows([
+              tx for tx in balance_transactions if periodOf(datetime.fromtimestamp(tx.created, timezone.utc)) == period]),
+          }
+          for dataset, rows in datasets.items():
+            paths = stripe_datev.parquet.writeDataset(parquetDir, dataset, rows, period)
+            written.setdefault(dataset, [0, set()])
+            written[dataset][0] += len(rows)
+            written[dataset][1].update(os.path.dirname(path) for path in paths)
+        for dataset, (rows, partitions) in written.items():
+          print("Wrote {} {} to {} partition(s) in {}".format(
+            str(rows).rjust(4, " "), dataset, len(partitions), os.path.relpath(os.path.join(parquetDir, dataset), os.getcwd())))
+    journal.close()
+
+    if quarantine.enabled:
+      errors_dir = os.path.join(out_dir, "errors")
+      if not os.path.exists(errors_dir):
+        os.mkdir(errors_dir)
+      errors_path = os.path.join(errors_dir, "download-{:04d}-{:02d}.json".format(year, args.month))
+      if len(quarantine.errors) > 0:
+        quarantine.writeReport(errors_path, command="download", year=year, month=args.month)
+        print("Quarantined {} object(s), see {}, then run: reprocess {}".format(
+          len(quarantine.ids()), os.path.relpath(errors_path, os.getcwd()), os.path.relpath(errors_path, os.getcwd())))
+      elif os.path.exists(errors_path):
+        os.remove(errors_path)
 
     # PDF
 
-    pdfDir = os.path.join(out_dir, 'pdf')
-    if not os.path.exists(pdfDir):
-      os.mkdir(pdfDir)
+    with stripe_datev.profile.phase("pdf"):
+      pdfDir = os.path.join(out_dir, 'pdf')
+      if not os.path.exists(pdfDir):
+        os.mkdir(pdfDir)
 
-    for invoice in invoices:
-      pdfLink = invoice.invoice_pdf
-      finalized_date = datetime.fromtimestamp(
-        invoice.status_transitions.finalized_at, timezone.utc).astimezone(stripe_datev.config.accounting_tz)
-      invNo = invoice.number
-
-      fileName = "{} {}.pdf".format(finalized_date.strftime("%Y-%m-%d"), invNo)
-      filePath = os.path.join(pdfDir, fileName)
-      if os.path.exists(filePath):
-        # print("{} exists, skipping".format(filePath))
-        continue
+      downloads = []
+      for invoice in invoices:
+        pdfLink = invoice.invoice_pdf
+        finalized_date = datetime.fromtimestamp(
+          invoice.status_transitions.finalized_at, timezone.utc).astimezone(stripe_datev.config.accounting_tz)
+        invNo = invoice.number
 
-      if not pdfLink:
-        continue
-      print("Downloading {} to {}".format(pdfLink, filePath))
-      r = requests.get(pdfLink)
-      if r.status_code != 200:
-        print("HTTP status {}".format(r.status_code))
-        continue
-      with open(filePath, "wb") as fp:
-        fp.write(r.content)
-
-    for charge in charges + list(map(lambda tx: tx["source"]["destination_payment"], filter(lambda tx: tx["type"] == "transfer", balance_transactions))):
-      fileName = "{} {}.html".format(datetime.fromtimestamp(
-        charge.created, timezone.utc).strftime("%Y-%m-%d"), charge.receipt_number or charge.id)
-      filePath = os.path.join(pdfDir, fileName)
-      if os.path.exists(filePath):
-        # print("{} exists, skipping".format(filePath))
-        continue
+        fileName = "{} {}.pdf".format(finalized_date.strftime("%Y-%m-%d"), invNo)
+        filePath = os.path.join(pdfDir, fileName)
+        if os.path.exists(filePath):
+          # print("{} exists, skipping".format(filePath))
+          continue
 
-      pdfLink = charge["receipt_url"]
-      if not pdfLink:
-        continue
-      print("Downloading {} to {}".format(pdfLink, filePath))
-      r = requests.get(pdfLink)
-      if r.status_code != 200:
-        print("HTTP status {}".format(r.status_code))
-        continue
-      with open(filePath, "wb") as fp:
-        fp.write(r.content)
+        if not pdfLink:
+          continue
+        downloads.append((pdfLink, filePath))
+
+      for charge in charges + list(map(lambda tx: tx["source"]["destination_payment"], filter(lambda tx: tx["type"] == "transfer", balance_transactions))):
+        fileName = "{} {}.html".format(datetime.fromtimestamp(
+          charge.created, timezone.utc).strftime("%Y-%m-%d"), charge.receipt_number or charge.id)
+        filePath = os.path.join(pdfDir, fileName)
+        if os.path.exists(filePath):
+          # print("{} exists, skipping".format(filePath))
+          continue
+
+        pdfLink = charge["receipt_url"]
+        if not pdfLink:
+          continue
+        downloads.append((pdfLink, filePath))
+
+      stripe_datev.client.map(lambda download: self.downloadFile(*download), downloads)
 
     # Warnings about changes to earlier invoices
 
+    with stripe_datev.profile.phase("warnings"):
+      # Once the period is over, invoices can no longer change their status
+      # and credit notes can no longer be created within it
+      warnings_inputs = stripe_datev.stages.fingerprint([int(fromTime.timestamp()), int(toTime.timestamp())])
+      if stages.upToDate("warnings", warnings_inputs):
+        print("Skipping scan for changes to earlier invoices, the period was scanned after its end")
+        warnings = stages.data("warnings")
+      else:
+        scanned_at = datetime.now(timezone.utc)
+        warnings = self.earlierInvoiceWarnings(fromTime, toTime)
+        if scanned_at >= toTime:
+          stages.record("warnings", warnings_inputs, [], data=warnings)
+      for warning in warnings:
+        print(warning)
+
+    if len(quarantine.errors) == 0 and all(stage in stages.stages for stage in download_stages):
+      stages.record("fetch", fetch_inputs, [], data={"fetched_at": fetched_at})
+
+  def earlierInvoiceWarnings(self, fromTime, toTime):
+    """
+    Warnings about invoices of the 24 months before fromTime that were voided,
+    marked uncollectible or credited in [fromTime, toTime).
+    """
+    warnings = []
     for status in ["uncollectible", "void"]:
       for invoice in stripe.Invoice.list(
           created={
@@ -208,7 +556,7 @@ class StripeDatevCli(object):
               invoice.status_transitions.marked_uncollectible_at, timezone.utc) >= fromTime and datetime.fromtimestamp(
               invoice.status_transitions.marked_uncollectible_at, timezone.utc) < toTime
           ):
-          print("Warning: found earlier invoice {} changed status to {} in this month, consider downloading {} again".format(invoice.id, status, datetime.fromtimestamp(
+          warnings.append("Warning: found earlier invoice {} changed status to {} in this month, consider downloading {} again".format(invoice.id, status, datetime.fromtimestamp(
               invoice.status_transitions.finalized_at, timezone.utc).astimezone(stripe_datev.config.accounting_tz).strftime("%Y-%m")))
 
     for creditNote in stripe.CreditNote.list(
@@ -221,20 +569,346 @@ class StripeDatevCli(object):
       invoiceFinalized = datetime.fromtimestamp(
         creditNote.invoice.status_transitions.finalized_at, timezone.utc).astimezone(stripe_datev.config.accounting_tz)
       if invoiceFinalized < fromTime:
-        print("Warning: found credit note {} for earlier invoice, consider downloading {} again".format(
+        warnings.append("Warning: found credit note {} for earlier invoice, consider downloading {} again".format(
           creditNote.number, invoiceFinalized.strftime("%Y-%m")))
+    return warnings
+
+  def openJournal(self):
+    if not os.path.exists(out_dir):
+      os.makedirs(out_dir)
+    return stripe_datev.journal.Journal(os.path.join(out_dir, "journal.sqlite"))
+
+  def revenueScopeOf(self, revenue_items):
+    """
+    Journal scope of the accounting month in which a revenue item was booked,
+    by its ID.
+    """
+    months = {revenue_item["id"]: stripe_datev.journal.accountingMonth(revenue_item["created"])
+              for revenue_item in revenue_items}
+    return lambda id: "revenue-" + months[id]
+
+  def balanceScopeOf(self, balance_transactions):
+    months = {tx.id: stripe_datev.journal.accountingMonth(datetime.fromtimestamp(tx.created, timezone.utc))
+              for tx in balance_transactions}
+    return lambda id: "balance-" + months[id]
+
+  def recognitionRanges(self, revenue_items):
+    return [(revenue_item["id"],) + recognition_range for revenue_item in revenue_items
+            for recognition_range in stripe_datev.invoices.recognitionRanges(revenue_item)]
+
+  def writeRevenueRecords(self, datevDir, thisMonth, records):
+    """
+    Writes the revenue records of a period into one file per month, returns
+    the paths written.
+    """
+    records_by_month = {}
+    for record in records:
+      records_by_month.setdefault(record["date"].strftime("%Y-%m"), []).append(record)
+
+    written = []
+    for month, month_records in records_by_month.items():
+      if month == thisMonth:
+        name = "EXTF_{}_Revenue.csv".format(thisMonth)
+      else:
+        name = "EXTF_{}_Revenue_From_{}.csv".format(month, thisMonth)
+      stripe_datev.output.writeRecords(os.path.join(
+        datevDir, name), month_records, bezeichung="Stripe Revenue {} from {}".format(month, thisMonth))
+      self.outputCompleted(os.path.join(datevDir, name))
+      written.append(os.path.join(datevDir, name))
+    return written
+
+  def writeBalanceRecords(self, datevDir, thisMonth, records):
+    balance_path = os.path.join(datevDir, "EXTF_{}_Balance.csv".format(thisMonth))
+    stripe_datev.output.writeRecords(balance_path, records, bezeichung="Stripe Balance {}".format(thisMonth))
+    self.outputCompleted(balance_path)
+    return [balance_path]
+
+  def appendCsvRows(self, path, csv_text):
+    """
+    Adds the rows of csv_text (without its header) to an existing CSV file.
+    """
+    rows = csv_text.split("\n")[1:]
+    if len(rows) == 0:
+      return
+    if os.path.exists(path):
+      with open(path, "r", encoding="utf-8") as fp:
+        csv_text = fp.read() + "\n" + "\n".join(rows)
+    with stripe_datev.checkpoint.atomicOpen(path, "w", encoding="utf-8") as fp:
+      fp.write(csv_text)
+    self.outputCompleted(path)
+    print("Added {} row(s) to {}".format(len(rows), os.path.relpath(path, os.getcwd())))
+
+  def reprocess(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py reprocess")
+    parser.add_argument('report', type=str, help='error report written by download --quarantine')
+    args = parser.parse_args(argv)
+
+    report = stripe_datev.quarantine.readReport(args.report)
+    year, month = report["year"], report["month"]
+    fromTime, toTime = self.periodBounds(year, month)
+    thisMonth = fromTime.strftime("%Y-%m")
+    ids_by_stage = {}
+    for error in report["errors"]:
+      ids_by_stage.setdefault(error["stage"], [])
+      if error["id"] not in ids_by_stage[error["stage"]]:
+        ids_by_stage[error["stage"]].append(error["id"])
+    print("Reprocessing {} quarantined object(s) of {}".format(
+      sum(len(ids) for ids in ids_by_stage.values()), thisMonth if month > 0 else year))
+
+    quarantine = stripe_datev.quarantine.Quarantine(enabled=True)
+
+    def createRevenueItems(id):
+      if id.startswith("in_"):
+        return stripe_datev.invoices.createRevenueItems([stripe_datev.invoices.retrieveInvoice(id)])
+      return stripe_datev.charges.createRevenueItems([stripe_datev.projections.charge(stripe.Charge.retrieve(id))])
+
+    # Objects that are missing from all outputs
+    revenue_ids = ids_by_stage.get("revenue_items", [])
+    revenue_items = quarantine.applyFlat("revenue_items", createRevenueItems, revenue_ids, id=lambda id: id)
+    invoices = [stripe_datev.invoices.retrieveInvoice(id) for id in revenue_ids
+                if id.startswith("in_") and id not in quarantine.ids()]
+
+    self.appendCsvRows(os.path.join(out_dir, "overview", "overview-{:04d}-{:02d}.csv".format(year, month)),
+                       stripe_datev.invoices.to_csv(invoices))
+    self.appendCsvRows(os.path.join(out_dir, "monthly_recognition", stripe_datev.pivots.recognitionFileName(year, month)),
+                       stripe_datev.invoices.to_recognized_month_csv2(revenue_items))
+
+    # Objects that are only missing from the DATEV revenue records
+    record_items = revenue_items + quarantine.applyFlat(
+      "accounting_records", createRevenueItems, ids_by_stage.get("accounting_records", []), id=lambda id: id)
+    records = quarantine.applyFlat(
+      "accounting_records",
+      lambda revenue_item: stripe_datev.journal.entries(
+        revenue_item["id"], stripe_datev.invoices.createAccountingRecords(revenue_item)),
+      record_items, id=lambda revenue_item: revenue_item["id"])
+
+    datevDir = os.path.join(out_dir, 'datev')
+    journal = self.openJournal()
+    command = " ".join(["reprocess"] + argv)
+    revenue_scopes = stripe_datev.journal.periodScopes("revenue", year, month)
+    balance_scopes = stripe_datev.journal.periodScopes("balance", year, month)
+
+    if len(records) > 0 and journal.hasScope(revenue_scopes):
+      journal.appendPeriod(revenue_scopes, records, self.revenueScopeOf(record_items), command=command,
+                           ranges=self.recognitionRanges(
+                             [revenue_item for revenue_item in record_items if revenue_item["id"] not in quarantine.ids()]),
+                           amend=True)
+      self.writeRevenueRecords(datevDir, thisMonth, journal.records(scope=revenue_scopes))
+    elif len(records) > 0:
+      # Downloaded before there was a journal
+      records_by_month = {}
+      for _, record in records:
+        records_by_month.setdefault(record["date"].strftime("%Y-%m"), []).append(record)
+      for record_month, month_records in records_by_month.items():
+        if record_month == thisMonth:
+          name = "EXTF_{}_Revenue.csv".format(thisMonth)
+        else:
+          name = "EXTF_{}_Revenue_From_{}.csv".format(record_month, thisMonth)
+        stripe_datev.output.mergeRecords(os.path.join(datevDir, name), month_records,
+                                         bezeichung="Stripe Revenue {} from {}".format(record_month, thisMonth))
+        self.outputCompleted(os.path.join(datevDir, name))
+
+    balance_transactions = quarantine.applyFlat(
+      "balance", lambda id: [stripe_datev.balance.retrieveBalanceTransaction(id)], ids_by_stage.get("balance", []),
+      id=lambda id: id)
+    balance_records = quarantine.applyFlat(
+      "balance", lambda tx: stripe_datev.journal.entries(tx.id, stripe_datev.balance.createAccountingRecords([tx])),
+      balance_transactions)
+    if len(balance_records) > 0 and journal.hasScope(balance_scopes):
+      journal.appendPeriod(balance_scopes, balance_records, self.balanceScopeOf(balance_transactions), command=command,
+                           amend=True)
+      self.writeBalanceRecords(datevDir, thisMonth, journal.records(scope=balance_scopes))
+    elif len(balance_records) > 0:
+      balance_path = os.path.join(datevDir, "EXTF_{}_Balance.csv".format(thisMonth))
+      stripe_datev.output.mergeRecords(balance_path, [record for _, record in balance_records],
+                                       bezeichung="Stripe Balance {}".format(thisMonth))
+      self.outputCompleted(balance_path)
+    journal.close()
+
+    # Only what still fails remains in the report
+    if len(quarantine.errors) > 0:
+      quarantine.writeReport(args.report, command=report["command"], year=year, month=month)
+      print("{} object(s) still failing, see {}".format(len(quarantine.ids()), args.report))
+    else:
+      os.remove(args.report)
+      print("All quarantined objects processed")
+
+  def journal(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py journal")
+    actions = parser.add_subparsers(dest="action", required=True)
+    query = actions.add_parser("query", help="print the current accounting records matching all filters as CSV")
+    query.add_argument('--month', type=str, metavar='YYYY-MM', help='accounting month')
+    query.add_argument('--konto', type=str)
+    query.add_argument('--gegenkonto', type=str)
+    query.add_argument('--beleg', type=str, help='Belegfeld 1, e.g. an invoice number')
+    query.add_argument('--source', type=str, help='ID of the Stripe object the records stem from')
+    export = actions.add_parser("export", help="write the DATEV files of a download period from the journal")
+    export.add_argument('year', type=int)
+    export.add_argument('month', type=int)
+    args = parser.parse_args(argv)
+
+    journal = self.openJournal()
+    if args.action == "query":
+      lines = [["run_id", "scope", "source", "date", "Konto", "Gegenkonto", "BU-Schlüssel", "Umsatz",
+                "Soll/Haben", "Belegfeld 1", "Buchungstext"]]
+      for run_id, scope, source, date, fields in journal.query(month=args.month, konto=args.konto,
+                                                               gegenkonto=args.gegenkonto,
+                                                               belegfeld1=args.beleg, source=args.source):
+        record = json.loads(fields)
+        lines.append([str(run_id), scope, source, date, record.get("Konto"),
+                      record.get("Gegenkonto (ohne BU-Schlüssel)"), record.get("BU-Schlüssel"),
+                      record.get("Umsatz (ohne Soll/Haben-Kz)"), record.get("Soll/Haben-Kennzeichen"),
+                      record.get("Belegfeld 1"), record.get("Buchungstext")])
+      print(stripe_datev.csv.lines_to_csv(lines))
+
+    elif args.action == "export":
+      fromTime, _ = self.periodBounds(args.year, args.month)
+      thisMonth = fromTime.astimezone(stripe_datev.config.accounting_tz).strftime("%Y-%m")
+      revenue_scopes = stripe_datev.journal.periodScopes("revenue", args.year, args.month)
+      balance_scopes = stripe_datev.journal.periodScopes("balance", args.year, args.month)
+      if not journal.hasScope(revenue_scopes) and not journal.hasScope(balance_scopes):
+        raise Exception("No records of {:04d}-{:02d} in the journal, run download first".format(args.year, args.month))
+
+      datevDir = os.path.join(out_dir, 'datev')
+      if not os.path.exists(datevDir):
+        os.mkdir(datevDir)
+      self.writeRevenueRecords(datevDir, thisMonth, journal.records(scope=revenue_scopes))
+      self.writeBalanceRecords(datevDir, thisMonth, journal.records(scope=balance_scopes))
+    journal.close()
+
+  def balances(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py balances")
+    parser.add_argument('accounts', type=str, nargs='*', help='accounts to show (default: all)')
+    parser.add_argument('--from', dest='from_month', type=str, metavar='YYYY-MM', help='first month to show')
+    parser.add_argument('--to', dest='to_month', type=str, metavar='YYYY-MM', help='last month to show')
+    args = parser.parse_args(argv)
+
+    journal = self.openJournal()
+    totals = journal.monthlyTotals(accounts=args.accounts)
+    journal.close()
+
+    def amount(cents):
+      return format(decimal.Decimal(cents) / 100, ",.2f").rjust(14, " ")
+
+    print("Konto       Monat            Soll          Haben          Saldo")
+    last_account = None
+    for account, month, debit, credit in totals:
+      if account != last_account:
+        # Balances include all months before --from
+        balance = 0
+        last_account = account
+      balance += debit - credit
+      if (args.from_month and month < args.from_month) or (args.to_month and month > args.to_month):
+        continue
+      print(account.ljust(11, " "), month.ljust(7, " "), amount(debit), amount(credit), amount(balance))
+
+  def deferred(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py deferred")
+    parser.add_argument('--as-of', type=str, metavar='YYYY-MM-DD',
+                        help='show the revenue deferred as of the end of this date (default: today)')
+    args = parser.parse_args(argv)
+
+    day = datetime.strptime(args.as_of, "%Y-%m-%d") if args.as_of else datetime.combine(datetime.now().date(), datetime.min.time())
+    asOf = stripe_datev.config.accounting_tz.localize(day + timedelta(days=1) - timedelta(seconds=1))
+
+    journal = self.openJournal()
+    ranges = journal.recognitionRanges()
+    journal.close()
+    if len(ranges) == 0:
+      raise Exception("No recognition ranges in the journal, run download first")
+
+    schedule = stripe_datev.deferred.DeferredRevenue(ranges).schedule(asOf)
+
+    print("Deferred revenue (pRAP) as of", asOf.date())
+    print("Monat          Auflösung")
+    for month_start, amount in schedule.items():
+      print(month_start.strftime("%Y-%m"), format(amount, ",.2f").rjust(16, " "))
+    print("TOTAL  ", format(sum(schedule.values(), decimal.Decimal(0)), ",.2f").rjust(16, " "))
+
+  def pivots(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py pivots")
+    parser.add_argument('years', type=int, nargs='+', help='years of downloaded monthly recognition files')
+    parser.add_argument('--report', type=str, choices=list(stripe_datev.pivots.reports.keys()), default='mrr',
+                        help='pivot table to print as CSV (default: mrr)')
+    args = parser.parse_args(argv)
+
+    paths = stripe_datev.pivots.recognitionFiles(out_dir, args.years)
+    if len(paths) == 0:
+      raise Exception("No monthly recognition files of {} in {}, run download first".format(
+        ", ".join(map(str, args.years)), os.path.join(out_dir, "monthly_recognition")))
+
+    columns = stripe_datev.pivots.readColumns(paths)
+    rows, _, _ = stripe_datev.pivots.reports[args.report]
+    print(stripe_datev.csv.lines_to_csv(stripe_datev.pivots.toLines(
+      rows, *stripe_datev.pivots.report(columns, args.report))))
 
   def validate_customers(self, argv):
-    stripe_datev.customer.validate_customers()
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py validate_customers")
+    parser.add_argument('--full', action='store_true',
+                        help='validate all customers, not only those created or changed since the last run')
+    parser.add_argument('--slices', type=int, help='number of time slices to list customers in parallel')
+    args = parser.parse_args(argv)
+
+    cache_dir = os.path.join(out_dir, "cache")
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    validation_dir = os.path.join(out_dir, "validation")
+    if not os.path.exists(validation_dir):
+      os.makedirs(validation_dir)
+    report_path = os.path.join(validation_dir, "customers.json")
+    stripe_datev.validation.validate(os.path.join(cache_dir, "customer_validation.json"), report_path,
+                                     full=args.full, slices=args.slices)
+    print("Wrote report to {}".format(os.path.relpath(report_path, os.getcwd())))
 
   def fill_account_numbers(self, argv):
-    stripe_datev.customer.fill_account_numbers()
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py fill_account_numbers")
+    parser.add_argument('--bulk', action='store_true',
+                        help='number all customers without account number, not only those created after the newest numbered one')
+    args = parser.parse_args(argv)
+
+    # The plan and journal of the assignments are always kept, so that an
+    # interrupted run can be continued with --resume
+    run_dir = self.checkpoint.dir if self.checkpoint is not None else \
+      os.path.join(out_dir, "runs", stripe_datev.checkpoint.runName("fill_account_numbers", argv))
+    stripe_datev.customer.fill_account_numbers(run_dir, bulk=args.bulk, resume=self.resume)
 
   def list_accounts(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py list_accounts")
+    parser.add_argument('file', type=str, nargs='?', help='output file (default: stdout)')
+    parser.add_argument('--since', type=str, metavar='YYYY-MM-DD', help='only customers created on or after the date')
+    parser.add_argument('--delta', action='store_true',
+                        help='only customers that are new or changed since the last export to a file')
+    args = parser.parse_args(argv)
+
+    since = None
+    if args.since is not None:
+      since = stripe_datev.config.accounting_tz.localize(datetime.strptime(args.since, "%Y-%m-%d"))
+
+    cache_dir = os.path.join(out_dir, "cache")
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
     stripe_datev.customer.list_account_numbers(
-      argv[0] if len(argv) > 0 else None)
+      args.file, since=since, manifest_path=os.path.join(cache_dir, "accounts_manifest.json"), delta=args.delta)
 
   def opos(self, argv):
+    parser = argparse.ArgumentParser(prog="stripe-datev-cli.py opos")
+    parser.add_argument('date', type=int, nargs='*', help='year, month and day to list unpaid invoices as of')
+    parser.add_argument('--month-ends', type=int, metavar='YEAR',
+                        help='show open totals and aging as of the end of each month of the year')
+    parser.add_argument('--dates', type=str, nargs='+', metavar='YYYY-MM-DD',
+                        help='show open totals and aging as of the end of each of the dates')
+
+    args = parser.parse_args(argv)
+
+    if args.month_ends is not None or args.dates is not None:
+      if args.month_ends is not None:
+        days = [datetime(args.month_ends, month, 1) + datedelta.MONTH - timedelta(days=1) for month in range(1, 13)]
+      else:
+        days = [datetime.strptime(date, "%Y-%m-%d") for date in args.dates]
+      return self.oposAging([stripe_datev.config.accounting_tz.localize(day + timedelta(days=1) - timedelta(seconds=1))
+                             for day in days])
+
+    argv = args.date
     if len(argv) > 0:
       ref = datetime(*list(map(int, argv))) + \
           timedelta(days=1) - timedelta(seconds=1)
@@ -282,6 +956,25 @@ class StripeDatevCli(object):
     total = reduce(lambda x, y: x + y, totals, decimal.Decimal(0))
     print("TOTAL        ", format(total, ",.2f").rjust(10, " "), "EUR")
 
+  def oposAging(self, refs):
+    refs = sorted(refs)
+    print("Unpaid invoices as of", ", ".join(str(ref.date()) for ref in refs))
+
+    # One listing for all dates, the sweep only keeps the invoices' lifecycle
+    # events. Each date counts the invoices created in the year before it,
+    # like a single date does.
+    events = stripe_datev.opos.invoiceEvents(stripe_datev.opos.listInvoices(refs[0] - datedelta.YEAR, refs[-1]),
+                                             window=datedelta.YEAR)
+    results = stripe_datev.opos.sweep(events, refs)
+
+    columns = ["Open", "Count"] + stripe_datev.opos.bucketNames()
+    print("Date      ", " ".join(column.rjust(14) for column in columns))
+    for result in results:
+      amounts = [result["total"]] + result["aging"]
+      cells = [format(decimal.Decimal(amount) / 100, ",.2f") for amount in amounts]
+      cells.insert(1, str(result["count"]))
+      print(result["date"].date(), " ".join(cell.rjust(14) for cell in cells))
+
   def fees(self, argv):
     parser = argparse.ArgumentParser(prog="stripe-datev-cli.py fees")
     parser.add_argument('year', type=int, help='year to download data for')
@@ -329,18 +1022,14 @@ class StripeDatevCli(object):
       for revenue_item in revenue_items:
         records += stripe_datev.invoices.createAccountingRecords(revenue_item)
     elif object_id.startswith("ch_"):
-      charge = stripe.Charge.retrieve(object_id)
+      charge = stripe_datev.projections.charge(stripe.Charge.retrieve(object_id))
       print("Previewing accounting records for charge {}".format(object_id))
       revenue_items = stripe_datev.charges.createRevenueItems([charge])
       records = []
       for revenue_item in revenue_items:
         records += stripe_datev.invoices.createAccountingRecords(revenue_item)
     elif object_id.startswith("txn_"):
-      balance_transaction = stripe.BalanceTransaction.retrieve(object_id, expand=["source", "source.customer",
-              "source.customer.tax_ids", "source.invoice", "source.charge",
-              "source.charge.customer", "source.charge.invoice",
-              "source.source_transaction", "source.source_transaction.invoice",
-              "source.destination", "source.destination_payment"])
+      balance_transaction = stripe_datev.balance.retrieveBalanceTransaction(object_id)
       print("Previewing accounting records for balance transaction {}".format(object_id))
       records = stripe_datev.balance.createAccountingRecords([balance_transaction])
     else:
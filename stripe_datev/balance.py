@@ -1,21 +1,28 @@
 import stripe
 import decimal
 from datetime import datetime, timezone
-from . import customer, output, config
+from . import customer, output, config, projections
+
+
+balance_transaction_expand = ["source", "source.customer",
+                              "source.customer.tax_ids", "source.invoice", "source.charge",
+                              "source.charge.customer", "source.charge.invoice",
+                              "source.source_transaction", "source.source_transaction.invoice",
+                              "source.destination", "source.destination_payment"]
 
 
 def listBalanceTransactions(fromTime, toTime):
-  return stripe.BalanceTransaction.list(
+  return map(projections.balanceTransaction, stripe.BalanceTransaction.list(
     created={
         "lt": int(toTime.timestamp()),
         "gte": int(fromTime.timestamp()),
       },
-      expand=["data.source", "data.source.customer",
-              "data.source.customer.tax_ids", "data.source.invoice", "data.source.charge",
-              "data.source.charge.customer", "data.source.charge.invoice",
-              "data.source.source_transaction", "data.source.source_transaction.invoice",
-              "data.source.destination", "data.source.destination_payment"]
-  ).auto_paging_iter()
+      expand=["data." + path for path in balance_transaction_expand]
+  ).auto_paging_iter())
+
+
+def retrieveBalanceTransaction(id):
+  return projections.balanceTransaction(stripe.BalanceTransaction.retrieve(id, expand=balance_transaction_expand))
 
 
 def createAccountingRecords(balance_transactions):
@@ -38,7 +45,7 @@ def createAccountingRecords(balance_transactions):
 
       records.append({
         "date": created,
-        "Umsatz (ohne Soll/Haben-Kz)": output.formatDecimal(abs(amount)),
+        "Umsatz (ohne Soll/Haben-Kz)": output.formatCents(abs(tx.amount)),
         "Soll/Haben-Kennzeichen": "S" if amount >= 0 else "H",
         "WKZ Umsatz": "EUR",
         "Konto": str(config.accounts["bank"]),
@@ -50,7 +57,7 @@ def createAccountingRecords(balance_transactions):
 
       records.append({
         "date": created,
-        "Umsatz (ohne Soll/Haben-Kz)": output.formatDecimal(abs(fee)),
+        "Umsatz (ohne Soll/Haben-Kz)": output.formatCents(abs(tx.fee)),
         "Soll/Haben-Kennzeichen": "S" if fee >= 0 else "H",
         "WKZ Umsatz": "EUR",
         "Konto": str(config.accounts["stripe_fees"]),
@@ -114,7 +121,7 @@ def createAccountingRecords(balance_transactions):
 
       records.append({
         "date": created,
-        "Umsatz (ohne Soll/Haben-Kz)": output.formatDecimal(decimal.Decimal(net_amount) / 100),
+        "Umsatz (ohne Soll/Haben-Kz)": output.formatCents(net_amount),
         "Soll/Haben-Kennzeichen": "S",
         "WKZ Umsatz": "EUR",
         "Konto": str(config.accounts["external_services"]),
@@ -125,7 +132,7 @@ def createAccountingRecords(balance_transactions):
 
       records.append({
         "date": created,
-        "Umsatz (ohne Soll/Haben-Kz)": output.formatDecimal(decimal.Decimal(net_amount) / 100),
+        "Umsatz (ohne Soll/Haben-Kz)": output.formatCents(net_amount),
         "Soll/Haben-Kennzeichen": "S",
         "WKZ Umsatz": "EUR",
         "Konto": transfer["destination"]["metadata"]["accountNumber"],
@@ -1,7 +1,7 @@
 import stripe
 import decimal
 from datetime import datetime, timezone
-from . import customer, dateparser, output, config, invoices
+from . import customer, dateparser, output, config, invoices, profile
 
 
 def chargeHasInvoice(charge):
@@ -13,7 +13,9 @@ checkoutSessionsByPaymentIntent = {}
 
 def getCheckoutSessionViaPaymentIntentCached(id):
   if id in checkoutSessionsByPaymentIntent:
+    profile.countCache("checkout_sessions", True)
     return checkoutSessionsByPaymentIntent[id]
+  profile.countCache("checkout_sessions", False)
   sessions = stripe.checkout.Session.list(
     payment_intent=id, expand=["data.line_items"]).data
   if len(sessions) > 0:
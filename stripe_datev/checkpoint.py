@@ -0,0 +1,119 @@
+import contextlib
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+from datetime import datetime
+
+from requests.structures import CaseInsensitiveDict
+
+from . import httpclient, snapshot
+
+
+def runName(command, argv):
+  return re.sub(r"[^0-9A-Za-z_.-]+", "_", "-".join([command] + list(argv)))
+
+
+@contextlib.contextmanager
+def atomicOpen(path, mode="w", **kwargs):
+  """
+  Opens a temporary file that replaces path only once it is completely
+  written, so that an interrupted run never leaves partial output behind.
+  """
+  part_path = path + ".part"
+  with open(part_path, mode, **kwargs) as fp:
+    yield fp
+  os.replace(part_path, path)
+
+
+class CheckpointHTTPClient(snapshot.RecordingHTTPClient):
+  """
+  Persists every final response (after retries) to the run's request log and
+  answers requests found in the log of an earlier attempt from there. List
+  requests are keyed by their cursor, so pagination continues where the
+  earlier attempt stopped.
+  """
+
+  def __init__(self, inner, path, responses):
+    super().__init__(inner, path)
+    self.responses = responses
+    self.served = {}
+    self.replayed = 0
+
+  def request_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, *, _usage=None):
+    key = snapshot.requestKey(method, url, post_data)
+    entries = self.responses.get(key, None)
+    if entries:
+      idx = self.served.get(key, 0)
+      self.served[key] = idx + 1
+      self.replayed += 1
+      entry = entries[min(idx, len(entries) - 1)]
+      return entry["body"], entry["status"], CaseInsensitiveDict(entry["headers"])
+
+    content, status, rheaders = self.inner.request_with_retries(
+      method, url, headers, post_data, max_network_retries)
+    if snapshot.durable(status):
+      self.record(method, url, post_data, content, status, rheaders)
+    return content, status, rheaders
+
+
+class Run(object):
+  """
+  Run directory with the request log and state of one command invocation,
+  out/runs/<command>-<args>. The request log is removed once the run
+  completed, state.json lists the output files that were written.
+  """
+
+  def __init__(self, runs_dir, command, argv, resume=False):
+    self.dir = os.path.join(runs_dir, runName(command, argv))
+    self.requests_path = os.path.join(self.dir, "requests.jsonl.gz")
+    self.state_path = os.path.join(self.dir, "state.json")
+    self.client = None
+    self.lock = threading.Lock()
+
+    if not resume and os.path.exists(self.dir):
+      shutil.rmtree(self.dir)
+    if not os.path.exists(self.dir):
+      os.makedirs(self.dir)
+
+    self.state = {"argv": [command] + list(argv), "completed": False, "outputs": []}
+    if resume and os.path.exists(self.state_path):
+      with open(self.state_path, "r", encoding="utf-8") as fp:
+        self.state = json.load(fp)
+
+  def install(self):
+    responses = {}
+    if os.path.exists(self.requests_path):
+      responses = snapshot.readSnapshot(self.requests_path)
+      # Rewrite what could be read, an interrupted gzip stream cannot be appended to
+      with atomicOpen(self.requests_path, "wb") as raw:
+        with gzip.open(raw, "wt", encoding="utf-8") as fp:
+          for entries in responses.values():
+            for entry in entries:
+              fp.write(json.dumps(entry) + "\n")
+    self.client = httpclient.install(lambda inner: CheckpointHTTPClient(inner, self.requests_path, responses))
+    return sum(len(entries) for entries in responses.values())
+
+  def output(self, path):
+    """
+    Records a completed output file.
+    """
+    with self.lock:
+      if path not in self.state["outputs"]:
+        self.state["outputs"].append(path)
+      self.save()
+
+  def save(self):
+    self.state["updated"] = datetime.now().isoformat()
+    with atomicOpen(self.state_path, "w", encoding="utf-8") as fp:
+      json.dump(self.state, fp, indent=2)
+
+  def complete(self):
+    self.state["completed"] = True
+    self.save()
+    if self.client is not None:
+      self.client.fp.close()
+    if os.path.exists(self.requests_path):
+      os.remove(self.requests_path)
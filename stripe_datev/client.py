@@ -0,0 +1,165 @@
+import concurrent.futures
+import random
+import threading
+import time
+import uuid
+
+import stripe
+
+from . import config, httpclient
+
+
+def maxRequestsPerSecond():
+  return config.stripe.get("max_requests_per_second", 20)
+
+
+def maxConcurrency():
+  return config.stripe.get("max_concurrency", 8)
+
+
+def maxRetries():
+  return config.stripe.get("max_retries", 5)
+
+
+class TokenBucket(object):
+  """
+  Allows `rate` requests per second on average and bursts of up to `burst`.
+  """
+
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst if burst is not None else max(1, rate)
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class AdaptiveLimit(object):
+  """
+  Number of requests allowed in flight, adjusted AIMD-style: grows by about
+  one per window of successful requests while latency stays near the best
+  observed latency, and halves (at most once per second) on rate limiting.
+  """
+
+  def __init__(self, maximum, initial=None, minimum=1, latency_factor=3):
+    self.maximum = maximum
+    self.minimum = minimum
+    self.limit = float(initial if initial is not None else min(maximum, 4))
+    self.latency_factor = latency_factor
+    self.best_latency = None
+    self.in_flight = 0
+    self.decreased_at = 0
+    self.throttled = 0
+    self.condition = threading.Condition()
+
+  def acquire(self):
+    with self.condition:
+      while self.in_flight >= int(self.limit):
+        self.condition.wait()
+      self.in_flight += 1
+
+  def release(self, latency, throttled=False):
+    with self.condition:
+      self.in_flight -= 1
+      if throttled:
+        self.throttled += 1
+        now = time.monotonic()
+        if now - self.decreased_at >= 1:
+          self.limit = max(self.minimum, self.limit / 2)
+          self.decreased_at = now
+      elif latency is not None:
+        if self.best_latency is None or latency < self.best_latency:
+          self.best_latency = latency
+        if latency <= self.best_latency * self.latency_factor:
+          self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      self.condition.notify_all()
+
+
+def backoffSeconds(attempt, retry_after=None, initial_delay=0.5, max_delay=20):
+  """
+  Exponential backoff with jitter in [delay / 2, delay], but not less than
+  a reasonable Retry-After.
+  """
+  delay = min(max_delay, initial_delay * 2 ** (attempt - 1))
+  delay = delay * (0.5 + random.random() / 2)
+  if retry_after is not None and retry_after <= 60:
+    delay = max(delay, retry_after)
+  return delay
+
+
+class RateLimitedHTTPClient(httpclient.WrappingHTTPClient):
+  """
+  Replaces the retry loop of the Stripe library: every attempt takes a token
+  from the bucket and a slot of the adaptive concurrency limit, and HTTP 429,
+  409, 5xx and connection errors are retried with jittered backoff. Writes
+  get an idempotency key that is kept across retries.
+  """
+
+  def __init__(self, inner, rate=None, concurrency=None, retries=None, initial_delay=0.5):
+    super().__init__(inner)
+    self.bucket = TokenBucket(rate if rate is not None else maxRequestsPerSecond())
+    self.limit = AdaptiveLimit(concurrency if concurrency is not None else maxConcurrency())
+    self.retries = retries if retries is not None else maxRetries()
+    self.initial_delay = initial_delay
+
+  def request_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, *, _usage=None):
+    return self.send(self.inner.request, method, url, headers, post_data)
+
+  def request_stream_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, *, _usage=None):
+    return self.send(self.inner.request_stream, method, url, headers, post_data)
+
+  def send(self, request, method, url, headers, post_data):
+    if method.lower() in ("post", "delete") and "Idempotency-Key" not in headers:
+      headers = dict(headers, **{"Idempotency-Key": str(uuid.uuid4())})
+
+    attempt = 0
+    while True:
+      self.bucket.acquire()
+      self.limit.acquire()
+      started = time.monotonic()
+      response, connection_error = None, None
+      try:
+        response = request(method, url, headers, post_data)
+      except stripe.APIConnectionError as e:
+        connection_error = e
+      finally:
+        throttled = response is not None and response[1] == 429
+        self.limit.release(time.monotonic() - started if response is not None else None, throttled=throttled)
+
+      if attempt < self.retries and (throttled or self._should_retry(response, connection_error, attempt, self.retries)):
+        attempt += 1
+        retry_after = self._retry_after_header(response) if response is not None else None
+        time.sleep(backoffSeconds(attempt, retry_after, initial_delay=self.initial_delay))
+        continue
+
+      if connection_error is not None:
+        raise connection_error
+      return response
+
+
+def install(**kwargs):
+  return httpclient.install(lambda inner: RateLimitedHTTPClient(inner, **kwargs))
+
+
+def map(fn, items, concurrency=None):
+  """
+  Calls fn for all items on a thread pool and returns the results in order,
+  the Stripe requests made by fn are limited by the installed client.
+  """
+  items = list(items)
+  if len(items) <= 1:
+    return [fn(item) for item in items]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency or maxConcurrency()) as executor:
+    return list(executor.map(fn, items))
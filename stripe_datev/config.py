@@ -1,7 +1,11 @@
+import os
 import pytz
 import tomli
 
-with open('config.toml', 'rb') as f:
+# Another configuration file can be used, e.g. config.example.toml in tests
+config_path = os.environ.get("STRIPE_DATEV_CONFIG", "config.toml")
+
+with open(config_path, 'rb') as f:
   config = tomli.load(f)
 
 company = config["company"]
@@ -9,3 +13,5 @@ accounting_tz = pytz.timezone(company["timezone"])
 
 datev = config["datev"]
 accounts = config["accounts"]
+invoices = config.get("invoices", {})
+stripe = config.get("stripe", {})
@@ -1,11 +1,82 @@
 
+# Line breaks become spaces, the separator a semicolon
+translations = {}
+
+
+def translation(sep):
+  if sep not in translations:
+    translations[sep] = str.maketrans({"\r": " ", "\n": " ", sep: ";"})
+  return translations[sep]
+
+
 def escape_csv_field(field_value, sep=","):
   if field_value is None:
     field_value = ""
-  field_value = field_value.replace("\r\n", " ").replace(
-    "\r", " ").replace("\n", " ").replace(sep, ";")
-  return field_value
+  if "\r\n" in field_value:
+    field_value = field_value.replace("\r\n", " ")
+  return field_value.translate(translation(sep))
+
+
+def escape_csv_line(line, sep=","):
+  try:
+    joined = sep.join(line)
+  except TypeError:
+    line = ["" if field is None else field for field in line]
+    joined = sep.join(line)
+  # Most lines have nothing to escape
+  if joined.count(sep) == len(line) - 1 and "\n" not in joined and "\r" not in joined:
+    return joined
+  return sep.join([escape_csv_field(field, sep=sep) for field in line])
 
 
 def lines_to_csv(lines_rows, sep=",", nl="\n"):
-  return nl.join(map(lambda l: sep.join(map(lambda f: escape_csv_field(f, sep=sep), l)), lines_rows))
+  return nl.join([escape_csv_line(line, sep=sep) for line in lines_rows])
+
+
+def write_csv(fp, lines_rows, sep=",", nl="\n", chunk_size=1000):
+  """
+  Writes the lines to fp like lines_to_csv() (no newline after the last one),
+  in chunks of lines instead of as one string.
+  """
+  chunk = []
+  first = True
+  for line in lines_rows:
+    chunk.append(escape_csv_line(line, sep=sep))
+    if len(chunk) >= chunk_size:
+      fp.write(("" if first else nl) + nl.join(chunk))
+      chunk = []
+      first = False
+  if len(chunk) > 0:
+    fp.write(("" if first else nl) + nl.join(chunk))
+
+
+class Formatter(object):
+  """
+  Caches the formatting of values that repeat across rows, e.g. the dates of
+  an invoice and the amounts of its recognition months.
+  """
+  max_size = 10000
+
+  def __init__(self):
+    self.dates = {}
+    self.amounts = {}
+
+  def date(self, value, fmt="%Y-%m-%d"):
+    # Equal datetimes in different time zones differ in their local date
+    key = (value, value.utcoffset(), fmt)
+    formatted = self.dates.get(key, None)
+    if formatted is None:
+      if len(self.dates) >= self.max_size:
+        self.dates.clear()
+      formatted = self.dates[key] = value.strftime(fmt)
+    return formatted
+
+  def amount(self, value, fmt=".2f"):
+    # 0 and -0 are equal, but formatted differently
+    key = (value, value.is_signed(), fmt)
+    formatted = self.amounts.get(key, None)
+    if formatted is None:
+      if len(self.amounts) >= self.max_size:
+        self.amounts.clear()
+      formatted = self.amounts[key] = format(value, fmt)
+    return formatted
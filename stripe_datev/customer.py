@@ -1,22 +1,26 @@
 from datetime import datetime, timezone
+import json
+import os
 import sys
+import threading
+import time
 import stripe
 
-from stripe_datev import config, output
+from stripe_datev import checkpoint, client, config, output, profile, projections, stages
 
-customers_cached = {}
+# Projected customers are interned by ID, see projections.customer()
+customers_cached = projections.customers_interned
 
 
 def retrieveCustomer(id):
   if isinstance(id, str):
     if id in customers_cached:
+      profile.countCache("customers", True)
       return customers_cached[id]
-    cus = stripe.Customer.retrieve(id, expand=["tax_ids"])
-    customers_cached[cus.id] = cus
-    return cus
-  elif isinstance(id, stripe.Customer):
-    customers_cached[id.id] = id
-    return id
+    profile.countCache("customers", False)
+    return projections.customer(stripe.Customer.retrieve(id, expand=["tax_ids"]))
+  elif isinstance(id, (stripe.Customer, projections.Customer)):
+    return projections.customer(id)
   else:
     raise Exception("Unexpected retrieveCustomer() argument: {}".format(id))
 
@@ -40,7 +44,9 @@ def getCustomerTaxId(customer):
     tax_id = tax_id.value if tax_id is not None else None
   else:
     if customer.id in tax_ids_cached:
+      profile.countCache("tax_ids", True)
       return tax_ids_cached[customer.id]
+    profile.countCache("tax_ids", False)
     ids = stripe.Customer.list_tax_ids(customer.id, limit=10).data
     tax_id = ids[0].value if len(ids) > 0 else None
     tax_ids_cached[customer.id] = tax_id
@@ -77,12 +83,43 @@ country_codes_eu = [
 ]
 
 
+def requiresAccountNumber(invoice=None):
+  """
+  Invoices finalized before 2022 are booked on the collective debtor account.
+  """
+  return invoice is None or datetime.fromtimestamp(invoice.status_transitions.finalized_at, timezone.utc) >= datetime(2022, 1, 1, 0, 0).astimezone(config.accounting_tz)
+
+
+def validateCustomer(customer, require_account_number=True):
+  """
+  Returns the reasons why getAccountingProps() would fail for the customer.
+  """
+  return [message for _, message in customerIssues(customer, require_account_number=require_account_number)]
+
+
+def customerIssues(customer, require_account_number=True):
+  """
+  Like validateCustomer(), as (issue type, message).
+  """
+  if customer.get("deleted", False):
+    return [("deleted", "customer is deleted")]
+
+  issues = []
+  if require_account_number and not customer.metadata.get("accountNumber", None):
+    issues.append(("missing_account_number", "missing 'accountNumber' in metadata"))
+  if not customer.address and not (customer.get("shipping", None) and customer.shipping.get("address", None)):
+    issues.append(("no_address", "no address or shipping address"))
+  if customer.tax_exempt not in ["none", "exempt", "reverse"]:
+    issues.append(("unknown_tax_exempt", "unknown tax_exempt status '{}'".format(customer.tax_exempt)))
+  return issues
+
+
 def getAccountingProps(customer, invoice=None, checkout_session=None):
   props = {
     "vat_region": "World",
   }
 
-  if (invoice is None or datetime.fromtimestamp(invoice.status_transitions.finalized_at, timezone.utc) >= datetime(2022, 1, 1, 0, 0).astimezone(config.accounting_tz)):
+  if requiresAccountNumber(invoice):
     if not customer.metadata.get("accountNumber", None):
       raise Exception("Expected 'accountNumber' in metadata")
     props["customer_account"] = customer.metadata["accountNumber"]
@@ -172,40 +209,81 @@ def getAccountingProps(customer, invoice=None, checkout_session=None):
   props["revenue_account"] = str(config.accounts["revenue_german_vat"])
   return props
 
-def validate_customers():
-  customer_count = 0
-  for customer in stripe.Customer.list(expand=["data.tax_ids"]).auto_paging_iter():
-    if not customer.address:
-      print("Warning: customer without address", customer.id)
-
-    if customer.tax_exempt == "exempt":
-      print("Warning: exempt customer", customer.id)
-
-    getAccountingProps(customer)
-
-    customer_count += 1
 
-  print("Validated {} customers".format(customer_count))
-
-
-def fill_account_numbers():
-  highest_account_number = None
+def fill_account_numbers(run_dir, bulk=False, resume=False):
+  """
+  Numbers the customers created after the newest one with an account number,
+  or with bulk all customers without one. The planned numbers are kept in
+  run_dir and each completed assignment is journaled there, so a resumed run
+  continues with the same plan instead of numbering anew.
+  """
+  plan_path = os.path.join(run_dir, "account_numbers.json")
+  journal_path = os.path.join(run_dir, "account_numbers.jsonl")
+  if not os.path.exists(run_dir):
+    os.makedirs(run_dir)
+  if not resume:
+    for path in [plan_path, journal_path]:
+      if os.path.exists(path):
+        os.remove(path)
+
+  if os.path.exists(plan_path):
+    with open(plan_path, "r", encoding="utf-8") as fp:
+      plan = json.load(fp)
+    print("Resuming the assignment of {} account number(s)".format(len(plan["assignments"])))
+  else:
+    highest_account_number, fill_customers = listAccountNumbers(bulk=bulk)
+    plan = {
+      "highest": highest_account_number,
+      "assignments": planAccountNumbers(fill_customers, highest_account_number),
+    }
+    with checkpoint.atomicOpen(plan_path, "w", encoding="utf-8") as fp:
+      json.dump(plan, fp, indent=2)
+    print("{} customers without account number, highest number is {}".format(
+      len(fill_customers), highest_account_number))
+
+  applyAccountNumbers(plan["assignments"], journal_path=journal_path)
+
+
+def listAccountNumbers(bulk=False):
+  """
+  Lists the customers, newest first. Returns the highest account number and
+  the customers to number: those created after the newest customer with an
+  account number, or with bulk all customers without one. Only with bulk are
+  the customers after the newest numbered one listed.
+  """
+  highest_account_number = 10100 - 1
   fill_customers = []
-  for customer in stripe.Customer.list().auto_paging_iter():
+  newer = True
+  for customer in stripe.Customer.list(limit=100).auto_paging_iter():
+    account_number = customer.metadata.get("accountNumber", None)
     if "accountNumber" in customer.metadata:
-      highest_account_number = int(customer.metadata["accountNumber"])
+      newer = False
+    if account_number and account_number.isdigit() and not bulk:
+      highest_account_number = int(account_number)
       break
-    fill_customers.append(customer)
-
-  if highest_account_number is None:
-    highest_account_number = 10100 - 1
-
-  print("{} customers without account number, highest number is {}".format(
-    len(fill_customers), highest_account_number))
-
-  for customer in reversed(fill_customers):
-    # print(customer.id, customer.metadata)
-
+    if account_number and account_number.isdigit():
+      highest_account_number = max(highest_account_number, int(account_number))
+    elif newer or (bulk and not account_number):
+      fill_customers.append(customer)
+  return highest_account_number, fill_customers
+
+
+def highestAccountNumber():
+  """
+  Customers may have been numbered out of creation order (see
+  assignAccountNumbers), so all of them are considered.
+  """
+  highest_account_number, _ = listAccountNumbers(bulk=True)
+  return highest_account_number
+
+
+def planAccountNumbers(customers, highest_account_number):
+  """
+  Returns the assignments of the account numbers after highest_account_number
+  to the customers, oldest first.
+  """
+  assignments = []
+  for customer in sorted(customers, key=lambda c: (c.created, c.id)):
     highest_account_number += 1
     metadata_new = {
       "accountNumber": str(highest_account_number)
@@ -215,17 +293,148 @@ def fill_account_numbers():
       if old_key in customer.metadata:
         metadata_new[old_key] = ""
 
-    # print("Update", metadata_new)
-    stripe.Customer.modify(customer.id, metadata=metadata_new)
+    assignments.append({"customer": customer.id, "metadata": metadata_new})
+  return assignments
+
+
+def applyAccountNumbers(assignments, journal_path=None):
+  """
+  Updates the customers' metadata concurrently, skipping the assignments
+  already in the journal. The idempotency key of each update is derived from
+  the assignment, so a retried or resumed update cannot assign another number.
+  Returns the assigned account numbers by customer ID.
+  """
+  done = set()
+  if journal_path is not None and os.path.exists(journal_path):
+    with open(journal_path, "r", encoding="utf-8") as fp:
+      for line in fp:
+        # The last line may be incomplete if the run was interrupted
+        if line.endswith("\n"):
+          done.add(json.loads(line)["customer"])
+  remaining = [assignment for assignment in assignments if assignment["customer"] not in done]
+  if len(done) > 0:
+    print("{} account number(s) assigned before, {} remaining".format(len(assignments) - len(remaining), len(remaining)))
+
+  lock = threading.Lock()
+  journal_fp = open(journal_path, "a", encoding="utf-8") if journal_path is not None else None
+
+  def assign(assignment):
+    account_number = assignment["metadata"]["accountNumber"]
+    stripe.Customer.modify(assignment["customer"], metadata=assignment["metadata"],
+                           idempotency_key="accountNumber-{}-{}".format(assignment["customer"], account_number))
+    with lock:
+      if journal_fp is not None:
+        journal_fp.write(json.dumps({"customer": assignment["customer"], "accountNumber": account_number}) + "\n")
+        journal_fp.flush()
+      print(assignment["customer"], account_number)
+
+  try:
+    client.map(assign, remaining)
+  finally:
+    if journal_fp is not None:
+      journal_fp.close()
+
+  return {assignment["customer"]: assignment["metadata"]["accountNumber"] for assignment in assignments}
+
+
+def assignAccountNumbers(customers):
+  """
+  Assigns the next free account numbers to the given customers (oldest first)
+  and returns them by customer ID.
+  """
+  return applyAccountNumbers(planAccountNumbers(customers, highestAccountNumber()))
+
+
+def loadAccountsManifest(path):
+  """
+  Returns the row hashes by customer ID of the manifest at path, the time of
+  the last complete listing they cover (or None) and the code fingerprint they
+  were computed with.
+  """
+  if path is None or not os.path.exists(path):
+    return {}, None, None
+  with open(path, "r", encoding="utf-8") as fp:
+    manifest = json.load(fp)
+  return manifest["rows"], manifest.get("listed_at", None), manifest.get("code", None)
+
+
+def saveAccountsManifest(path, manifest, listed_at):
+  with checkpoint.atomicOpen(path, "w", encoding="utf-8") as fp:
+    json.dump({
+      "exported_at": datetime.now(timezone.utc).isoformat(),
+      "listed_at": listed_at,
+      "code": stages.codeFingerprint(),
+      "rows": manifest,
+    }, fp, indent=2, sort_keys=True)
+
+
+account_event_types = [
+  "customer.updated",
+  "customer.tax_id.created",
+  "customer.tax_id.updated",
+  "customer.tax_id.deleted",
+]
 
-    print(customer.id, highest_account_number)
 
+def listChangedCustomers(since, created_gte=None):
+  """
+  Lists the customers created since the given time, then those created before
+  (but not before created_gte) whose account data changed since, according to
+  the events. Requires since to be within Stripe's event retention.
+  """
+  created = {"gte": since if created_gte is None else max(since, created_gte)}
+  seen = set()
+  for cus in stripe.Customer.list(limit=100, expand=["data.tax_ids"], created=created).auto_paging_iter():
+    seen.add(cus.id)
+    yield cus
+
+  for event in stripe.Event.list(types=account_event_types, created={"gte": since}, limit=100).auto_paging_iter():
+    obj = event["data"]["object"]
+    id = obj["id"] if event["type"] == "customer.updated" else obj.get("customer", None)
+    if id is None or id in seen:
+      continue
+    seen.add(id)
+    cus = stripe.Customer.retrieve(id, expand=["tax_ids"])
+    if cus.get("deleted", False) or (created_gte is not None and cus.created < created_gte):
+      continue
+    yield cus
+
+
+def list_account_numbers(file_path, since=None, manifest_path=None, delta=False):
+  """
+  Exports the customers (created since the given time, if any) as DATEV
+  Debitoren/Kreditoren. The manifest at manifest_path keeps a hash of each
+  customer's row as of the last export to a file, with delta only customers
+  that are new or changed since are exported. Delta exports within Stripe's
+  event retention of the last full one only list the customers created or
+  changed since.
+  """
+  if delta and manifest_path is None:
+    raise Exception("Delta export requires a manifest")
+
+  manifest, listed_at, code = loadAccountsManifest(manifest_path) if manifest_path is not None else (None, None, None)
+  created_gte = int(since.timestamp()) if since is not None else None
+  now = int(time.time())
+
+  if delta and listed_at is not None and listed_at >= now - stages.events_retention \
+     and code == stages.codeFingerprint():
+    customer_it = listChangedCustomers(listed_at, created_gte)
+  else:
+    params = {}
+    if created_gte is not None:
+      params["created"] = {"gte": created_gte}
+    customer_it = stripe.Customer.list(
+      limit=100, expand=["data.tax_ids"], **params).auto_paging_iter()
+  # Only listings without since cover every customer changed since listed_at
+  if since is None:
+    listed_at = now
 
-def list_account_numbers(file_path):
-  customer_it = stripe.Customer.list(
-    expand=["data.tax_ids"]).auto_paging_iter()
   if file_path is None:
-    output.printAccounts(sys.stdout, customer_it)
-  else:
-    with open(file_path, "w", encoding="latin-1", errors="replace") as fp:
-      output.printAccounts(fp, customer_it)
+    output.printAccounts(sys.stdout, customer_it, manifest=manifest, delta=delta)
+    return
+
+  with checkpoint.atomicOpen(file_path, "w", encoding="latin-1", errors="replace") as fp:
+    written = output.printAccounts(fp, customer_it, manifest=manifest, delta=delta)
+  if manifest is not None:
+    saveAccountsManifest(manifest_path, manifest, listed_at)
+  print("Wrote {} accounts to {}".format(written, file_path))
@@ -0,0 +1,90 @@
+import decimal
+
+from . import recognition
+
+
+class IntervalTree(object):
+  """
+  Centered interval tree of (low, high, value) intervals, to find all
+  intervals containing a point in O(log n + matches). Empty intervals (low >
+  high) are left out.
+  """
+
+  def __init__(self, intervals):
+    intervals = [interval for interval in intervals if interval[0] <= interval[1]]
+    self.center = None
+    if len(intervals) == 0:
+      return
+    points = sorted(point for low, high, _ in intervals for point in (low, high))
+    self.center = points[len(points) // 2]
+
+    left = [interval for interval in intervals if interval[1] < self.center]
+    right = [interval for interval in intervals if interval[0] > self.center]
+    overlapping = [interval for interval in intervals if interval[0] <= self.center <= interval[1]]
+    # Intervals containing the center, by low ascending and by high descending
+    self.by_low = sorted(overlapping, key=lambda interval: interval[0])
+    self.by_high = sorted(overlapping, key=lambda interval: interval[1], reverse=True)
+    self.left = IntervalTree(left) if len(left) > 0 else None
+    self.right = IntervalTree(right) if len(right) > 0 else None
+
+  def stab(self, point):
+    """
+    Values of all intervals with low <= point <= high.
+    """
+    result = []
+    node = self
+    while node is not None and node.center is not None:
+      if point < node.center:
+        for low, _, value in node.by_low:
+          if low > point:
+            break
+          result.append(value)
+        node = node.left
+      elif point > node.center:
+        for _, high, value in node.by_high:
+          if high < point:
+            break
+          result.append(value)
+        node = node.right
+      else:
+        result += [value for _, _, value in node.by_low]
+        break
+    return result
+
+
+class DeferredRevenue(object):
+  """
+  Index of the recognition ranges of booked revenue, as stored in the
+  journal. Each range defers the part of its amount recognized in the months
+  after its date, and releases it at the start of each of these months, like
+  the pRAP records of invoices.createAccountingRecords().
+  """
+
+  def __init__(self, ranges):
+    self.ranges = list(ranges)
+    # A range has deferred revenue from its date until its recognition end at most,
+    # none if it was booked after its end
+    self.tree = IntervalTree((date, end, idx) for idx, (_, date, _, end, _, _) in enumerate(self.ranges))
+    self.months_cache = {}
+
+  def months(self, idx):
+    if idx not in self.months_cache:
+      _, _, start, end, amount, _ = self.ranges[idx]
+      self.months_cache[idx] = [(month["start"], month["amounts"][0])
+                                for month in recognition.split_months(start, end, [amount])]
+    return self.months_cache[idx]
+
+  def schedule(self, asOf):
+    """
+    Deferred revenue as of asOf, by month it will be released in, as
+    {month start: amount}, only including revenue booked until asOf.
+    """
+    releases = {}
+    for idx in self.tree.stab(asOf):
+      for month_start, amount in self.months(idx):
+        if month_start > asOf:
+          releases[month_start] = releases.get(month_start, decimal.Decimal(0)) + amount
+    return {month_start: releases[month_start] for month_start in sorted(releases)}
+
+  def outstanding(self, asOf):
+    return sum(self.schedule(asOf).values(), decimal.Decimal(0))
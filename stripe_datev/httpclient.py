@@ -0,0 +1,51 @@
+import stripe
+
+
+class WrappingHTTPClient(stripe.HTTPClient):
+  """
+  Base class for HTTP clients that wrap the client used by the Stripe library,
+  e.g. to record, replay or count requests. Install with install().
+  """
+
+  name = "stripe-datev-wrapper"
+
+  def __init__(self, inner):
+    super().__init__()
+    self.inner = inner
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    return self.inner.request(method, url, headers, post_data)
+
+  def request_stream(self, method, url, headers, post_data=None, *, _usage=None):
+    return self.inner.request_stream(method, url, headers, post_data)
+
+  def close(self):
+    if self.inner is not None:
+      self.inner.close()
+
+
+def currentClient():
+  if stripe.default_http_client is None:
+    stripe.default_http_client = stripe.new_default_http_client(
+      verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy)
+  return stripe.default_http_client
+
+
+def install(wrap):
+  """
+  Wraps the current Stripe HTTP client, wrap is called with the current client
+  and returns the new one.
+  """
+  stripe.default_http_client = wrap(currentClient())
+  return stripe.default_http_client
+
+
+def requestPath(url):
+  """
+  Path and query of a request URL, independent of the configured API base.
+  """
+  scheme_sep = url.find("://")
+  if scheme_sep < 0:
+    return url
+  path_start = url.find("/", scheme_sep + 3)
+  return url[path_start:] if path_start >= 0 else "/"
@@ -1,49 +1,140 @@
+import itertools
 import json
+import os
 from stripe_datev import recognition, csv
 import stripe
 import decimal
 import math
 from datetime import datetime, timedelta, timezone
-from . import customer, output, dateparser, config
+from . import customer, output, dateparser, config, profile, client, projections
 import datedelta
 
 invoices_cached = {}
 
 
-def listFinalizedInvoices(fromTime, toTime):
+def getLookback():
+  return datedelta.datedelta(months=int(config.invoices.get("lookback_months", 1)))
+
+
+def suggestLookbackMonths(max_lag_seconds):
+  # A month may be as short as 28 days
+  return max(1, math.ceil(max_lag_seconds / (28 * 24 * 60 * 60)))
+
+
+def loadPaddingCache(path):
+  if not os.path.exists(path):
+    return {}
+  with open(path, "r", encoding="utf-8") as fp:
+    return json.load(fp)
+
+
+def savePaddingCache(path, padding_cache):
+  with open(path, "w", encoding="utf-8") as fp:
+    json.dump(padding_cache, fp, indent=2, sort_keys=True)
+
+
+def listFinalizedInvoices(fromTime, toTime, padding_cache=None):
+  """
+  Yields all invoices finalized in [fromTime, toTime). Invoices created up to
+  `lookback_months` before fromTime are considered, to catch late finalizations.
+
+  If padding_cache (a dict, see loadPaddingCache) covers the look-back window
+  from a previous run, only invoices that were still drafts or are known to be
+  finalized in the period are retrieved from that window, instead of listing
+  it again. The cache is updated in place for the next period.
+  """
+  padding_start = int((fromTime - getLookback()).timestamp())
+  from_ts = int(fromTime.timestamp())
+  to_ts = int(toTime.timestamp())
+  listed_at = int(datetime.now(timezone.utc).timestamp())
+
+  covered = padding_cache.get("covered", None) if padding_cache is not None else None
+  use_cache = covered is not None and covered[0] <= padding_start and covered[1] >= from_ts
+
   invoices = stripe.Invoice.list(
     created={
-      "lt": int(toTime.timestamp()),
-      # Increase this padding if you have invoices where more than
-      # 1 month passed between creation and finalization
-      "gte": int((fromTime - datedelta.MONTH).timestamp()),
+      "lt": to_ts,
+      "gte": from_ts if use_cache else padding_start,
     },
     expand=["data.customer", "data.customer.tax_ids"]
   ).auto_paging_iter()
 
+  if use_cache:
+    candidates = sorted(((id, entry) for id, entry in padding_cache["invoices"].items()
+                         if padding_start <= entry["created"] < from_ts
+                         and (entry["finalized_at"] is None or from_ts <= entry["finalized_at"] < to_ts)),
+                        key=lambda c: c[1]["created"], reverse=True)
+    print("Using cached look-back window, retrieving {} invoice(s) individually".format(len(candidates)))
+
+    def retrieveCandidate(candidate):
+      try:
+        return retrieveInvoice(candidate[0])
+      except stripe.InvalidRequestError:
+        # Drafts may have been deleted in the meantime
+        return None
+
+    def iterCandidates():
+      for invoice in client.map(retrieveCandidate, candidates):
+        if invoice is not None:
+          yield invoice
+
+    invoices = itertools.chain(invoices, iterCandidates())
+
+  seen = {}
+  max_lag = padding_cache.get("max_lag_seconds", 0) if padding_cache is not None else 0
+
   for invoice in invoices:
+    finalized_at = invoice.status_transitions.finalized_at if invoice.status != "draft" else None
+    seen[invoice.id] = {
+      "created": invoice.created,
+      "finalized_at": finalized_at,
+    }
+    if finalized_at is not None:
+      max_lag = max(max_lag, finalized_at - invoice.created)
+
     if invoice.status == "draft":
       continue
     finalized_date = datetime.fromtimestamp(
-      invoice.status_transitions.finalized_at, timezone.utc).astimezone(config.accounting_tz)
+      finalized_at, timezone.utc).astimezone(config.accounting_tz)
     if finalized_date < fromTime or finalized_date >= toTime:
       # print("Skipping invoice {}, created {} finalized {} due {}".format(invoice.id, created_date, finalized_date, due_date))
       continue
+    # Projected only now, projecting paginates the line items of the invoice
+    invoice = projections.invoice(invoice)
     invoices_cached[invoice.id] = invoice
     yield invoice
 
+  suggested = suggestLookbackMonths(max_lag)
+  if suggested > getLookback().months:
+    print("Warning: invoices were finalized up to {} day(s) after creation, consider setting [invoices] lookback_months = {}".format(
+      max_lag // (24 * 60 * 60), suggested))
+
+  if padding_cache is not None:
+    # Keep only what the look-back window of the following period needs
+    keep_from = int((toTime - getLookback()).timestamp())
+    keep_to = min(to_ts, listed_at)
+    padding_cache.clear()
+    padding_cache.update({
+      "covered": [keep_from, keep_to],
+      "max_lag_seconds": max_lag,
+      "invoices": {id: entry for id, entry in seen.items() if keep_from <= entry["created"] < keep_to},
+    })
+
 
 def retrieveInvoice(id):
   if isinstance(id, str):
     if id in invoices_cached:
+      profile.countCache("invoices", True)
       return invoices_cached[id]
-    invoice = stripe.Invoice.retrieve(
-      id, expand=["customer", "customer.tax_ids"])
+    profile.countCache("invoices", False)
+    invoice = projections.invoice(stripe.Invoice.retrieve(
+      id, expand=["customer", "customer.tax_ids"]))
+    invoices_cached[invoice.id] = invoice
+    return invoice
+  elif isinstance(id, (stripe.Invoice, projections.Invoice)):
+    invoice = projections.invoice(id)
     invoices_cached[invoice.id] = invoice
     return invoice
-  elif isinstance(id, stripe.Invoice):
-    invoices_cached[id.id] = id
-    return id
   else:
     raise Exception("Unexpected retrieveInvoice() argument: {}".format(id))
 
@@ -53,7 +144,9 @@ tax_rates_cached = {}
 
 def retrieveTaxRate(id):
   if id in tax_rates_cached:
+    profile.countCache("tax_rates", True)
     return tax_rates_cached[id]
+  profile.countCache("tax_rates", False)
   tax_rate = stripe.TaxRate.retrieve(id)
   tax_rates_cached[id] = tax_rate
   return tax_rate
@@ -201,7 +294,6 @@ def createAccountingRecords(revenue_item):
   created = revenue_item["created"]
   amount_with_tax = revenue_item["amount_with_tax"]
   accounting_props = revenue_item["accounting_props"]
-  line_items = revenue_item["line_items"]
   text = revenue_item["text"]
   voided_at = revenue_item.get("voided_at", None)
   credited_at = revenue_item.get("credited_at", None)
@@ -273,7 +365,7 @@ def createAccountingRecords(revenue_item):
       })
 
   prap_records = []
-  def apply_prap(date, start, end, amount):
+  def apply_prap(date, start, end, amount, text):
     # print("apply_prap", date, start, end, amount)
 
     months = recognition.split_months(start, end, [amount])
@@ -316,24 +408,8 @@ def createAccountingRecords(revenue_item):
 
     assert sum(map(lambda month: month["amounts"][0], forward_months)) == forward_amount
 
-  for line_item in line_items:
-    amount_with_tax = line_item["amount_with_tax"]
-    recognition_start = line_item["recognition_start"]
-    recognition_end = line_item["recognition_end"]
-    text = line_item["text"]
-
-    apply_prap(created, recognition_start, recognition_end, amount_with_tax)
-
-    if voided_at:
-      apply_prap(voided_at, recognition_start, recognition_end, -amount_with_tax)
-    elif marked_uncollectible_at:
-      apply_prap(marked_uncollectible_at, recognition_start, recognition_end, -amount_with_tax)
-    elif credited_at:
-      if len(line_items) == 1:
-        credited_amount_li = credited_amount
-      else:
-        credited_amount_li = credited_amount * (amount_with_tax / revenue_item["amount_with_tax"]) # TODO: rounding issues?
-      apply_prap(credited_at, recognition_start, recognition_end, -credited_amount_li)
+  for date, recognition_start, recognition_end, amount, text in recognitionRanges(revenue_item):
+    apply_prap(date, recognition_start, recognition_end, amount, text)
 
   prap_records_by_month = {}
   for record in prap_records:
@@ -353,8 +429,44 @@ def createAccountingRecords(revenue_item):
   return records
 
 
-def to_csv(inv):
-  lines = [[
+def recognitionRanges(revenue_item):
+  """
+  (date, recognition start, recognition end, amount with tax, text) of each
+  line item when the invoice was booked, and again with the negative amount
+  when it was voided, marked uncollectible or credited. The part of the
+  amount recognized after the date is deferred (pRAP).
+  """
+  line_items = revenue_item["line_items"]
+  voided_at = revenue_item.get("voided_at", None)
+  credited_at = revenue_item.get("credited_at", None)
+  credited_amount = revenue_item.get("credited_amount", None)
+  marked_uncollectible_at = revenue_item.get("marked_uncollectible_at", None)
+
+  ranges = []
+  for line_item in line_items:
+    amount_with_tax = line_item["amount_with_tax"]
+    recognition_start = line_item["recognition_start"]
+    recognition_end = line_item["recognition_end"]
+    text = line_item["text"]
+
+    ranges.append((revenue_item["created"], recognition_start, recognition_end, amount_with_tax, text))
+
+    if voided_at:
+      ranges.append((voided_at, recognition_start, recognition_end, -amount_with_tax, text))
+    elif marked_uncollectible_at:
+      ranges.append((marked_uncollectible_at, recognition_start, recognition_end, -amount_with_tax, text))
+    elif credited_at:
+      if len(line_items) == 1:
+        credited_amount_li = credited_amount
+      else:
+        credited_amount_li = credited_amount * (amount_with_tax / revenue_item["amount_with_tax"]) # TODO: rounding issues?
+      ranges.append((credited_at, recognition_start, recognition_end, -credited_amount_li, text))
+  return ranges
+
+
+def to_csv_lines(inv):
+  formatter = csv.Formatter()
+  yield [
     "invoice_id",
     "invoice_number",
     "date",
@@ -374,7 +486,7 @@ def to_csv(inv):
     "customer_account",
     "revenue_account",
     "datev_tax_key",
-  ]]
+  ]
   for invoice in inv:
     if invoice.status == "void":
       continue
@@ -387,17 +499,17 @@ def to_csv(inv):
     if tax is not None:
       total_before_tax -= tax
 
-    lines.append([
+    yield [
       invoice.id,
       invoice.number,
-      datetime.fromtimestamp(invoice.status_transitions.finalized_at, timezone.utc).astimezone(
-        config.accounting_tz).strftime("%Y-%m-%d"),
+      formatter.date(datetime.fromtimestamp(invoice.status_transitions.finalized_at, timezone.utc).astimezone(
+        config.accounting_tz)),
 
-      format(total_before_tax, ".2f"),
-      format(tax, ".2f") if tax else None,
+      formatter.amount(total_before_tax),
+      formatter.amount(tax) if tax else None,
       format(decimal.Decimal(invoice.tax_percent),
              ".0f") if "tax_percent" in invoice and invoice.tax_percent else None,
-      format(total, ".2f"),
+      formatter.amount(total),
 
       cus.id,
       customer.getCustomerName(cus),
@@ -409,33 +521,18 @@ def to_csv(inv):
       props["customer_account"],
       props["revenue_account"],
       props["datev_tax_key_invoice"],
-    ])
-
-  return csv.lines_to_csv(lines)
-
-
-def to_recognized_month_csv2(revenue_items):
-  lines = [[
-    "invoice_id",
-    "invoice_number",
-    "invoice_date",
-    "recognition_start",
-    "recognition_end",
-    "recognition_month",
+    ]
 
-    "line_item_idx",
-    "line_item_desc",
-    "line_item_net",
 
-    "customer_id",
-    "customer_name",
-    "country",
+def to_csv(inv):
+  return csv.lines_to_csv(to_csv_lines(inv))
 
-    "accounting_date",
-    "revenue_type",
-    "is_recurring",
-  ]]
 
+def recognizedMonths(revenue_items):
+  """
+  Net revenue of each line item by month of recognition, with reversals of
+  voided, uncollectible and credited invoices, as dicts of typed values.
+  """
   for revenue_item in revenue_items:
     amount_with_tax = revenue_item.get("amount_with_tax")
     voided_at = revenue_item.get("voided_at", None)
@@ -457,50 +554,86 @@ def to_recognized_month_csv2(revenue_items):
         accounting_date = max(
           revenue_item["created"], end if end < month["start"] else month["start"])
 
-        lines.append([
-          revenue_item["id"],
-          revenue_item.get("number", ""),
-          revenue_item["created"].strftime("%Y-%m-%d"),
-          line_item["recognition_start"].strftime("%Y-%m-%d"),
-          line_item["recognition_end"].strftime("%Y-%m-%d"),
-          month["start"].strftime("%Y-%m") + "-01",
-
-          str(line_item.get("line_item_idx", 0) + 1),
-          line_item["text"],
-          format(month["amounts"][0], ".2f"),
-
-          revenue_item["customer"]["id"],
-          customer.getCustomerName(revenue_item["customer"]),
-          revenue_item["customer"].get("address", {}).get("country", ""),
-
-          accounting_date.strftime("%Y-%m-%d"),
-          revenue_type,
-          "true" if is_recurring else "false",
-        ])
-
-        if voided_at is not None:
-          reverse = lines[-1].copy()
-          reverse[8] = format(month["amounts"][0] * -1, ".2f")
-          reverse[12] = max(revenue_item["created"], end if end <
-                            month["end"] else month["start"]).strftime("%Y-%m-%d")
-          lines.append(reverse)
-
-        elif marked_uncollectible_at is not None:
-          reverse = lines[-1].copy()
-          reverse[8] = format(month["amounts"][0] * -1, ".2f")
-          reverse[12] = max(revenue_item["created"], end if end <
-                            month["end"] else month["start"]).strftime("%Y-%m-%d")
-          lines.append(reverse)
-
-        elif credited_at is not None:
-          reverse = lines[-1].copy()
-          reverse[8] = format(month["amounts"][0] * -1 *
-                              (credited_amount / amount_with_tax), ".2f")
-          reverse[12] = max(revenue_item["created"], end if end <
-                            month["end"] else month["start"]).strftime("%Y-%m-%d")
-          lines.append(reverse)
-
-  return csv.lines_to_csv(lines)
+        row = {
+          "invoice_id": revenue_item["id"],
+          "invoice_number": revenue_item.get("number", ""),
+          "invoice_date": revenue_item["created"],
+          "recognition_start": line_item["recognition_start"],
+          "recognition_end": line_item["recognition_end"],
+          "recognition_month": month["start"],
+
+          "line_item_idx": line_item.get("line_item_idx", 0) + 1,
+          "line_item_desc": line_item["text"],
+          "line_item_net": month["amounts"][0],
+
+          "customer_id": revenue_item["customer"]["id"],
+          "customer_name": customer.getCustomerName(revenue_item["customer"]),
+          "country": revenue_item["customer"].get("address", {}).get("country", ""),
+
+          "accounting_date": accounting_date,
+          "revenue_type": revenue_type,
+          "is_recurring": is_recurring,
+        }
+        yield row
+
+        if voided_at is not None or marked_uncollectible_at is not None or credited_at is not None:
+          reverse = row.copy()
+          reverse["line_item_net"] = month["amounts"][0] * -1
+          if voided_at is None and marked_uncollectible_at is None:
+            reverse["line_item_net"] *= credited_amount / amount_with_tax
+          reverse["accounting_date"] = max(revenue_item["created"], end if end <
+                                           month["end"] else month["start"])
+          yield reverse
+
+
+def to_recognized_month_csv2_lines(revenue_items):
+  formatter = csv.Formatter()
+  yield [
+    "invoice_id",
+    "invoice_number",
+    "invoice_date",
+    "recognition_start",
+    "recognition_end",
+    "recognition_month",
+
+    "line_item_idx",
+    "line_item_desc",
+    "line_item_net",
+
+    "customer_id",
+    "customer_name",
+    "country",
+
+    "accounting_date",
+    "revenue_type",
+    "is_recurring",
+  ]
+
+  for row in recognizedMonths(revenue_items):
+    yield [
+      row["invoice_id"],
+      row["invoice_number"],
+      formatter.date(row["invoice_date"]),
+      formatter.date(row["recognition_start"]),
+      formatter.date(row["recognition_end"]),
+      formatter.date(row["recognition_month"], "%Y-%m-01"),
+
+      str(row["line_item_idx"]),
+      row["line_item_desc"],
+      formatter.amount(row["line_item_net"]),
+
+      row["customer_id"],
+      row["customer_name"],
+      row["country"],
+
+      formatter.date(row["accounting_date"]),
+      row["revenue_type"],
+      "true" if row["is_recurring"] else "false",
+    ]
+
+
+def to_recognized_month_csv2(revenue_items):
+  return csv.lines_to_csv(to_recognized_month_csv2_lines(revenue_items))
 
 
 def roundCentsDown(dec):
@@ -0,0 +1,296 @@
+import decimal
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+from . import config
+
+# Stored as PRAGMA user_version, 1 = totals of all runs are kept
+schema_version = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  scope TEXT NOT NULL,
+  command TEXT,
+  created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_scope ON runs (scope, id);
+
+CREATE TABLE IF NOT EXISTS records (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL REFERENCES runs (id),
+  source TEXT,
+  month TEXT NOT NULL,
+  date TEXT NOT NULL,
+  konto TEXT,
+  gegenkonto TEXT,
+  belegfeld1 TEXT,
+  umsatz TEXT,
+  soll_haben TEXT,
+  buchungstext TEXT,
+  fields TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_run ON records (run_id);
+CREATE INDEX IF NOT EXISTS records_month ON records (month);
+CREATE INDEX IF NOT EXISTS records_konto ON records (konto, month);
+CREATE INDEX IF NOT EXISTS records_gegenkonto ON records (gegenkonto, month);
+CREATE INDEX IF NOT EXISTS records_belegfeld1 ON records (belegfeld1);
+
+-- Debit and credit sums per account and accounting month of each run,
+-- added together with the run's records
+CREATE TABLE IF NOT EXISTS totals (
+  run_id INTEGER NOT NULL REFERENCES runs (id),
+  month TEXT NOT NULL,
+  account TEXT NOT NULL,
+  debit INTEGER NOT NULL,
+  credit INTEGER NOT NULL,
+  PRIMARY KEY (run_id, month, account)
+);
+
+-- Recognition ranges of the revenue booked (or cancelled) in each run, to
+-- forecast the release of deferred revenue (pRAP)
+CREATE TABLE IF NOT EXISTS recognition_ranges (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL REFERENCES runs (id),
+  source TEXT,
+  date TEXT NOT NULL,
+  start TEXT NOT NULL,
+  end TEXT NOT NULL,
+  amount TEXT NOT NULL,
+  text TEXT
+);
+CREATE INDEX IF NOT EXISTS recognition_ranges_run ON recognition_ranges (run_id);
+
+-- The latest run of a scope replaces all earlier ones
+CREATE VIEW IF NOT EXISTS current_records AS
+  SELECT records.*, runs.scope AS scope FROM records
+  JOIN runs ON runs.id = records.run_id
+  WHERE runs.id = (SELECT MAX(latest.id) FROM runs AS latest WHERE latest.scope = runs.scope);
+
+CREATE VIEW IF NOT EXISTS current_recognition_ranges AS
+  SELECT recognition_ranges.*, runs.scope AS scope FROM recognition_ranges
+  JOIN runs ON runs.id = recognition_ranges.run_id
+  WHERE runs.id = (SELECT MAX(latest.id) FROM runs AS latest WHERE latest.scope = runs.scope);
+"""
+
+
+def entries(source, records):
+  """
+  Accounting records tagged with the ID of the Stripe object they stem from.
+  """
+  return [(source, record) for record in records]
+
+
+def accountingMonth(date):
+  return date.astimezone(config.accounting_tz).strftime("%Y-%m")
+
+
+def periodScopes(kind, year, month):
+  """
+  Scopes of the records of a download period, e.g. revenue-2023-05. Scopes
+  are kept per accounting month, a year (month 0) covers the scopes of all
+  its months, so that a year run replaces the runs of its months and vice
+  versa.
+  """
+  months = [month] if month > 0 else range(1, 13)
+  return ["{}-{:04d}-{:02d}".format(kind, year, m) for m in months]
+
+
+def scopeCondition(scope):
+  """
+  SQL condition and parameters matching one scope or any of a list of scopes.
+  """
+  if isinstance(scope, (list, tuple)):
+    return "scope IN ({})".format(", ".join("?" for _ in scope)), [str(s) for s in scope]
+  return "scope = ?", [str(scope)]
+
+
+def cents(umsatz):
+  return int(decimal.Decimal(umsatz.replace(",", ".")) * 100)
+
+
+def totals(rows):
+  """
+  Debit and credit cents per (month, account) of (month, Konto, Gegenkonto,
+  Umsatz, Soll/Haben-Kennzeichen) rows: "S" debits the Konto and credits the
+  Gegenkonto, "H" the other way around.
+  """
+  sums = {}
+  for month, konto, gegenkonto, umsatz, soll_haben in rows:
+    amount = cents(umsatz)
+    debit, credit = (konto, gegenkonto) if soll_haben == "S" else (gegenkonto, konto)
+    for account, idx in [(debit, 0), (credit, 1)]:
+      if account:
+        sums.setdefault((month, account), [0, 0])[idx] += amount
+  return sums
+
+
+class Journal(object):
+  """
+  Append-only store of the accounting records of each run. A run covers a
+  scope (e.g. the revenue records of one download period) completely, queries
+  only see the records of the latest run of each scope.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.db = sqlite3.connect(path)
+    self.db.executescript(schema)
+    version, = self.db.execute("PRAGMA user_version").fetchone()
+    if version < schema_version:
+      # Journals written before totals were kept
+      with self.db:
+        for run_id, in self.db.execute("SELECT id FROM runs WHERE id NOT IN (SELECT run_id FROM totals)").fetchall():
+          self.addTotals(run_id)
+        self.db.execute("PRAGMA user_version = {}".format(schema_version))
+
+  def close(self):
+    self.db.close()
+
+  def hasScope(self, scope):
+    """
+    Whether there is a run of the scope, or of any of a list of scopes.
+    """
+    condition, params = scopeCondition(scope)
+    return self.db.execute("SELECT 1 FROM runs WHERE {} LIMIT 1".format(condition), params).fetchone() is not None
+
+  def append(self, scope, entries, command=None, ranges=()):
+    """
+    Adds a run with the given (source, record) entries and (source, date,
+    start, end, amount, text) recognition ranges to the scope, and returns
+    its ID.
+    """
+    with self.db:
+      run_id = self.db.execute("INSERT INTO runs (scope, command, created) VALUES (?, ?, ?)", (
+        scope, command, datetime.now(timezone.utc).isoformat())).lastrowid
+      self.db.executemany("""
+        INSERT INTO records (run_id, source, month, date, konto, gegenkonto, belegfeld1, umsatz, soll_haben,
+                             buchungstext, fields)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+      """, [(
+        run_id,
+        source,
+        accountingMonth(record["date"]),
+        record["date"].isoformat(),
+        record.get("Konto", None),
+        record.get("Gegenkonto (ohne BU-Schlüssel)", None),
+        record.get("Belegfeld 1", None),
+        record.get("Umsatz (ohne Soll/Haben-Kz)", None),
+        record.get("Soll/Haben-Kennzeichen", None),
+        record.get("Buchungstext", None),
+        json.dumps({name: value for name, value in record.items() if name != "date"}),
+      ) for source, record in entries])
+      self.db.executemany("""
+        INSERT INTO recognition_ranges (run_id, source, date, start, end, amount, text) VALUES (?, ?, ?, ?, ?, ?, ?)
+      """, [(run_id, source, date.isoformat(), start.isoformat(), end.isoformat(), str(amount), text)
+            for source, date, start, end, amount, text in ranges])
+      self.addTotals(run_id)
+    return run_id
+
+  def addTotals(self, run_id):
+    sums = totals(self.db.execute(
+      "SELECT month, konto, gegenkonto, umsatz, soll_haben FROM records WHERE run_id = ?", (run_id,)))
+    self.db.executemany("INSERT INTO totals (run_id, month, account, debit, credit) VALUES (?, ?, ?, ?, ?)", [
+      (run_id, month, account, debit, credit) for (month, account), (debit, credit) in sums.items()])
+
+  def monthlyTotals(self, accounts=None):
+    """
+    Debit and credit cents per account and accounting month over the latest
+    runs of all scopes, as (account, month, debit, credit) ordered by account
+    and month.
+    """
+    condition = ""
+    params = []
+    if accounts:
+      condition = " AND totals.account IN ({})".format(", ".join("?" for _ in accounts))
+      params = [str(account) for account in accounts]
+    return self.db.execute("""
+      SELECT totals.account, totals.month, SUM(totals.debit), SUM(totals.credit) FROM totals
+      JOIN runs ON runs.id = totals.run_id
+      WHERE runs.id = (SELECT MAX(latest.id) FROM runs AS latest WHERE latest.scope = runs.scope){}
+      GROUP BY totals.account, totals.month
+      ORDER BY totals.account, totals.month
+    """.format(condition), params).fetchall()
+
+  def appendPeriod(self, scopes, entries, scopeOf, command=None, ranges=(), amend=False):
+    """
+    Adds the entries and ranges to the scopes of a period (see
+    periodScopes()), each source to the scope that scopeOf returns for it.
+    Every scope of the period gets a run, as the period covers it
+    completely. With amend, only the scopes with new entries or ranges are
+    amended, see amend().
+    """
+    def periodScope(source):
+      # Objects booked just outside the period (e.g. charges paid out later)
+      # belong to its first or last scope
+      return min(max(scopeOf(source), scopes[0]), scopes[-1]) if len(scopes) > 1 else scopes[0]
+
+    by_scope = {scope: ([], []) for scope in scopes}
+    for entry in entries:
+      by_scope[periodScope(entry[0])][0].append(entry)
+    for recognition_range in ranges:
+      by_scope[periodScope(recognition_range[0])][1].append(recognition_range)
+
+    run_ids = []
+    for scope, (scope_entries, scope_ranges) in by_scope.items():
+      if not amend:
+        run_ids.append(self.append(scope, scope_entries, command=command, ranges=scope_ranges))
+      elif len(scope_entries) > 0 or len(scope_ranges) > 0:
+        run_ids.append(self.amend(scope, scope_entries, command=command, ranges=scope_ranges))
+    return run_ids
+
+  def amend(self, scope, entries, command=None, ranges=()):
+    """
+    Like append(), but keeps the current records and ranges of all sources
+    that have no new entries, e.g. to add objects that failed in the previous
+    run.
+    """
+    sources = set(source for source, _ in entries) | set(r[0] for r in ranges)
+    kept = [(source, record) for source, record in self.entries(scope=scope) if source not in sources]
+    kept_ranges = [r for r in self.recognitionRanges(scope=scope) if r[0] not in sources]
+    return self.append(scope, kept + list(entries), command=command, ranges=kept_ranges + list(ranges))
+
+  def query(self, scope=None, month=None, konto=None, gegenkonto=None, belegfeld1=None, source=None):
+    conditions = []
+    params = []
+    if scope is not None:
+      condition, scope_params = scopeCondition(scope)
+      conditions.append(condition)
+      params += scope_params
+    for column, value in [("month", month), ("konto", konto), ("gegenkonto", gegenkonto),
+                          ("belegfeld1", belegfeld1), ("source", source)]:
+      if value is not None:
+        conditions.append("{} = ?".format(column))
+        params.append(str(value))
+    return self.db.execute("SELECT run_id, scope, source, date, fields FROM current_records{} ORDER BY id".format(
+      " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""), params)
+
+  def entries(self, **filters):
+    """
+    Current (source, record) entries in the order they were added, records
+    like the ones passed to append().
+    """
+    result = []
+    for _, _, source, date, fields in self.query(**filters):
+      record = {"date": datetime.fromisoformat(date)}
+      record.update(json.loads(fields))
+      result.append((source, record))
+    return result
+
+  def records(self, **filters):
+    return [record for _, record in self.entries(**filters)]
+
+  def recognitionRanges(self, scope=None):
+    """
+    Current (source, date, start, end, amount, text) recognition ranges, as
+    passed to append(), of one scope or a list of scopes.
+    """
+    def parse(value):
+      return datetime.fromisoformat(value).astimezone(config.accounting_tz)
+
+    condition, params = scopeCondition(scope) if scope is not None else (None, [])
+    return [(source, parse(date), parse(start), parse(end), decimal.Decimal(amount), text)
+            for source, date, start, end, amount, text in self.db.execute(
+              "SELECT source, date, start, end, amount, text FROM current_recognition_ranges{} ORDER BY id".format(
+                " WHERE " + condition if condition is not None else ""), params)]
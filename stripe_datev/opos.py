@@ -0,0 +1,122 @@
+import bisect
+from datetime import datetime, timedelta
+
+import stripe
+
+from . import config
+
+# Upper bounds of the aging buckets in days overdue, after "not due"
+default_buckets = [30, 60, 90]
+
+
+class FenwickTree(object):
+  """
+  Binary indexed tree of sums over positions 0..size-1, with point updates
+  and prefix sums in O(log size).
+  """
+
+  def __init__(self, size):
+    self.tree = [0] * (size + 1)
+
+  def add(self, idx, delta):
+    idx += 1
+    while idx < len(self.tree):
+      self.tree[idx] += delta
+      idx += idx & -idx
+
+  def prefixSum(self, end):
+    """
+    Sum of positions 0..end-1.
+    """
+    total = 0
+    while end > 0:
+      total += self.tree[end]
+      end -= end & -end
+    return total
+
+
+def listInvoices(fromTime, toTime):
+  return stripe.Invoice.list(
+    created={
+      "lte": int(toTime.timestamp()),
+      "gte": int(fromTime.timestamp()),
+    },
+    limit=100,
+  ).auto_paging_iter()
+
+
+def invoiceEvents(invoices, window=None):
+  """
+  Lifecycle events (time, +1/-1, amount, due date) of the invoices, sorted by
+  time: an invoice is open from its finalization until it is paid, voided or
+  marked uncollectible. With a window (e.g. datedelta.YEAR), it also stops
+  counting once it was created more than the window before, like the
+  invoices listed for a single date.
+  """
+  events = []
+  for invoice in invoices:
+    # Only the events are kept, not the invoices
+    transitions = invoice.status_transitions
+    finalized_at = transitions.get("finalized_at", None)
+    if finalized_at is None:
+      continue
+    due = invoice.due_date or invoice.created
+    events.append((finalized_at, 1, invoice.total, due))
+    closed_at = [at for at in [transitions.get("paid_at", None), transitions.get("voided_at", None),
+                               transitions.get("marked_uncollectible_at", None)] if at is not None]
+    if window is not None:
+      # Counted for dates up to the window after its creation
+      closed_at.append(int((datetime.fromtimestamp(invoice.created, config.accounting_tz) + window).timestamp()) + 1)
+    if len(closed_at) > 0:
+      events.append((max(finalized_at, min(closed_at)), -1, -invoice.total, due))
+  events.sort(key=lambda event: event[0])
+  return events
+
+
+def sweep(events, ref_dates, buckets=default_buckets):
+  """
+  Open invoice totals (in cents) as of the end of each of the ref_dates, in
+  one pass over the events. Returns per date the count and total of open
+  invoices, and their totals by days overdue: not due, up to buckets[0],
+  ..., more than buckets[-1].
+  """
+  dues = sorted(set(due for _, _, _, due in events))
+  amounts = FenwickTree(len(dues))
+
+  def dueUntil(timestamp):
+    return amounts.prefixSum(bisect.bisect_right(dues, timestamp))
+
+  results = []
+  idx = 0
+  total = 0
+  count = 0
+  for ref in sorted(ref_dates):
+    ref_ts = int(ref.timestamp())
+    while idx < len(events) and events[idx][0] <= ref_ts:
+      _, delta, amount, due = events[idx]
+      pos = bisect.bisect_left(dues, due)
+      amounts.add(pos, amount)
+      total += amount
+      count += delta
+      idx += 1
+
+    # Due at or before each bucket bound, from ref backwards
+    due_until = [dueUntil(ref_ts)] + [dueUntil(int((ref - timedelta(days=days)).timestamp())) for days in buckets]
+    aging = [total - due_until[0]] + [due_until[i] - due_until[i + 1] for i in range(len(buckets))] + [due_until[-1]]
+    results.append({
+      "date": ref,
+      "count": count,
+      "total": total,
+      "aging": aging,
+    })
+  return results
+
+
+def bucketNames(buckets=default_buckets):
+  names = ["not due"]
+  lower = 1
+  for upper in buckets:
+    names.append("{}-{}".format(lower, upper))
+    lower = upper + 1
+  names.append(">{}".format(buckets[-1]))
+  return names
@@ -1,5 +1,8 @@
 from datetime import datetime
-from . import config, customer
+from . import config, customer, checkpoint
+import csv
+import hashlib
+import operator
 import os
 
 fields = [
@@ -134,21 +137,52 @@ def filterRecords(records, fromTime=None, toTime=None):
 def writeRecords(fileName, records, fromTime=None, toTime=None, bezeichung=None):
   if len(records) == 0:
     return
-  with open(fileName, 'w', encoding="latin1", errors="replace", newline="\r\n") as fp:
+  with checkpoint.atomicOpen(fileName, 'w', encoding="latin1", errors="replace", newline="\r\n") as fp:
     printRecords(fp, records, fromTime=fromTime,
                  toTime=toTime, bezeichung=bezeichung)
     print("Wrote {} acc. records  to {}".format(
-      str(len(records)).rjust(4, " "), os.path.relpath(fp.name, os.getcwd())))
+      str(len(records)).rjust(4, " "), os.path.relpath(fileName, os.getcwd())))
+
+
+def readRecords(fileName):
+  """
+  Reads the records and Bezeichnung of a file written by writeRecords(). Dates
+  are only known to the day.
+  """
+  with open(fileName, "r", encoding="latin1", newline="") as fp:
+    rows = list(csv.reader(fp, delimiter=";"))
+  header, names = rows[0], rows[1]
+  year = int(header[12][:4])
+  records = []
+  for row in rows[2:]:
+    record = {name: value for name, value in zip(names, row) if value != ""}
+    record["date"] = config.accounting_tz.localize(
+      datetime(year, int(record["Belegdatum"][2:4]), int(record["Belegdatum"][0:2])))
+    records.append(record)
+  return records, header[16] or None
+
+
+def mergeRecords(fileName, records, bezeichung=None):
+  """
+  Adds records to an existing file written by writeRecords(), or creates it.
+  """
+  if os.path.exists(fileName):
+    existing, existing_bezeichnung = readRecords(fileName)
+    records = existing + records
+    bezeichung = existing_bezeichnung or bezeichung
+  writeRecords(fileName, records, bezeichung=bezeichung)
 
 
 def printRecords(textFileHandle, records, fromTime=None, toTime=None, bezeichung=None):
   if fromTime is not None or toTime is not None:
     records = filterRecords(records, fromTime, toTime)
 
-  minTime = fromTime or min([r["date"] for r in records])
-  maxTime = toTime or max([r["date"] for r in records])
-  years = set(r["date"].astimezone(config.accounting_tz).strftime("%Y")
-              for r in records)
+  # Records of one invoice or transaction share their date
+  dates = set(r["date"] for r in records)
+  minTime = fromTime or min(dates)
+  maxTime = toTime or max(dates)
+  years = set(d.astimezone(config.accounting_tz).strftime("%Y")
+              for d in dates)
   if len(years) > 1:
     raise Exception(
       "May not print records from multiple years: {}".format(years))
@@ -190,18 +224,65 @@ def printRecords(textFileHandle, records, fromTime=None, toTime=None, bezeichung
   textFileHandle.write(";".join(fields))
   textFileHandle.write("\n")
 
+  lines = []
   for record in records:
     record["Belegdatum"] = formatDateDatev(record["date"])
     record["Buchungstext"] = "\"{}\"".format(record["Buchungstext"][:60])
 
-    # print(record)
-    recordValues = [record.get(f, '') for f in fields]
-    textFileHandle.write(";".join(recordValues))
-    textFileHandle.write("\n")
+    template, values = recordTemplate(record)
+    lines.append(template % values(record))
+    if len(lines) >= 1000:
+      textFileHandle.write("\n".join(lines) + "\n")
+      lines = []
+  if len(lines) > 0:
+    textFileHandle.write("\n".join(lines) + "\n")
+
+
+# (Columns, keys of a record in insertion order) -> (row format, getter of
+# its values). Columns are the module level lists fields or fields_accounts.
+record_templates = {}
+
+
+def recordTemplate(record, columns=None):
+  """
+  Returns the row format of records with the keys of this one, with a "%s"
+  for each populated column and the runs of empty columns in between as
+  literal separators (e.g. "%s;%s;%s;;;;%s;%s;;%s;;;...;" for the usual ~12
+  of 121 fields), and a getter of the values to fill it with. None values
+  are written as empty fields, not as "None".
+  """
+  if columns is None:
+    columns = fields
+  key = (id(columns), tuple(record.keys()))
+  template = record_templates.get(key, None)
+  if template is None:
+    populated = [f for f in columns if f in record]
+    if len(populated) > 1:
+      getter = operator.itemgetter(*populated)
+    else:
+      def getter(r): return tuple(r[f] for f in populated)
+
+    def values(r):
+      values = getter(r)
+      if None in values:
+        return tuple("" if value is None else value for value in values)
+      return values
+    template = record_templates[key] = (";".join("%s" if f in record else "" for f in columns), values)
+  return template
+
+
+# Date -> Belegdatum
+datev_dates = {}
 
 
 def formatDateDatev(date):
-  return date.astimezone(config.accounting_tz).strftime("%d%m")
+  # Equal datetimes are the same instant, i.e. the same accounting date
+  formatted = datev_dates.get(date, None)
+  if formatted is None:
+    if len(datev_dates) >= 10000:
+      datev_dates.clear()
+    formatted = datev_dates[date] = date.astimezone(config.accounting_tz).strftime("%d%m")
+  return formatted
 
 
 def formatDateHuman(date):
@@ -209,7 +290,18 @@ def formatDateHuman(date):
 
 
 def formatDecimal(d):
-  return "{0:.2f}".format(d).replace(",", "").replace(".", ",")
+  return format(d, ".2f").replace(".", ",")
+
+
+def formatCents(cents):
+  """
+  Formats an integer amount in cents like formatDecimal(Decimal(cents) / 100).
+  """
+  if cents < 0:
+    digits = "%03d" % -cents
+    return "-" + digits[:-2] + "," + digits[-2:]
+  digits = "%03d" % cents
+  return digits[:-2] + "," + digits[-2:]
 
 
 fields_accounts = [
@@ -470,7 +562,13 @@ fields_accounts = [
 ]
 
 
-def printAccounts(textFileHandle, customers):
+def printAccounts(textFileHandle, customers, manifest=None, delta=False):
+  """
+  Writes the Debitoren/Kreditoren rows of the customers and returns their
+  number. If manifest (a dict, see customer.loadAccountsManifest) is given,
+  it is updated in place with a hash of each customer's row, and with delta,
+  only rows that are new or differ from the manifest are written.
+  """
   header = [
     '"EXTF"',  # DATEV-Format (DTVF - von DATEV erzeugt, EXTF Fremdprogramm)
     '700',  # Version des DATEV-Formats (141 bedeutet 1.41)
@@ -505,24 +603,43 @@ def printAccounts(textFileHandle, customers):
   textFileHandle.write(";".join(fields_accounts))
   textFileHandle.write("\n")
 
+  written = 0
+  lines = []
   for cus in customers:
-    acc_props = customer.getAccountingProps(cus)
-    vat_id = acc_props["vat_id"]
-
-    record = {
-      "Konto": acc_props["customer_account"],
-      "Name (Adressattyp Unternehmen)": customer.getCustomerName(cus),
-      "Adressattyp": "2",
-      "EU-Land": vat_id[:2] if vat_id is not None else "",
-      "EU-UStID": vat_id[2:] if vat_id is not None else "",
-      "Straße": cus.address.line1 or "",
-      "Adresszusatz": cus.address.line2 or "",
-      "Postleitzahl": cus.address.postal_code or "",
-      "Ort": cus.address.city or "",
-      "Land": cus.address.country or "",
-      "E-Mail": cus.email or "",
-    }
-
-    recordValues = [record.get(f, '') for f in fields_accounts]
-    textFileHandle.write(";".join(recordValues))
-    textFileHandle.write("\n")
+    record = accountRecord(cus)
+    template, values = recordTemplate(record, columns=fields_accounts)
+    line = template % values(record)
+
+    if manifest is not None:
+      row_hash = hashlib.sha256(line.encode("utf-8")).hexdigest()[:16]
+      if delta and manifest.get(cus.id, None) == row_hash:
+        continue
+      manifest[cus.id] = row_hash
+
+    lines.append(line)
+    written += 1
+    if len(lines) >= 1000:
+      textFileHandle.write("\n".join(lines) + "\n")
+      lines = []
+  if len(lines) > 0:
+    textFileHandle.write("\n".join(lines) + "\n")
+  return written
+
+
+def accountRecord(cus):
+  acc_props = customer.getAccountingProps(cus)
+  vat_id = acc_props["vat_id"]
+
+  return {
+    "Konto": acc_props["customer_account"],
+    "Name (Adressattyp Unternehmen)": customer.getCustomerName(cus),
+    "Adressattyp": "2",
+    "EU-Land": vat_id[:2] if vat_id is not None else "",
+    "EU-UStID": vat_id[2:] if vat_id is not None else "",
+    "Straße": cus.address.line1 or "",
+    "Adresszusatz": cus.address.line2 or "",
+    "Postleitzahl": cus.address.postal_code or "",
+    "Ort": cus.address.city or "",
+    "Land": cus.address.country or "",
+    "E-Mail": cus.email or "",
+  }
@@ -0,0 +1,275 @@
+"""
+Columnar export of the datasets of a download to Parquet, with typed columns
+(amounts in integer cents, timestamps, account numbers as integers) and
+partitioned by month: <out>/parquet/<dataset>/month=YYYY-MM/<period>.parquet.
+Requires pyarrow, which is only imported when writing.
+"""
+
+import decimal
+import glob
+import importlib.util
+import os
+from datetime import datetime, timezone
+
+from . import checkpoint, config, invoices, journal
+
+# Dataset -> [(column, type)], each row also has a "month" to partition by
+schemas = {
+  "invoices": [
+    ("invoice_id", "string"),
+    ("invoice_number", "string"),
+    ("status", "string"),
+    ("customer_id", "string"),
+    ("subscription_id", "string"),
+    ("created", "timestamp"),
+    ("finalized_at", "timestamp"),
+    ("due_date", "timestamp"),
+    ("paid_at", "timestamp"),
+    ("voided_at", "timestamp"),
+    ("marked_uncollectible_at", "timestamp"),
+    ("total", "cents"),
+    ("tax", "cents"),
+  ],
+  "revenue_items": [
+    ("id", "string"),
+    ("number", "string"),
+    ("created", "timestamp"),
+    ("customer_id", "string"),
+    ("country", "string"),
+    ("vat_region", "string"),
+    ("vat_id", "string"),
+    ("tax_exempt", "string"),
+    ("customer_account", "account"),
+    ("revenue_account", "account"),
+    ("amount_net", "cents"),
+    ("amount_with_tax", "cents"),
+    ("tax_percentage", "float"),
+    ("voided_at", "timestamp"),
+    ("marked_uncollectible_at", "timestamp"),
+    ("credited_at", "timestamp"),
+    ("credited_amount", "cents"),
+    ("is_subscription", "bool"),
+    ("line_items", "int"),
+  ],
+  "recognition": [
+    ("invoice_id", "string"),
+    ("invoice_number", "string"),
+    ("invoice_date", "timestamp"),
+    ("recognition_start", "timestamp"),
+    ("recognition_end", "timestamp"),
+    ("recognition_month", "timestamp"),
+    ("line_item_idx", "int"),
+    ("line_item_desc", "string"),
+    ("line_item_net", "cents"),
+    ("customer_id", "string"),
+    ("customer_name", "string"),
+    ("country", "string"),
+    ("accounting_date", "timestamp"),
+    ("revenue_type", "string"),
+    ("is_recurring", "bool"),
+  ],
+  "accounting_records": [
+    ("ledger", "string"),
+    ("source", "string"),
+    ("date", "timestamp"),
+    ("konto", "account"),
+    ("gegenkonto", "account"),
+    ("bu_schluessel", "string"),
+    ("umsatz", "cents"),
+    ("soll_haben", "string"),
+    ("belegfeld1", "string"),
+    ("buchungstext", "string"),
+    ("eu_land_ustid", "string"),
+  ],
+  "balance_transactions": [
+    ("id", "string"),
+    ("type", "string"),
+    ("reporting_category", "string"),
+    ("created", "timestamp"),
+    ("amount", "cents"),
+    ("fee", "cents"),
+    ("net", "cents"),
+    ("currency", "string"),
+    ("description", "string"),
+    ("source_id", "string"),
+  ],
+}
+
+
+def available():
+  return importlib.util.find_spec("pyarrow") is not None
+
+
+def fromTimestamp(timestamp):
+  return datetime.fromtimestamp(timestamp, timezone.utc) if timestamp is not None else None
+
+
+def cents(amount):
+  """
+  Integer cents of a decimal amount in EUR.
+  """
+  if amount is None:
+    return None
+  return int((decimal.Decimal(amount) * 100).quantize(decimal.Decimal(1)))
+
+
+def account(value):
+  return int(value) if value not in (None, "") else None
+
+
+def month(date):
+  return date.astimezone(config.accounting_tz).strftime("%Y-%m")
+
+
+def invoiceRows(invs):
+  rows = []
+  for invoice in invs:
+    transitions = invoice.status_transitions
+    finalized_at = fromTimestamp(transitions.get("finalized_at", None))
+    customer_id = invoice.customer if isinstance(invoice.customer, str) else invoice.customer.id
+    rows.append({
+      "month": month(finalized_at or fromTimestamp(invoice.created)),
+      "invoice_id": invoice.id,
+      "invoice_number": invoice.get("number", None),
+      "status": invoice.status,
+      "customer_id": customer_id,
+      "subscription_id": invoice.get("subscription", None),
+      "created": fromTimestamp(invoice.created),
+      "finalized_at": finalized_at,
+      "due_date": fromTimestamp(invoice.get("due_date", None)),
+      "paid_at": fromTimestamp(transitions.get("paid_at", None)),
+      "voided_at": fromTimestamp(transitions.get("voided_at", None)),
+      "marked_uncollectible_at": fromTimestamp(transitions.get("marked_uncollectible_at", None)),
+      "total": invoice.total,
+      "tax": invoice.get("tax", None),
+    })
+  return rows
+
+
+def revenueItemRows(revenue_items):
+  rows = []
+  for revenue_item in revenue_items:
+    props = revenue_item["accounting_props"]
+    rows.append({
+      "month": month(revenue_item["created"]),
+      "id": revenue_item["id"],
+      "number": revenue_item.get("number", None),
+      "created": revenue_item["created"],
+      "customer_id": revenue_item["customer"]["id"],
+      "country": props.get("country", None),
+      "vat_region": props.get("vat_region", None),
+      "vat_id": props.get("vat_id", None),
+      "tax_exempt": props.get("tax_exempt", None),
+      "customer_account": account(props.get("customer_account", None)),
+      "revenue_account": account(props.get("revenue_account", None)),
+      "amount_net": cents(revenue_item["amount_net"]),
+      "amount_with_tax": cents(revenue_item["amount_with_tax"]),
+      "tax_percentage": float(revenue_item["tax_percentage"]) if revenue_item.get("tax_percentage") is not None else None,
+      "voided_at": revenue_item.get("voided_at", None),
+      "marked_uncollectible_at": revenue_item.get("marked_uncollectible_at", None),
+      "credited_at": revenue_item.get("credited_at", None),
+      "credited_amount": cents(revenue_item.get("credited_amount", None)),
+      "is_subscription": revenue_item.get("is_subscription", False),
+      "line_items": len(revenue_item["line_items"]),
+    })
+  return rows
+
+
+def recognitionRows(revenue_items):
+  return [dict(row, month=month(row["recognition_month"]), line_item_net=cents(row["line_item_net"]))
+          for row in invoices.recognizedMonths(revenue_items)]
+
+
+def accountingRecordRows(ledger, entries):
+  rows = []
+  for source, record in entries:
+    rows.append({
+      "month": journal.accountingMonth(record["date"]),
+      "ledger": ledger,
+      "source": source,
+      "date": record["date"],
+      "konto": account(record.get("Konto", None)),
+      "gegenkonto": account(record.get("Gegenkonto (ohne BU-Schlüssel)", None)),
+      "bu_schluessel": record.get("BU-Schlüssel", None),
+      "umsatz": journal.cents(record["Umsatz (ohne Soll/Haben-Kz)"]),
+      "soll_haben": record.get("Soll/Haben-Kennzeichen", None),
+      "belegfeld1": record.get("Belegfeld 1", None),
+      "buchungstext": record.get("Buchungstext", None),
+      "eu_land_ustid": record.get("EU-Land u. UStID", None),
+    })
+  return rows
+
+
+def balanceTransactionRows(balance_transactions):
+  rows = []
+  for tx in balance_transactions:
+    source = tx.get("source", None)
+    rows.append({
+      "month": month(fromTimestamp(tx.created)),
+      "id": tx.id,
+      "type": tx.type,
+      "reporting_category": tx.get("reporting_category", None),
+      "created": fromTimestamp(tx.created),
+      "amount": tx.amount,
+      "fee": tx.fee,
+      "net": tx.net,
+      "currency": tx.currency,
+      "description": tx.get("description", None),
+      "source_id": source if source is None or isinstance(source, str) else source.get("id", None),
+    })
+  return rows
+
+
+def arrowType(name):
+  import pyarrow
+
+  return {
+    "string": pyarrow.string(),
+    "cents": pyarrow.int64(),
+    "account": pyarrow.int64(),
+    "int": pyarrow.int32(),
+    "float": pyarrow.float64(),
+    "bool": pyarrow.bool_(),
+    "timestamp": pyarrow.timestamp("s", tz="UTC"),
+  }[name]
+
+
+def toTable(dataset, rows):
+  import pyarrow
+
+  schema = pyarrow.schema([(column, arrowType(type)) for column, type in schemas[dataset]])
+  return pyarrow.table({column: pyarrow.array([row[column] for row in rows], type=schema.field(column).type)
+                        for column, _ in schemas[dataset]}, schema=schema)
+
+
+def writeTable(dataset, rows, fp):
+  import pyarrow.parquet
+
+  pyarrow.parquet.write_table(toTable(dataset, rows), fp)
+
+
+def writeDataset(root, dataset, rows, period):
+  """
+  Writes the rows of a download period (an accounting month) to one file per
+  month partition with writeTable(), replacing the period's files from
+  earlier runs. Returns the paths written.
+  """
+  if not available():
+    raise Exception("Parquet export requires pyarrow (pip install pyarrow)")
+
+  for path in glob.glob(os.path.join(root, dataset, "month=*", "{}.parquet".format(period))):
+    os.remove(path)
+
+  rows_by_month = {}
+  for row in rows:
+    rows_by_month.setdefault(row["month"], []).append(row)
+
+  paths = []
+  for partition, partition_rows in sorted(rows_by_month.items()):
+    partition_dir = os.path.join(root, dataset, "month={}".format(partition))
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, "{}.parquet".format(period))
+    with checkpoint.atomicOpen(path, "wb") as fp:
+      writeTable(dataset, partition_rows, fp)
+    paths.append(path)
+  return paths
@@ -0,0 +1,166 @@
+"""
+Pivot tables over the monthly recognition rows written by download, e.g.
+recurring revenue by month or revenue by VAT region, for a year or more at a
+time. The rows are loaded into columns once, each pivot is one grouped sum
+over them, vectorized with NumPy if it is installed.
+"""
+
+import csv
+import decimal
+import glob
+import os
+
+from . import customer
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+dimensions = ["recognition_month", "invoice_month", "timing", "customer_id", "country", "vat_region",
+              "revenue_type", "is_recurring"]
+
+# Name -> (rows, columns, only rows where column == value)
+reports = {
+  "mrr": ("recognition_month", "revenue_type", ("is_recurring", "true")),
+  "deferral": ("invoice_month", "timing", None),
+  "vat_region": ("recognition_month", "vat_region", None),
+  "country": ("recognition_month", "country", None),
+  "revenue_type": ("recognition_month", "revenue_type", None),
+  "customer": ("customer_id", "recognition_month", None),
+}
+
+
+def vatRegion(country):
+  if country == "DE":
+    return "DE"
+  if country in customer.country_codes_eu:
+    return "EU"
+  return "World"
+
+
+def recognitionFileName(year, month):
+  """
+  File name of the monthly recognition rows of a download of the month, or
+  with month 0 of the whole year.
+  """
+  if month == 0:
+    return "monthly_recognition-{:04d}.csv".format(year)
+  return "monthly_recognition-{:04d}-{:02d}.csv".format(year, month)
+
+
+def recognitionFiles(out_dir, years):
+  """
+  Per year the file of a download of the whole year or else the files of the
+  downloads of its months. Month files next to a year file have rows that are
+  in the year file as well, they are left out.
+  """
+  paths = []
+  for year in years:
+    year_path = os.path.join(out_dir, "monthly_recognition", recognitionFileName(year, 0))
+    month_paths = sorted(glob.glob(os.path.join(out_dir, "monthly_recognition", "monthly_recognition-{:04d}-*.csv".format(year))))
+    if os.path.exists(year_path):
+      if len(month_paths) > 0:
+        print("Warning: using {} instead of the {} month file(s) of {}".format(
+          os.path.basename(year_path), len(month_paths), year))
+      paths.append(year_path)
+    else:
+      paths += month_paths
+  return paths
+
+
+def readColumns(paths):
+  """
+  Columns of the recognition rows in the files: the dimensions as strings,
+  "amount" as integer cents.
+  """
+  columns = {name: [] for name in dimensions + ["amount"]}
+  for path in paths:
+    with open(path, "r", encoding="utf-8", newline="") as fp:
+      reader = csv.reader(fp)
+      header = next(reader, None)
+      if header is None:
+        continue
+      idx = {name: header.index(name) for name in ["invoice_date", "recognition_month", "line_item_net",
+                                                   "customer_id", "country", "revenue_type", "is_recurring"]}
+      for fields in reader:
+        if len(fields) == 0:
+          continue
+        recognition_month = fields[idx["recognition_month"]][:7]
+        invoice_month = fields[idx["invoice_date"]][:7]
+        country = fields[idx["country"]]
+        columns["recognition_month"].append(recognition_month)
+        columns["invoice_month"].append(invoice_month)
+        columns["timing"].append("deferred" if recognition_month > invoice_month else "recognized")
+        columns["customer_id"].append(fields[idx["customer_id"]])
+        columns["country"].append(country)
+        columns["vat_region"].append(vatRegion(country))
+        columns["revenue_type"].append(fields[idx["revenue_type"]])
+        columns["is_recurring"].append(fields[idx["is_recurring"]])
+        columns["amount"].append(int(decimal.Decimal(fields[idx["line_item_net"]]) * 100))
+
+  if numpy is not None:
+    columns = vectorize(columns)
+  return columns
+
+
+def vectorize(columns):
+  """
+  NumPy columns: each dimension as integer codes into its sorted labels in
+  columns["labels"], so that pivots don't compare strings.
+  """
+  vectorized = {"labels": {}}
+  for name, values in columns.items():
+    if name == "amount":
+      vectorized[name] = numpy.array(values, dtype=numpy.int64)
+    else:
+      vectorized["labels"][name], vectorized[name] = numpy.unique(numpy.array(values, dtype=str), return_inverse=True)
+  return vectorized
+
+
+def pivot(columns, rows, cols, where=None):
+  """
+  Sums of the amounts by the values of the rows and cols dimensions, as
+  (row labels, column labels, [[cents per column] per row]), labels sorted.
+  """
+  if "labels" in columns:
+    labels = columns["labels"]
+    row_codes, col_codes, amounts = columns[rows], columns[cols], columns["amount"]
+    if where is not None:
+      match = numpy.flatnonzero(labels[where[0]] == where[1])
+      mask = columns[where[0]] == (match[0] if len(match) > 0 else -1)
+      row_codes, col_codes, amounts = row_codes[mask], col_codes[mask], amounts[mask]
+    keys = row_codes * len(labels[cols]) + col_codes
+    size = len(labels[rows]) * len(labels[cols])
+    shape = (len(labels[rows]), len(labels[cols]))
+    # Weights are float64, exact for sums below 2^53 cents
+    sums = numpy.rint(numpy.bincount(keys, weights=amounts, minlength=size)).astype(numpy.int64).reshape(shape)
+    counts = numpy.bincount(keys, minlength=size).reshape(shape)
+    present_rows = counts.sum(axis=1) > 0
+    present_cols = counts.sum(axis=0) > 0
+    return (labels[rows][present_rows].tolist(), labels[cols][present_cols].tolist(),
+            sums[present_rows][:, present_cols].tolist())
+
+  sums = {}
+  for idx, amount in enumerate(columns["amount"]):
+    if where is not None and columns[where[0]][idx] != where[1]:
+      continue
+    key = (columns[rows][idx], columns[cols][idx])
+    sums[key] = sums.get(key, 0) + amount
+  row_labels = sorted(set(row for row, _ in sums))
+  col_labels = sorted(set(col for _, col in sums))
+  return row_labels, col_labels, [[sums.get((row, col), 0) for col in col_labels] for row in row_labels]
+
+
+def report(columns, name):
+  rows, cols, where = reports[name]
+  return pivot(columns, rows, cols, where=where)
+
+
+def toLines(rows, row_labels, col_labels, cells):
+  lines = [[rows] + [str(label) for label in col_labels] + ["total"]]
+  for label, row in zip(row_labels, cells):
+    lines.append([str(label)] + [format(decimal.Decimal(cents) / 100, ".2f") for cents in row + [sum(row)]])
+  totals = [sum(row[idx] for row in cells) for idx in range(len(col_labels))]
+  lines.append(["total"] + [format(decimal.Decimal(cents) / 100, ".2f") for cents in totals + [sum(totals)]])
+  return lines
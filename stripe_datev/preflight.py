@@ -0,0 +1,70 @@
+from . import customer
+
+
+def collectCustomers(invoices, charges):
+  """
+  Returns customer ID -> (all instances of the customer object, whether an
+  account number is required), e.g. an expanded customer per invoice.
+  """
+  customers = {}
+
+  def add(cus, require_account_number):
+    if cus is None:
+      return
+    if isinstance(cus, str):
+      cus = customer.retrieveCustomer(cus)
+    instances, required = customers.get(cus.id, ([], False))
+    instances.append(cus)
+    customers[cus.id] = (instances, required or require_account_number)
+
+  for invoice in invoices:
+    add(invoice.customer, customer.requiresAccountNumber(invoice))
+  for charge in charges:
+    add(charge.customer, True)
+  return customers
+
+
+def check(invoices, charges, fill_account_numbers=False, quarantine=False):
+  """
+  Validates the customers referenced by the invoices and charges before any
+  accounting records are created from them. Missing account numbers are
+  assigned if fill_account_numbers is set, any other issue aborts, or with
+  quarantine is returned as customer ID -> issues, for passed().
+  """
+  customers = collectCustomers(invoices, charges)
+
+  issues = {}
+  for id, (instances, require_account_number) in customers.items():
+    cus_issues = customer.validateCustomer(instances[0], require_account_number=require_account_number)
+    if len(cus_issues) > 0:
+      issues[id] = cus_issues
+
+  missing_account_number = [customers[id][0][0] for id, cus_issues in issues.items()
+                            if cus_issues == ["missing 'accountNumber' in metadata"]]
+  if fill_account_numbers and len(missing_account_number) > 0:
+    print("Assigning account numbers to {} customer(s)".format(len(missing_account_number)))
+    for id, account_number in customer.assignAccountNumbers(missing_account_number).items():
+      for instance in customers[id][0]:
+        instance.metadata["accountNumber"] = account_number
+      del issues[id]
+
+  for id, cus_issues in sorted(issues.items()):
+    for issue in cus_issues:
+      print("Preflight: customer {}: {}".format(id, issue))
+
+  print("Preflight checked {} customer(s), {} with issues".format(len(customers), len(issues)))
+  if len(issues) > 0 and not quarantine:
+    hint = " (run with --fill-account-numbers to assign missing account numbers)" if not fill_account_numbers else ""
+    raise Exception("Preflight failed for {} customer(s){}".format(len(issues), hint))
+  return issues
+
+
+def passed(obj, cus, issues):
+  """
+  Returns obj, or raises if its customer cus (object or ID) has issues, so
+  that it is quarantined.
+  """
+  id = cus if isinstance(cus, str) or cus is None else cus.id
+  if id in issues:
+    raise Exception("Preflight failed for customer {}: {}".format(id, "; ".join(issues[id])))
+  return obj
@@ -0,0 +1,248 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from . import httpclient
+
+lock = threading.Lock()
+phase_stack = []
+
+# name -> {"wall_s", "cpu_s", "calls"}
+phases = {}
+# endpoint -> list of latencies in seconds
+request_latencies = {}
+# endpoint -> number of responses by status code
+request_statuses = {}
+bytes_downloaded = 0
+# cache name -> {"hit", "miss"}
+caches = {}
+
+# Object IDs, as opposed to path segments like "balance_transactions"
+ID_REGEX = re.compile(r"^[a-z]+_(?=[0-9A-Za-z_]*[0-9A-Z])[0-9A-Za-z_]+$")
+
+
+@contextlib.contextmanager
+def phase(name):
+  """
+  Measures wall and CPU time of a phase, nested phases are reported as
+  "outer/inner".
+  """
+  phase_stack.append(name)
+  key = "/".join(phase_stack)
+  wall = time.perf_counter()
+  cpu = time.process_time()
+  try:
+    yield
+  finally:
+    entry = phases.setdefault(key, {"wall_s": 0, "cpu_s": 0, "calls": 0})
+    entry["wall_s"] += time.perf_counter() - wall
+    entry["cpu_s"] += time.process_time() - cpu
+    entry["calls"] += 1
+    phase_stack.pop()
+
+
+def countCache(name, hit):
+  entry = caches.setdefault(name, {"hit": 0, "miss": 0})
+  entry["hit" if hit else "miss"] += 1
+
+
+def endpointName(method, url):
+  path = httpclient.requestPath(url).split("?", 1)[0]
+  parts = ["{id}" if ID_REGEX.match(part) else part for part in path.split("/")]
+  return "{} {}".format(method.upper(), "/".join(parts))
+
+
+def recordRequest(method, url, latency, status, size):
+  global bytes_downloaded
+  endpoint = endpointName(method, url)
+  with lock:
+    request_latencies.setdefault(endpoint, []).append(latency)
+    statuses = request_statuses.setdefault(endpoint, {})
+    statuses[str(status)] = statuses.get(str(status), 0) + 1
+    bytes_downloaded += size
+
+
+class ProfilingHTTPClient(httpclient.WrappingHTTPClient):
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    started = time.perf_counter()
+    content, status, rheaders = super().request(method, url, headers, post_data)
+    recordRequest(method, url, time.perf_counter() - started, status, len(content or ""))
+    return content, status, rheaders
+
+
+def install():
+  return httpclient.install(ProfilingHTTPClient)
+
+
+def percentile(sorted_values, p):
+  if len(sorted_values) == 0:
+    return None
+  return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def maxRssBytes():
+  """
+  Peak resident set size of the process, None where the resource module
+  is not available (Windows).
+  """
+  try:
+    import resource
+  except ImportError:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux, bytes on macOS
+  return rss if sys.platform == "darwin" else rss * 1024
+
+
+def report():
+  endpoints = {}
+  for endpoint, latencies in sorted(request_latencies.items()):
+    latencies = sorted(latencies)
+    endpoints[endpoint] = {
+      "count": len(latencies),
+      "statuses": request_statuses[endpoint],
+      "total_s": sum(latencies),
+      "p50_s": percentile(latencies, 50),
+      "p90_s": percentile(latencies, 90),
+      "p99_s": percentile(latencies, 99),
+      "max_s": latencies[-1],
+    }
+
+  return {
+    "phases": phases,
+    "requests": {
+      "count": sum(e["count"] for e in endpoints.values()),
+      "bytes": bytes_downloaded,
+      "endpoints": endpoints,
+    },
+    "caches": {name: dict(entry, hit_rate=entry["hit"] / (entry["hit"] + entry["miss"]))
+               for name, entry in sorted(caches.items())},
+    "peak_rss_bytes": maxRssBytes(),
+  }
+
+
+def writeReport(path):
+  with open(path, "w", encoding="utf-8") as fp:
+    json.dump(report(), fp, indent=2)
+
+
+def frameLabel(code):
+  return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler(object):
+  """
+  Sampling profiler: records the stack of the calling thread every interval
+  seconds from a background thread, as collapsed stacks ("a;b;c" -> count).
+  """
+
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.stacks = {}
+    self.thread_id = threading.get_ident()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.sample, daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+
+  def sample(self):
+    while not self.stopped.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id, None)
+      stack = []
+      while frame is not None:
+        stack.append(frameLabel(frame.f_code))
+        frame = frame.f_back
+      if len(stack) > 0:
+        key = ";".join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+  def collapsed(self):
+    return self.stacks
+
+
+def cProfileCollapsed(profiler):
+  """
+  cProfile only records caller/callee pairs, not full stacks: returns
+  "caller;callee" -> own time in microseconds for each pair.
+  """
+  stats = pstats.Stats(profiler).stats
+  stacks = {}
+  for (filename, line, name), (_, _, _, _, callers) in stats.items():
+    callee = "{} ({}:{})".format(name, os.path.basename(filename), line)
+    for (caller_filename, caller_line, caller_name), (_, _, tt, _) in callers.items():
+      caller = "{} ({}:{})".format(caller_name, os.path.basename(caller_filename), caller_line)
+      key = "{};{}".format(caller, callee)
+      stacks[key] = stacks.get(key, 0) + int(tt * 1e6)
+  return {key: value for key, value in stacks.items() if value > 0}
+
+
+def writeCollapsed(path, stacks):
+  with open(path, "w", encoding="utf-8") as fp:
+    for key, value in sorted(stacks.items()):
+      fp.write("{} {}\n".format(key, value))
+
+
+def writeAllocations(path, snapshot, peak, top=25):
+  with open(path, "w", encoding="utf-8") as fp:
+    fp.write("Peak traced memory: {:.1f} MB\n\n".format(peak / 2**20))
+    fp.write("Top {} allocation sites by size:\n".format(top))
+    for stat in snapshot.statistics("lineno")[:top]:
+      fp.write("{}\n".format(stat))
+    fp.write("\nTop {} allocation tracebacks by size:\n".format(min(top, 10)))
+    for stat in snapshot.statistics("traceback")[:min(top, 10)]:
+      fp.write("\n{:.1f} KiB in {} blocks\n".format(stat.size / 1024, stat.count))
+      for line in stat.traceback.format():
+        fp.write("{}\n".format(line))
+
+
+@contextlib.contextmanager
+def profiler(kind, out_prefix, trace_memory=False, top=25):
+  """
+  Runs the block under cProfile ("cprofile") or the sampling profiler
+  ("sample") and optionally tracemalloc, writing <out_prefix>.collapsed
+  (flamegraph.pl / speedscope input), <out_prefix>.pstats (cProfile only)
+  and <out_prefix>.allocations.txt (tracemalloc).
+  """
+  written = []
+  if trace_memory:
+    tracemalloc.start(25)
+  if kind == "cprofile":
+    prof = cProfile.Profile()
+    prof.enable()
+  elif kind == "sample":
+    prof = Sampler()
+    prof.start()
+  else:
+    prof = None
+
+  try:
+    yield written
+  finally:
+    if kind == "cprofile":
+      prof.disable()
+      prof.dump_stats(out_prefix + ".pstats")
+      writeCollapsed(out_prefix + ".collapsed", cProfileCollapsed(prof))
+      written += [out_prefix + ".pstats", out_prefix + ".collapsed"]
+    elif kind == "sample":
+      prof.stop()
+      writeCollapsed(out_prefix + ".collapsed", prof.collapsed())
+      written.append(out_prefix + ".collapsed")
+    if trace_memory:
+      snapshot = tracemalloc.take_snapshot()
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      writeAllocations(out_prefix + ".allocations.txt", snapshot, peak, top=top)
+      written.append(out_prefix + ".allocations.txt")
@@ -0,0 +1,247 @@
+"""
+Compact, immutable records of the Stripe objects the pipeline works on,
+holding only the fields it reads. Stripe objects are projected right after
+they are fetched, the full responses are not kept.
+
+Projections support the access patterns of Stripe objects (`obj.field`,
+`obj["field"]`, `obj.get("field")`, `"field" in obj`), fields missing from
+the Stripe object are missing from the projection as well.
+"""
+
+# Customers shared by invoices and charges are projected once per ID
+customers_interned = {}
+
+
+class Projection(object):
+  __slots__ = ()
+  # Field name -> function projecting its value
+  nested = {}
+
+  def __init__(self, values):
+    for name, value in values.items():
+      object.__setattr__(self, name, value)
+
+  @classmethod
+  def project(cls, obj):
+    if obj is None or isinstance(obj, (str, Projection)):
+      return obj
+    values = {}
+    for name in cls.__slots__:
+      if name in obj:
+        value = obj[name]
+        values[name] = cls.nested[name](value) if name in cls.nested and value is not None else value
+    return cls(values)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("{} is immutable".format(type(self).__name__))
+
+  def __delattr__(self, name):
+    raise AttributeError("{} is immutable".format(type(self).__name__))
+
+  def __getitem__(self, name):
+    try:
+      return getattr(self, name)
+    except AttributeError:
+      raise KeyError(name)
+
+  def __contains__(self, name):
+    return hasattr(self, name)
+
+  def get(self, name, default=None):
+    return getattr(self, name, default)
+
+  def toDict(self):
+    return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+  def __repr__(self):
+    return "<{} {}>".format(type(self).__name__, getattr(self, "id", ""))
+
+
+def plain(value):
+  """
+  Nested Stripe object only accessed by key, as a dict.
+  """
+  return dict(value)
+
+
+def tupleOf(project):
+  return lambda values: tuple(project(value) for value in values)
+
+
+class List(Projection):
+  """
+  Fully paginated list, iterates over its data like a Stripe list object.
+  """
+  __slots__ = ("object", "data", "has_more", "url")
+
+  @classmethod
+  def of(cls, project_item):
+    def projectList(obj):
+      items = obj.list().auto_paging_iter() if obj.has_more else obj.data
+      return cls({"object": "list", "data": tuple(project_item(item) for item in items), "has_more": False,
+                  "url": obj.get("url", None)})
+    return projectList
+
+  def __iter__(self):
+    return iter(self.data)
+
+  def __len__(self):
+    return len(self.data)
+
+
+class Address(Projection):
+  __slots__ = ("city", "country", "line1", "line2", "postal_code", "state")
+
+
+class Shipping(Projection):
+  __slots__ = ("address", "name")
+  nested = {"address": Address.project}
+
+
+class TaxIdVerification(Projection):
+  __slots__ = ("status",)
+
+
+class TaxId(Projection):
+  __slots__ = ("id", "object", "type", "value", "verification")
+  nested = {"verification": TaxIdVerification.project}
+
+
+class Customer(Projection):
+  __slots__ = ("id", "object", "created", "deleted", "name", "description", "email", "metadata",
+               "address", "shipping", "tax_exempt", "tax_ids")
+  nested = {
+    "metadata": plain,
+    "address": Address.project,
+    "shipping": Shipping.project,
+    "tax_ids": List.of(TaxId.project),
+  }
+
+
+def customer(obj):
+  """
+  Projection of a customer, interned by ID: a customer expanded on many
+  invoices and charges is kept once. A projection with the customer's tax IDs
+  expanded replaces one without.
+  """
+  if obj is None or isinstance(obj, (str, Customer)):
+    return obj
+  interned = customers_interned.get(obj["id"], None)
+  if interned is not None and ("tax_ids" in interned or "tax_ids" not in obj):
+    return interned
+  projected = Customer.project(obj)
+  customers_interned[projected.id] = projected
+  return projected
+
+
+class StatusTransitions(Projection):
+  __slots__ = ("finalized_at", "marked_uncollectible_at", "paid_at", "voided_at")
+
+
+class LineItem(Projection):
+  __slots__ = ("id", "object", "amount", "description", "period", "discount_amounts", "tax_amounts")
+  nested = {
+    "period": plain,
+    "discount_amounts": tupleOf(plain),
+    "tax_amounts": tupleOf(plain),
+  }
+
+
+class Invoice(Projection):
+  __slots__ = ("id", "object", "number", "status", "created", "due_date", "customer", "customer_tax_exempt",
+               "automatic_tax", "metadata", "status_transitions", "subscription", "total", "tax", "tax_percent",
+               "total_tax_amounts", "post_payment_credit_notes_amount", "invoice_pdf", "lines")
+  nested = {
+    "customer": customer,
+    "automatic_tax": plain,
+    "metadata": plain,
+    "status_transitions": StatusTransitions.project,
+    "total_tax_amounts": tupleOf(plain),
+    "lines": List.of(LineItem.project),
+  }
+
+
+class Refund(Projection):
+  __slots__ = ("id", "object", "amount", "charge")
+
+
+class Charge(Projection):
+  __slots__ = ("id", "object", "amount", "application_fee_amount", "created", "customer", "description",
+               "invoice", "payment_intent", "receipt_number", "receipt_url", "refunded", "refunds")
+  nested = {
+    "customer": customer,
+    "invoice": Invoice.project,
+    "refunds": List.of(Refund.project),
+  }
+
+
+Refund.nested = {"charge": Charge.project}
+
+
+class Payout(Projection):
+  __slots__ = ("id", "object", "amount")
+
+
+class Account(Projection):
+  __slots__ = ("id", "object", "metadata")
+  nested = {"metadata": plain}
+
+
+class Transfer(Projection):
+  __slots__ = ("id", "object", "amount", "destination", "destination_payment", "source_transaction")
+  nested = {
+    "destination": Account.project,
+    "destination_payment": Charge.project,
+    "source_transaction": Charge.project,
+  }
+
+
+def source(obj):
+  """
+  Projection of a balance transaction source, other types of sources are
+  kept as they are.
+  """
+  project = sources.get(obj.get("object", None), None) if not isinstance(obj, str) else None
+  return project(obj) if project is not None else obj
+
+
+sources = {
+  "charge": Charge.project,
+  "refund": Refund.project,
+  "payout": Payout.project,
+  "transfer": Transfer.project,
+}
+
+
+class FeeDetail(Projection):
+  __slots__ = ("amount", "currency", "description", "type")
+
+
+class BalanceTransaction(Projection):
+  __slots__ = ("id", "object", "type", "reporting_category", "created", "amount", "fee", "net", "currency",
+               "description", "fee_details", "source")
+  nested = {
+    "fee_details": tupleOf(FeeDetail.project),
+    "source": source,
+  }
+
+
+def invoice(obj):
+  return Invoice.project(obj)
+
+
+def charge(obj):
+  return Charge.project(obj)
+
+
+def balanceTransaction(obj):
+  return BalanceTransaction.project(obj)
+
+
+def jsonDefault(obj):
+  """
+  json.dumps() default for projections, e.g. to fingerprint them.
+  """
+  if isinstance(obj, Projection):
+    return obj.toDict()
+  return str(obj)
@@ -0,0 +1,53 @@
+import itertools
+import json
+import traceback
+
+from . import checkpoint
+
+
+class Quarantine(object):
+  """
+  Applies a processing step to one object at a time. If enabled, objects
+  for which it fails are quarantined with the error and left out, instead of
+  aborting the run.
+  """
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.errors = []
+
+  def apply(self, stage, fn, items, id=lambda item: item.id):
+    results = []
+    for item in items:
+      if not self.enabled:
+        results.append(fn(item))
+        continue
+      try:
+        results.append(fn(item))
+      except Exception as e:
+        print("Warning: quarantined {} in {}: {}: {}".format(id(item), stage, type(e).__name__, e))
+        self.errors.append({
+          "id": id(item),
+          "stage": stage,
+          "error": "{}: {}".format(type(e).__name__, e),
+          "traceback": traceback.format_exc(),
+        })
+    return results
+
+  def applyFlat(self, stage, fn, items, id=lambda item: item.id):
+    """
+    Like apply() for steps that return a list per object.
+    """
+    return list(itertools.chain.from_iterable(self.apply(stage, fn, items, id=id)))
+
+  def ids(self, stage=None):
+    return set(error["id"] for error in self.errors if stage is None or error["stage"] == stage)
+
+  def writeReport(self, path, **context):
+    with checkpoint.atomicOpen(path, "w", encoding="utf-8") as fp:
+      json.dump(dict(context, errors=self.errors), fp, indent=2)
+
+
+def readReport(path):
+  with open(path, "r", encoding="utf-8") as fp:
+    return json.load(fp)
@@ -0,0 +1,234 @@
+import csv
+import decimal
+import io
+import time
+from datetime import datetime, timezone
+
+import stripe
+
+from . import balance, httpclient, invoices, projections
+
+report_type = "balance_change_from_activity.itemized.3"
+columns = [
+  "balance_transaction_id",
+  "created_utc",
+  "currency",
+  "gross",
+  "fee",
+  "net",
+  "reporting_category",
+  "source_id",
+  "description",
+  "customer_facing_amount",
+  "customer_facing_currency",
+  "customer_id",
+  "charge_id",
+  "invoice_id",
+]
+
+types_by_reporting_category = {
+  "refund": "refund",
+  "payout": "payout",
+  "fee": "stripe_fee",
+  "contribution": "contribution",
+  "transfer": "transfer",
+}
+
+
+class LazyObject(dict):
+  """
+  Stripe object of which only some fields are known. Accessing any other field
+  loads the full object once, with load().
+  """
+
+  def __init__(self, fields, load):
+    super().__init__(fields)
+    self._load = load
+    self._loaded = None
+
+  def loaded(self):
+    if self._loaded is None:
+      self._loaded = self._load()
+    return self._loaded
+
+  def __missing__(self, key):
+    return self.loaded()[key]
+
+  def __getattr__(self, name):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    try:
+      return self[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def get(self, key, default=None):
+    if key in self:
+      return dict.__getitem__(self, key)
+    return self.loaded().get(key, default)
+
+
+def toCents(value):
+  return int(decimal.Decimal(value) * 100)
+
+
+def parseUtc(value):
+  return int(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+
+def dataAvailableEnd():
+  return stripe.reporting.ReportType.retrieve(report_type).data_available_end
+
+
+def runReport(fromTime, toTime, poll_interval=2, timeout=60 * 60):
+  """
+  Runs the itemized balance change report for [fromTime, toTime) and returns
+  the URL of the resulting CSV file.
+  """
+  report_run = stripe.reporting.ReportRun.create(
+    report_type=report_type,
+    parameters={
+      "interval_start": int(fromTime.timestamp()),
+      "interval_end": int(toTime.timestamp()),
+      "columns": columns,
+    },
+  )
+  print("Requested report run {}".format(report_run.id))
+  started = time.monotonic()
+  while report_run.status == "pending":
+    if time.monotonic() - started > timeout:
+      raise Exception("Report run {} did not finish within {} seconds".format(report_run.id, timeout))
+    time.sleep(poll_interval)
+    poll_interval = min(poll_interval * 1.5, 30)
+    report_run = stripe.reporting.ReportRun.retrieve(report_run.id)
+  if report_run.status != "succeeded":
+    raise Exception("Report run {} {}: {}".format(report_run.id, report_run.status, report_run.get("error", None)))
+  return report_run.result.url
+
+
+def downloadReport(url):
+  content, status, _ = httpclient.currentClient().request_with_retries(
+    "get", url, {"Authorization": "Bearer {}".format(stripe.api_key)})
+  if isinstance(content, bytes):
+    content = content.decode("utf-8")
+  if status != 200:
+    raise Exception("Downloading report {} failed with HTTP status {}".format(url, status))
+  return list(csv.DictReader(io.StringIO(content)))
+
+
+class BalanceReport(object):
+  """
+  Maps the rows of the report into balance transactions for
+  balance.createAccountingRecords(). Fields the report lacks are loaded only
+  for the rows that need them: charges (with the fee details of their balance
+  transactions) by listing the charges created between the first and the last
+  charge row once, charges outside of that by retrieving them, anything else
+  by retrieving the expanded balance transaction.
+  """
+
+  def __init__(self, rows, fromTime, toTime):
+    self.rows = rows
+    self.fromTime = fromTime
+    self.toTime = toTime
+    self.charges = None
+    self.fee_details = {}
+
+  def addCharge(self, charge):
+    self.charges[charge.id] = projections.charge(charge)
+    if isinstance(charge.get("balance_transaction", None), stripe.BalanceTransaction):
+      self.fee_details[charge.balance_transaction.id] = projections.balanceTransaction(
+        charge.balance_transaction).fee_details
+
+  def loadCharges(self):
+    self.charges = {}
+    created = [parseUtc(row["created_utc"]) for row in self.rows if row["reporting_category"] == "charge"]
+    if len(created) == 0:
+      return
+    for charge in stripe.Charge.list(created={"gte": min(created), "lte": max(created)},
+                                     expand=["data.balance_transaction"], limit=100).auto_paging_iter():
+      self.addCharge(charge)
+
+  def charge(self, id):
+    if self.charges is None:
+      self.loadCharges()
+    if id not in self.charges:
+      self.addCharge(stripe.Charge.retrieve(id, expand=["balance_transaction"]))
+    return self.charges[id]
+
+  def feeDetails(self, row):
+    id = row["balance_transaction_id"]
+    # Without a fee there are no fee details
+    if toCents(row["fee"]) == 0:
+      return ()
+    if id not in self.fee_details:
+      self.charge(row["source_id"])
+    if id not in self.fee_details:
+      self.fee_details[id] = balance.retrieveBalanceTransaction(id).fee_details
+    return self.fee_details[id]
+
+  def invoice(self, id):
+    if not id:
+      return None
+    return LazyObject({"id": id}, lambda: invoices.retrieveInvoice(id))
+
+  def chargeObject(self, row, id):
+    fields = {
+      "id": id,
+      "object": "charge",
+      "customer": row["customer_id"] or None,
+      "invoice": self.invoice(row["invoice_id"]),
+    }
+    if row["customer_facing_currency"] == row["currency"] and row["customer_facing_amount"]:
+      fields["amount"] = toCents(row["customer_facing_amount"])
+    return LazyObject(fields, lambda: self.charge(id))
+
+  def transaction(self, row):
+    id = row["balance_transaction_id"]
+    category = row["reporting_category"]
+    fields = {
+      "id": id,
+      "object": "balance_transaction",
+      "created": parseUtc(row["created_utc"]),
+      "currency": row["currency"],
+      "amount": toCents(row["gross"]),
+      "fee": toCents(row["fee"]),
+      "net": toCents(row["net"]),
+      "reporting_category": category,
+      "description": row["description"] or None,
+    }
+
+    if category == "charge":
+      fields["type"] = "payment" if row["source_id"].startswith("py_") else "charge"
+      fields["source"] = self.chargeObject(row, row["source_id"])
+      fields["fee_details"] = self.feeDetails(row)
+    elif category == "refund" and row["charge_id"]:
+      fields["type"] = "refund"
+      fields["source"] = LazyObject({"id": row["source_id"], "charge": self.chargeObject(row, row["charge_id"])},
+                                    lambda: balance.retrieveBalanceTransaction(id).source)
+    elif category in ["payout", "fee", "contribution"]:
+      fields["type"] = types_by_reporting_category[category]
+      fields["source"] = LazyObject({"id": row["source_id"]},
+                                    lambda: balance.retrieveBalanceTransaction(id).source) if row["source_id"] else None
+    return LazyObject(fields, lambda: balance.retrieveBalanceTransaction(id))
+
+  def transactions(self):
+    # Newest first, like the list API
+    rows = sorted(self.rows, key=lambda row: (row["created_utc"], row["balance_transaction_id"]), reverse=True)
+    return [self.transaction(row) for row in rows]
+
+
+def listBalanceTransactions(fromTime, toTime):
+  """
+  Balance transactions of [fromTime, toTime) from one report run instead of
+  paginating the list API, falls back to the list API for periods the
+  report has no data for yet.
+  """
+  available_end = dataAvailableEnd()
+  if available_end < int(toTime.timestamp()):
+    print("Warning: report data is only available until {}, listing balance transactions instead".format(
+      datetime.fromtimestamp(available_end, timezone.utc).isoformat()))
+    return balance.listBalanceTransactions(fromTime, toTime)
+
+  rows = downloadReport(runReport(fromTime, toTime))
+  print("Downloaded report with {} row(s)".format(len(rows)))
+  return iter(BalanceReport(rows, fromTime, toTime).transactions())
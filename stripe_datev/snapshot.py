@@ -0,0 +1,133 @@
+import gzip
+import json
+import threading
+from datetime import datetime
+
+import stripe
+from requests.structures import CaseInsensitiveDict
+
+from . import httpclient
+
+# Response headers worth keeping, all others are dropped from snapshots
+kept_headers = ["content-type", "request-id", "stripe-version"]
+
+
+def requestKey(method, url, post_data):
+  return "{} {} {}".format(method.upper(), httpclient.requestPath(url), post_data or "")
+
+
+def durable(status):
+  """
+  Whether a response is the result of a request, rather than rate limiting or
+  a server error that is retried.
+  """
+  return status < 500 and status != 429
+
+
+def snapshotFileName(command):
+  return "{}-{}.jsonl.gz".format(command, datetime.now().strftime("%Y%m%d-%H%M%S"))
+
+
+def readSnapshot(path):
+  """
+  Returns recorded responses by request key, in the order they were recorded.
+  Rate limited attempts and server errors recorded by earlier versions are
+  skipped.
+  """
+  responses = {}
+  with gzip.open(path, "rt", encoding="utf-8") as fp:
+    try:
+      for line in fp:
+        # A run that was interrupted may have left a partial last line
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          break
+        if durable(entry["status"]):
+          responses.setdefault(entry["key"], []).append(entry)
+    except EOFError:
+      # ... or a truncated gzip stream
+      pass
+  return responses
+
+
+class RecordingHTTPClient(httpclient.WrappingHTTPClient):
+  """
+  Appends every response received from Stripe to a gzip compressed JSON lines
+  file, one line per request. Rate limited attempts and server errors are not
+  recorded, they are retried by the client.RateLimitedHTTPClient outside.
+  """
+
+  def __init__(self, inner, path):
+    super().__init__(inner)
+    self.path = path
+    self.fp = gzip.open(path, "at", encoding="utf-8")
+    # Requests may be sent concurrently, see client.map()
+    self.lock = threading.Lock()
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    content, status, rheaders = super().request(method, url, headers, post_data)
+    if durable(status):
+      self.record(method, url, post_data, content, status, rheaders)
+    return content, status, rheaders
+
+  def record(self, method, url, post_data, content, status, rheaders):
+    if isinstance(content, bytes):
+      content = content.decode("utf-8")
+    line = json.dumps({
+      "key": requestKey(method, url, post_data),
+      "status": status,
+      "headers": {k.lower(): v for k, v in rheaders.items() if k.lower() in kept_headers},
+      "body": content,
+    }) + "\n"
+    with self.lock:
+      self.fp.write(line)
+      self.fp.flush()
+
+  def close(self):
+    self.fp.close()
+    super().close()
+
+
+class ReplayHTTPClient(httpclient.WrappingHTTPClient):
+  """
+  Serves responses from a snapshot written by RecordingHTTPClient. Identical
+  requests are answered in the order they were recorded, the last response is
+  repeated if a request is sent more often than during recording.
+
+  Requests missing from the snapshot are sent to the wrapped client, or fail
+  if there is none.
+  """
+
+  def __init__(self, inner, path):
+    super().__init__(inner)
+    self.responses = readSnapshot(path)
+    self.served = {}
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    key = requestKey(method, url, post_data)
+    entries = self.responses.get(key, None)
+    if not entries:
+      if self.inner is None:
+        raise stripe.APIConnectionError(
+          "Request not found in snapshot: {}".format(key), should_retry=False)
+      return super().request(method, url, headers, post_data)
+
+    idx = self.served.get(key, 0)
+    self.served[key] = idx + 1
+    entry = entries[min(idx, len(entries) - 1)]
+    return entry["body"], entry["status"], CaseInsensitiveDict(entry["headers"])
+
+  def request_stream(self, method, url, headers, post_data=None, *, _usage=None):
+    raise stripe.APIConnectionError(
+      "Streaming requests cannot be replayed", should_retry=False)
+
+
+def record(path):
+  return httpclient.install(lambda inner: RecordingHTTPClient(inner, path))
+
+
+def replay(path):
+  stripe.max_network_retries = 0
+  stripe.default_http_client = ReplayHTTPClient(None, path)
+  return stripe.default_http_client
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import time
+
+import stripe
+
+from . import checkpoint, config, projections
+
+code_fingerprint = None
+
+# Stripe keeps events for 30 days
+events_retention = 30 * 24 * 60 * 60
+
+
+def codeFingerprint():
+  """
+  Hash of the configuration and of this package's source, a change to either
+  may change all outputs.
+  """
+  global code_fingerprint
+  if code_fingerprint is None:
+    h = hashlib.sha256()
+    h.update(json.dumps(config.config, sort_keys=True, default=str).encode("utf-8"))
+    package_dir = os.path.dirname(os.path.realpath(__file__))
+    for name in sorted(os.listdir(package_dir)):
+      if name.endswith(".py"):
+        with open(os.path.join(package_dir, name), "rb") as fp:
+          h.update(name.encode("utf-8"))
+          h.update(fp.read())
+    code_fingerprint = h.hexdigest()
+  return code_fingerprint
+
+
+def fingerprint(*objects):
+  """
+  Hash of Stripe objects or lists of them. Stripe objects have no `updated`
+  timestamp, so their full content (including expanded objects) is hashed.
+  """
+  h = hashlib.sha256(codeFingerprint().encode("utf-8"))
+  for obj in objects:
+    if isinstance(obj, list):
+      h.update(str(len(obj)).encode("utf-8"))
+      for item in obj:
+        h.update(json.dumps(item, sort_keys=True, separators=(",", ":"),
+                            default=projections.jsonDefault).encode("utf-8"))
+    else:
+      h.update(json.dumps(obj, sort_keys=True, separators=(",", ":"), default=projections.jsonDefault).encode("utf-8"))
+  return h.hexdigest()
+
+
+def changedSince(since, toTime):
+  """
+  Whether objects created before toTime, i.e. possible inputs of a period
+  ending then, may have changed since the given time, according to the
+  events since then. Changes from before Stripe's event retention are
+  assumed.
+  """
+  if since < time.time() - events_retention:
+    return True
+  for event in stripe.Event.list(created={"gte": since}, limit=100).auto_paging_iter():
+    created = event["data"]["object"].get("created", None)
+    if created is None or created < toTime:
+      return True
+  return False
+
+
+def fileHash(path):
+  h = hashlib.sha256()
+  with open(path, "rb") as fp:
+    for chunk in iter(lambda: fp.read(1 << 16), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class Manifest(object):
+  """
+  Input fingerprint and output file hashes of each stage of a run. A stage is
+  up to date if its inputs are unchanged and all of its outputs still exist
+  unmodified, like in an incremental build. A stage may keep JSON data, e.g.
+  results that are not written to a file.
+  """
+
+  def __init__(self, path, base_dir, force=False):
+    self.path = path
+    self.base_dir = base_dir
+    self.stages = {}
+    if not force and os.path.exists(path):
+      with open(path, "r", encoding="utf-8") as fp:
+        self.stages = json.load(fp)
+
+  def upToDate(self, stage, inputs):
+    entry = self.stages.get(stage, None)
+    if entry is None or entry["inputs"] != inputs:
+      return False
+    for path, output_hash in entry["outputs"].items():
+      path = os.path.join(self.base_dir, path)
+      if not os.path.exists(path) or fileHash(path) != output_hash:
+        return False
+    return True
+
+  def data(self, stage):
+    return self.stages.get(stage, {}).get("data", None)
+
+  def unchangedSinceFetch(self, inputs, stages, toTime):
+    """
+    Whether the stages are up to date without fetching their inputs again:
+    the last fetch, recorded as stage "fetch" with its time, completed all of
+    them, their outputs are unmodified and the events since show no change
+    to objects of the period.
+    """
+    entry = self.stages.get("fetch", None)
+    if entry is None or entry["inputs"] != inputs:
+      return False
+    if not all(stage in self.stages and self.upToDate(stage, self.stages[stage]["inputs"]) for stage in stages):
+      return False
+    return not changedSince(entry["data"]["fetched_at"], int(toTime.timestamp()))
+
+  def record(self, stage, inputs, outputs, data=None):
+    self.stages[stage] = {
+      "inputs": inputs,
+      "outputs": {os.path.relpath(path, self.base_dir): fileHash(path) for path in outputs if os.path.exists(path)},
+    }
+    if data is not None:
+      self.stages[stage]["data"] = data
+    self.save()
+
+  def forget(self, stage):
+    if self.stages.pop(stage, None) is not None:
+      self.save()
+
+  def save(self):
+    with checkpoint.atomicOpen(self.path, "w", encoding="utf-8") as fp:
+      json.dump(self.stages, fp, indent=2)
@@ -0,0 +1,170 @@
+"""
+Incremental validation of the customers: the first run lists all customers
+in parallel slices of their creation time, later runs only validate the
+customers created since the last successful run and those changed since
+according to Stripe's events. The outstanding issues of all customers are
+kept in a state file and written to a report grouped by issue type.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import stripe
+
+from . import checkpoint, client, customer
+
+# Stripe keeps events for 30 days, older runs require a full validation
+events_retention = timedelta(days=30)
+
+event_types = [
+  "customer.updated",
+  "customer.deleted",
+  "customer.tax_id.created",
+  "customer.tax_id.updated",
+  "customer.tax_id.deleted",
+]
+
+
+def loadState(path):
+  if not os.path.exists(path):
+    return {}
+  with open(path, "r", encoding="utf-8") as fp:
+    return json.load(fp)
+
+
+def saveState(path, state):
+  with checkpoint.atomicOpen(path, "w", encoding="utf-8") as fp:
+    json.dump(state, fp, indent=2, sort_keys=True)
+
+
+def customerIssues(cus):
+  """
+  The issues of customer.customerIssues(), and warnings about the tax status.
+  """
+  issues = customer.customerIssues(cus)
+  if cus.get("deleted", False):
+    return issues
+
+  if cus.tax_exempt == "exempt":
+    issues.append(("tax_exempt", "exempt customer, invoices are treated like 'reverse'"))
+
+  address = cus.address or (cus.shipping.address if cus.get("shipping", None) else None)
+  country = address.country if address else None
+  if country == "DE" and cus.tax_exempt != "none":
+    issues.append(("de_not_taxable", "DE customer tax status is {}".format(cus.tax_exempt)))
+  if country in customer.country_codes_eu and country != "DE" and cus.tax_exempt == "reverse" and \
+          customer.getCustomerTaxId(cus) is None:
+    issues.append(("eu_reverse_without_vat_id", "EU reverse charge customer without verified VAT ID"))
+  return issues
+
+
+def timeSlices(fromTs, toTs, count):
+  """
+  Splits [fromTs, toTs) into count slices of equal length.
+  """
+  count = max(1, min(count, toTs - fromTs))
+  bounds = [fromTs + (toTs - fromTs) * idx // count for idx in range(count)] + [toTs]
+  return list(zip(bounds[:-1], bounds[1:]))
+
+
+def listCustomers(fromTs, toTs, slices):
+  def listSlice(bounds):
+    return list(stripe.Customer.list(
+      created={"gte": bounds[0], "lt": bounds[1]}, limit=100, expand=["data.tax_ids"]).auto_paging_iter())
+
+  customers = {}
+  for slice_customers in client.map(listSlice, timeSlices(fromTs, toTs, slices)):
+    for cus in slice_customers:
+      customers[cus.id] = cus
+  return customers
+
+
+def changedCustomerIds(sinceTs, toTs):
+  """
+  Returns the IDs of the customers changed and deleted in [sinceTs, toTs).
+  """
+  changed, deleted = set(), set()
+  events = stripe.Event.list(types=event_types, created={"gte": sinceTs, "lt": toTs}, limit=100)
+  for event in events.auto_paging_iter():
+    obj = event.data.object
+    # The tax ID events are about a tax_id object of the customer
+    id = obj.id if obj.object == "customer" else obj.get("customer", None)
+    if id is None:
+      continue
+    if event.type == "customer.deleted":
+      deleted.add(id)
+    else:
+      changed.add(id)
+  return changed - deleted, deleted
+
+
+def validate(state_path, report_path, full=False, slices=None):
+  """
+  Validates the customers created or changed since the last successful run
+  (all with full, or if there was none within the events' retention), and
+  writes the outstanding issues of all customers to report_path. Returns the
+  issues by customer ID.
+  """
+  started = datetime.now(timezone.utc)
+  started_ts = int(started.timestamp())
+  state = loadState(state_path)
+
+  since_ts = state.get("validated_until", None) if not full else None
+  if since_ts is not None and started - datetime.fromtimestamp(since_ts, timezone.utc) > events_retention:
+    print("Warning: last validation older than {} days, validating all customers".format(events_retention.days))
+    since_ts = None
+
+  if since_ts is None:
+    issues = {}
+    customers = listCustomers(stripe.Account.retrieve().created, started_ts + 1, slices or client.maxConcurrency())
+    deleted = set()
+  else:
+    issues = state.get("issues", {})
+    customers = listCustomers(since_ts, started_ts + 1, slices or client.maxConcurrency())
+    changed, deleted = changedCustomerIds(since_ts, started_ts + 1)
+    retrieved = client.map(lambda id: stripe.Customer.retrieve(id, expand=["tax_ids"]),
+                           sorted(changed - set(customers.keys()) - deleted))
+    for cus in retrieved:
+      customers[cus.id] = cus
+
+  for id in deleted:
+    issues.pop(id, None)
+
+  new_issues = 0
+  for id, cus in sorted(customers.items()):
+    if cus.get("deleted", False):
+      issues.pop(id, None)
+      continue
+    cus_issues = [list(issue) for issue in customerIssues(cus)]
+    if len(cus_issues) == 0:
+      issues.pop(id, None)
+      continue
+    for issue_type, message in cus_issues:
+      if [issue_type, message] not in issues.get(id, []):
+        print("Warning: customer {}: {}".format(id, message))
+        new_issues += 1
+    issues[id] = cus_issues
+
+  by_type = {}
+  for id, cus_issues in sorted(issues.items()):
+    for issue_type, message in cus_issues:
+      by_type.setdefault(issue_type, []).append({"customer": id, "message": message})
+
+  with checkpoint.atomicOpen(report_path, "w", encoding="utf-8") as fp:
+    json.dump({
+      "validated_at": started.isoformat(),
+      "since": datetime.fromtimestamp(since_ts, timezone.utc).isoformat() if since_ts is not None else None,
+      "validated": len(customers),
+      "customers_with_issues": len(issues),
+      "issues": by_type,
+    }, fp, indent=2)
+  # Overlaps the next run by a second, validating a customer twice is harmless
+  saveState(state_path, {"validated_until": started_ts, "issues": issues})
+
+  print("Validated {} customer(s){}, {} new issue(s), {} customer(s) with issues".format(
+    len(customers), " changed since {}".format(datetime.fromtimestamp(since_ts, timezone.utc).isoformat())
+    if since_ts is not None else "", new_issues, len(issues)))
+  for issue_type, entries in sorted(by_type.items()):
+    print("  {} {}".format(issue_type.ljust(28), len(entries)))
+  return issues
@@ -0,0 +1,5 @@
+import os
+
+# The tests use the example configuration, not the user's config.toml
+os.environ["STRIPE_DATEV_CONFIG"] = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                 "config.example.toml")
@@ -0,0 +1,79 @@
+"""
+Helpers shared by the tests that run the CLI against the in-process fake
+Stripe of benchmarks/fake_stripe.py.
+"""
+from stripe_datev import charges, customer, httpclient, invoices, profile
+import contextlib
+import importlib.util
+import io
+import os
+import stripe
+
+cli_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "stripe-datev-cli.py")
+
+
+def loadCli():
+  os.environ.setdefault("STRIPE_API_KEY", "sk_test_request_budget")
+  spec = importlib.util.spec_from_file_location("stripe_datev_cli", cli_path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def resetCaches():
+  for cache in [customer.customers_cached, customer.tax_ids_cached, invoices.invoices_cached,
+                invoices.tax_rates_cached, charges.checkoutSessionsByPaymentIntent]:
+    cache.clear()
+
+
+def readOutputs(out_dir):
+  """
+  Output lines per file, without the DATEV header that contains the time of
+  export.
+  """
+  outputs = {}
+  for dir in ["datev", "overview", "monthly_recognition"]:
+    for name in os.listdir(os.path.join(out_dir, dir)):
+      with open(os.path.join(out_dir, dir, name), "rb") as fp:
+        lines = fp.read().splitlines()
+      outputs[name] = lines[1:] if name.startswith("EXTF_") else lines
+  return outputs
+
+
+def runCli(cli, out_dir, client, *argv):
+  """
+  Runs the CLI with empty caches against the given Stripe HTTP client and
+  out_dir as output directory, without downloading receipts and invoice PDFs.
+  Returns what it printed.
+  """
+  resetCaches()
+  stripe.default_http_client = client
+  cli.out_dir = out_dir
+  runner = cli.StripeDatevCli()
+  runner.offline = True
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    runner.run(["stripe-datev-cli.py"] + list(argv))
+  return output.getvalue()
+
+
+class CountingHTTPClient(httpclient.WrappingHTTPClient):
+
+  def __init__(self, inner):
+    super().__init__(inner)
+    self.counts = {}
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    endpoint = profile.endpointName(method, url)
+    self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+    return super().request(method, url, headers, post_data)
+
+
+class NoNetworkHTTPClient(stripe.HTTPClient):
+  name = "no-network"
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    raise AssertionError("Unexpected Stripe API request: {} {}".format(method, url))
+
+  def close(self):
+    pass
@@ -0,0 +1,125 @@
+from benchmarks import fake_stripe
+from stripe_datev import httpclient
+from tests.helpers import CountingHTTPClient, loadCli, runCli
+import shutil
+import tempfile
+import threading
+import unittest
+import stripe
+
+
+class Interrupted(Exception):
+  pass
+
+
+class InterruptingHTTPClient(httpclient.WrappingHTTPClient):
+  """
+  Interrupts all customer updates after the first `limit` ones, and keeps the
+  idempotency keys of the updates.
+  """
+
+  def __init__(self, inner, limit=None):
+    super().__init__(inner)
+    self.limit = limit
+    self.keys = []
+    self.lock = threading.Lock()
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    if method.lower() == "post":
+      with self.lock:
+        if self.limit is not None and len(self.keys) >= self.limit:
+          raise Interrupted()
+        self.keys.append(headers.get("Idempotency-Key", None))
+    return super().request(method, url, headers, post_data)
+
+
+def numberInCreationOrder(store):
+  """
+  Renumbers the synthetic customers in creation order, like
+  fill_account_numbers does.
+  """
+  customers = sorted(store.customers.values(), key=lambda c: (c["created"], c["id"]))
+  for idx, cus in enumerate(customers):
+    cus["metadata"]["accountNumber"] = str(10100 + idx)
+  return customers
+
+
+class AccountNumbersTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+    self.store = fake_stripe.generateMonths("2023-05", 100)
+    # Customers in creation order, the newest two and every third one without
+    # account number, with a numbered one before the newest two
+    self.customers = numberInCreationOrder(self.store)
+    self.unnumbered = [cus["id"] for idx, cus in enumerate(self.customers)
+                       if (idx % 3 == 0 and idx < len(self.customers) - 3) or idx >= len(self.customers) - 2]
+    for id in self.unnumbered:
+      del self.store.customers[id]["metadata"]["accountNumber"]
+    self.highest = max(int(cus["metadata"]["accountNumber"]) for cus in self.customers
+                       if "accountNumber" in cus["metadata"])
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv, limit=None):
+    http_client = InterruptingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)), limit)
+    runCli(self.cli, self.out_dir, http_client, *argv)
+    return http_client
+
+  def accountNumbers(self):
+    return {id: self.store.customers[id]["metadata"].get("accountNumber", None) for id in self.unnumbered}
+
+  def test_newest_then_bulk(self):
+    # Without --bulk, only the customers created after the newest numbered one
+    newest = self.unnumbered[-2:]
+    self.run_cli("fill_account_numbers")
+    numbers = self.accountNumbers()
+    self.assertEqual([numbers[id] for id in newest], [str(self.highest + 1), str(self.highest + 2)])
+    self.assertTrue(all(numbers[id] is None for id in self.unnumbered[:-2]))
+
+    self.run_cli("fill_account_numbers", "--bulk")
+    numbers = self.accountNumbers()
+    self.assertEqual([numbers[id] for id in self.unnumbered[:-2]],
+                     [str(self.highest + 3 + idx) for idx in range(len(self.unnumbered) - 2)])
+
+  def test_newest_stops_at_numbered(self):
+    # More than one page of customers, only the first is listed without --bulk
+    store = fake_stripe.generateMonths("2023-05", 400)
+    self.assertGreater(len(store.customers), 100)
+    newest = numberInCreationOrder(store)[-1]
+    del newest["metadata"]["accountNumber"]
+    http_client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(store)))
+    runCli(self.cli, self.out_dir, http_client, "fill_account_numbers")
+    self.assertEqual(http_client.counts["GET /v1/customers"], 1)
+    self.assertIn("accountNumber", newest["metadata"])
+
+  def test_resume_interrupted_bulk(self):
+    self.resumeInterruptedBulk("--checkpoint")
+
+  def test_resume_interrupted_bulk_without_checkpoint(self):
+    # The plan and journal are kept without --checkpoint, too
+    self.resumeInterruptedBulk()
+
+  def resumeInterruptedBulk(self, *argv):
+    with self.assertRaises(Interrupted):
+      self.run_cli("fill_account_numbers", "--bulk", *argv, limit=5)
+    interrupted = self.accountNumbers()
+    self.assertEqual(len([number for number in interrupted.values() if number is not None]), 5)
+
+    # Customers losing their account number since must not change the plan
+    self.store.customers[self.customers[1]["id"]]["metadata"].pop("accountNumber")
+    http_client = self.run_cli("fill_account_numbers", "--bulk", "--resume")
+    self.assertEqual(len(http_client.keys), len(self.unnumbered) - 5)
+
+    numbers = self.accountNumbers()
+    self.assertEqual(numbers, {id: str(self.highest + 1 + idx) for idx, id in enumerate(self.unnumbered)})
+    self.assertTrue(all(interrupted[id] in (None, numbers[id]) for id in self.unnumbered))
+    self.assertTrue(all(key == "accountNumber-{}-{}".format(id, numbers[id])
+                        for key, id in zip(sorted(http_client.keys), sorted(
+                          id for id in self.unnumbered if interrupted[id] is None))))
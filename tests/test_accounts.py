@@ -0,0 +1,109 @@
+from benchmarks import fake_stripe
+from stripe_datev import config, output
+from tests.helpers import CountingHTTPClient, loadCli, resetCaches, runCli
+from datetime import datetime
+import copy
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import stripe
+
+
+class ListAccountsTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+    self.store = fake_stripe.generateMonths("2023-05", 60)
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv):
+    return runCli(self.cli, self.out_dir, fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)), *argv)
+
+  def export(self, *argv):
+    path = os.path.join(self.out_dir, "accounts.csv")
+    self.run_cli("list_accounts", path, *argv)
+    with open(path, "r", encoding="latin-1") as fp:
+      lines = fp.read().split("\n")
+    self.assertEqual(lines[1], ";".join(output.fields_accounts))
+    self.assertEqual(lines[-1], "")
+    return lines[2:-1]
+
+  def test_rows_match_columns(self):
+    lines = self.export()
+    self.assertEqual(len(lines), len(self.store.customers))
+
+    resetCaches()
+    stripe.default_http_client = fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store))
+    customers = list(stripe.Customer.list(limit=100, expand=["data.tax_ids"]).auto_paging_iter())
+    with contextlib.redirect_stdout(io.StringIO()):
+      expected = [";".join(output.accountRecord(cus).get(f, "") for f in output.fields_accounts) for cus in customers]
+    self.assertEqual(lines, expected)
+
+  def test_delta_and_since(self):
+    self.assertEqual(len(self.export("--delta")), len(self.store.customers))
+    self.assertEqual(self.export("--delta"), [])
+
+    changed = sorted(self.store.customers.keys())[3]
+    self.store.customers[changed]["metadata"]["accountNumber"] = "99999"
+    fake_stripe.FakeStripe(self.store).addEvent("customer.updated", self.store.customers[changed])
+    lines = self.export("--delta")
+    self.assertEqual([line.split(";")[0] for line in lines], ["99999"])
+    self.assertEqual(self.export("--delta"), [])
+
+    created = sorted(cus["created"] for cus in self.store.customers.values())
+    since = datetime.fromtimestamp(created[len(created) // 2], config.accounting_tz).replace(
+      hour=0, minute=0, second=0, tzinfo=None)
+    expected = [ts for ts in created if ts >= config.accounting_tz.localize(since).timestamp()]
+    self.assertGreater(len(expected), 0)
+    self.assertLess(len(expected), len(created))
+    self.assertEqual(len(self.export("--since", since.strftime("%Y-%m-%d"))), len(expected))
+
+  def test_delta_lists_changes_only(self):
+    self.assertEqual(len(self.export("--delta")), len(self.store.customers))
+
+    fake = fake_stripe.FakeStripe(self.store)
+    changed = sorted(self.store.customers.keys())[5]
+    self.store.customers[changed]["metadata"]["accountNumber"] = "99998"
+    fake.addEvent("customer.updated", self.store.customers[changed])
+    # An event without a change of the row is listed, but not exported
+    fake.addEvent("customer.updated", self.store.customers[sorted(self.store.customers.keys())[6]])
+    newest = max(self.store.customers.values(), key=lambda cus: cus["created"])
+    added = dict(copy.deepcopy(newest), id="cus_added", created=int(time.time()))
+    added["metadata"]["accountNumber"] = "99999"
+    self.store.add(added)
+
+    client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake))
+    path = os.path.join(self.out_dir, "accounts.csv")
+    runCli(self.cli, self.out_dir, client, "list_accounts", path, "--delta")
+    with open(path, "r", encoding="latin-1") as fp:
+      lines = fp.read().split("\n")[2:-1]
+    self.assertEqual(sorted(line.split(";")[0] for line in lines), ["99998", "99999"])
+    self.assertEqual(client.counts, {
+      "GET /v1/customers": 1,
+      "GET /v1/events": 1,
+      "GET /v1/customers/{id}": 2,
+    })
+
+    # Without a listing time, e.g. from an older manifest, all customers are listed
+    manifest_path = os.path.join(self.out_dir, "cache", "accounts_manifest.json")
+    with open(manifest_path, "r", encoding="utf-8") as fp:
+      manifest = json.load(fp)
+    del manifest["listed_at"]
+    with open(manifest_path, "w", encoding="utf-8") as fp:
+      json.dump(manifest, fp)
+    client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake))
+    runCli(self.cli, self.out_dir, client, "list_accounts", path, "--delta")
+    self.assertEqual(client.counts, {"GET /v1/customers": 1})
+    self.assertEqual(self.export("--delta"), [])
@@ -0,0 +1,29 @@
+from benchmarks import pipeline, synthetic
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+
+class PipelineGoldenTest(unittest.TestCase):
+
+  def test_output_matches_golden(self):
+    # benchmarks/golden.json was written with --invoices 200 and the accounts
+    # of config.example.toml, which tests/__init__.py configures
+    with open(os.path.join(os.path.dirname(pipeline.__file__), "golden.json"), "r", encoding="utf-8") as fp:
+      golden = json.load(fp)
+
+    store = synthetic.generate(2023, 5, 200)
+    with tempfile.TemporaryDirectory() as out_dir:
+      pipeline.runPipeline(store, out_dir, 2023, 5, pipeline.Stages(False))
+      hashes = {name: pipeline.normalizedHash(os.path.join(out_dir, name)) for name in sorted(os.listdir(out_dir))}
+
+    self.assertEqual(hashes, golden)
+
+  def test_max_rss_without_resource(self):
+    self.assertGreater(pipeline.maxRssMb(), 0)
+    # The resource module is Unix-only
+    with mock.patch.dict(sys.modules, {"resource": None}):
+      self.assertIsNone(pipeline.maxRssMb())
@@ -0,0 +1,62 @@
+from benchmarks import fake_stripe
+from stripe_datev import httpclient
+from tests.helpers import CountingHTTPClient, loadCli, runCli
+import os
+import tempfile
+import unittest
+import stripe
+
+
+class InterruptingHTTPClient(httpclient.WrappingHTTPClient):
+
+  def __init__(self, inner, after):
+    super().__init__(inner)
+    self.remaining = after
+
+  def request(self, method, url, headers, post_data=None, *, _usage=None):
+    if self.remaining == 0:
+      raise KeyboardInterrupt()
+    self.remaining -= 1
+    return super().request(method, url, headers, post_data)
+
+
+def readOutputs(out_dir):
+  outputs = {}
+  for dir in ["datev", "overview", "monthly_recognition"]:
+    for name in sorted(os.listdir(os.path.join(out_dir, dir))):
+      with open(os.path.join(out_dir, dir, name), "rb") as fp:
+        # Skip the DATEV header, it contains the time of export
+        outputs[name] = fp.read().split(b"\n", 1)[1]
+  return outputs
+
+
+class ResumeTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.fake = fake_stripe.FakeStripe(fake_stripe.generateMonths("2023-04:2023-05", 60))
+
+  def tearDown(self):
+    stripe.default_http_client = None
+
+  def download(self, out_dir, client, resume=False):
+    runCli(self.cli, out_dir, client, "download", "2023", "5", "--resume" if resume else "--checkpoint")
+
+  def test_resume(self):
+    with tempfile.TemporaryDirectory() as out_dir:
+      complete = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(self.fake))
+      self.download(out_dir, complete)
+      expected = readOutputs(out_dir)
+      self.assertEqual(os.listdir(os.path.join(out_dir, "runs")), ["download-2023-5"])
+
+    with tempfile.TemporaryDirectory() as out_dir:
+      with self.assertRaises(KeyboardInterrupt):
+        self.download(out_dir, InterruptingHTTPClient(fake_stripe.FakeStripeHTTPClient(self.fake), 20))
+
+      resumed = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(self.fake))
+      self.download(out_dir, resumed, resume=True)
+
+      self.assertEqual(readOutputs(out_dir), expected)
+      # The 20 requests before the interruption are answered from the checkpoint
+      self.assertEqual(sum(resumed.counts.values()), sum(complete.counts.values()) - 20)
@@ -0,0 +1,59 @@
+from benchmarks import fake_stripe, synthetic
+from stripe_datev import client, snapshot
+import os
+import tempfile
+import unittest
+import stripe
+
+
+class RateLimitedHTTPClientTest(unittest.TestCase):
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    stripe.max_network_retries = self.max_network_retries
+
+  def setUp(self):
+    self.max_network_retries = stripe.max_network_retries
+
+  def test_retries_rate_limited_requests(self):
+    store = synthetic.generate(2023, 5, 50)
+    fake = fake_stripe.FakeStripe(store, rate_limit=0.3, seed=1)
+    stripe.default_http_client = fake_stripe.FakeStripeHTTPClient(fake)
+    limited = client.install(rate=1000, retries=20, initial_delay=0.001)
+
+    ids = client.map(lambda id: stripe.Invoice.retrieve(id, api_key="sk_test_client").id, sorted(store.invoices))
+
+    self.assertEqual(ids, sorted(store.invoices))
+    self.assertGreater(limited.limit.throttled, 0)
+
+  def test_replay_recorded_under_rate_limit(self):
+    store = synthetic.generate(2023, 5, 20)
+    fake = fake_stripe.FakeStripe(store, rate_limit=0.3, seed=2)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "snapshot.jsonl.gz")
+      stripe.default_http_client = fake_stripe.FakeStripeHTTPClient(fake)
+      recorder = snapshot.record(path)
+      limited = client.install(rate=1000, retries=20, initial_delay=0.001)
+      totals = [stripe.Invoice.retrieve(id, api_key="sk_test_client").total for id in sorted(store.invoices)]
+      self.assertGreater(limited.limit.throttled, 0)
+      recorder.close()
+
+      # Only the final responses were recorded, none of the rate limited attempts
+      snapshot.replay(path)
+      self.assertEqual([stripe.Invoice.retrieve(id, api_key="sk_test_client").total for id in sorted(store.invoices)],
+                       totals)
+
+  def test_adaptive_limit(self):
+    limit = client.AdaptiveLimit(8, initial=4)
+    for _ in range(40):
+      limit.acquire()
+      limit.release(0.1)
+    self.assertEqual(limit.limit, 8)
+
+    limit.acquire()
+    limit.release(None, throttled=True)
+    self.assertEqual(limit.limit, 4)
+    # Halves at most once per second
+    limit.acquire()
+    limit.release(None, throttled=True)
+    self.assertEqual(limit.limit, 4)
@@ -0,0 +1,31 @@
+from stripe_datev import csv
+from datetime import datetime, timedelta, timezone
+import decimal
+import io
+import unittest
+
+
+class CsvTest(unittest.TestCase):
+
+  def test_escape(self):
+    self.assertEqual(csv.lines_to_csv([["a,b", "c\r\nd", "e\rf\ng", None], ["x", "y;z", "", "1"]]),
+                     "a;b,c d,e f g,\nx,y;z,,1")
+    self.assertEqual(csv.lines_to_csv([["a\tb", "c,d"]], sep="\t"), "a;b\tc,d")
+
+  def test_write_in_chunks(self):
+    lines = [[str(idx), "line,{}".format(idx) if idx % 3 == 0 else "line"] for idx in range(10)]
+    for chunk_size in [1, 3, 10, 100]:
+      fp = io.StringIO()
+      csv.write_csv(fp, iter(lines), chunk_size=chunk_size)
+      self.assertEqual(fp.getvalue(), csv.lines_to_csv(lines))
+    fp = io.StringIO()
+    csv.write_csv(fp, [])
+    self.assertEqual(fp.getvalue(), "")
+
+  def test_formatter(self):
+    formatter = csv.Formatter()
+    self.assertEqual(formatter.amount(decimal.Decimal("0.00")), "0.00")
+    self.assertEqual(formatter.amount(decimal.Decimal("-0.00")), "-0.00")
+    utc = datetime(2023, 5, 31, 23, 0, tzinfo=timezone.utc)
+    self.assertEqual(formatter.date(utc), "2023-05-31")
+    self.assertEqual(formatter.date(utc.astimezone(timezone(timedelta(hours=2)))), "2023-06-01")
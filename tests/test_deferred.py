@@ -0,0 +1,65 @@
+from benchmarks import fake_stripe
+from stripe_datev import config, deferred, journal
+from tests.helpers import NoNetworkHTTPClient, loadCli, runCli
+from datetime import datetime, timedelta
+import decimal
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import stripe
+
+
+class DeferredTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv, client=None):
+    return runCli(self.cli, self.out_dir, client or fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)),
+                  *argv)
+
+  def test_interval_tree(self):
+    rnd = random.Random(0)
+    intervals = []
+    for idx in range(300):
+      low = rnd.randint(0, 1000)
+      intervals.append((low, low + rnd.randint(0, 200), idx))
+    tree = deferred.IntervalTree(intervals)
+    for point in range(-10, 1250, 7):
+      self.assertEqual(sorted(tree.stab(point)),
+                       [idx for low, high, idx in intervals if low <= point <= high])
+
+  def test_matches_prap_balance(self):
+    self.run_cli("download", "2023", "5")
+
+    j = journal.Journal(os.path.join(self.out_dir, "journal.sqlite"))
+    ranges = j.recognitionRanges()
+    totals = j.monthlyTotals(accounts=[config.accounts["prap"]])
+    j.close()
+    self.assertGreater(len(ranges), 0)
+
+    index = deferred.DeferredRevenue(ranges)
+    balance = 0
+    for _, month, debit, credit in totals:
+      balance += debit - credit
+      year, month = map(int, month.split("-"))
+      end_of_month = datetime(year, month, 1) + timedelta(days=32)
+      asOf = config.accounting_tz.localize(datetime(end_of_month.year, end_of_month.month, 1) - timedelta(seconds=1))
+      self.assertEqual(int(index.outstanding(asOf) * 100), -balance)
+
+    output = self.run_cli("deferred", "--as-of", "2023-05-31", client=NoNetworkHTTPClient())
+    total = output.strip().split("\n")[-1].split()[1]
+    self.assertEqual(total, format(index.outstanding(
+      config.accounting_tz.localize(datetime(2023, 5, 31, 23, 59, 59))), ",.2f"))
+    self.assertGreater(decimal.Decimal(total.replace(",", "")), 0)
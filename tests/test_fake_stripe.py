@@ -0,0 +1,82 @@
+from benchmarks import fake_stripe
+from tests.helpers import loadCli, readOutputs, resetCaches, runCli
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+import stripe
+
+
+class FakeStripeTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+
+  def setUp(self):
+    self.api_base = stripe.api_base
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    stripe.api_base = self.api_base
+
+  def list(self, fake, path, **params):
+    status, content, _ = fake.handle("GET", "{}?{}".format(path, "&".join(
+      "{}={}".format(key, value) for key, value in params.items())))
+    self.assertEqual(status, 200)
+    return json.loads(content)
+
+  def test_cursors(self):
+    fake = fake_stripe.FakeStripe(self.store)
+    expected = [ch["id"] for ch in sorted(self.store.charges.values(), key=lambda ch: (ch["created"], ch["id"]),
+                                          reverse=True)]
+    ids = []
+    page = self.list(fake, "/v1/charges", limit=7)
+    ids += [ch["id"] for ch in page["data"]]
+    while page["has_more"]:
+      page = self.list(fake, "/v1/charges", limit=7, starting_after=ids[-1])
+      ids += [ch["id"] for ch in page["data"]]
+    self.assertEqual(ids, expected)
+
+    page = self.list(fake, "/v1/charges", limit=7, ending_before=expected[10])
+    self.assertEqual([ch["id"] for ch in page["data"]], expected[3:10])
+    self.assertTrue(page["has_more"])
+
+    # Filters apply from the cursor on
+    created = {"created[gte]": self.store.charges[expected[-1]]["created"] + 1}
+    page = self.list(fake, "/v1/charges", limit=100, starting_after=expected[5], **created)
+    self.assertEqual([ch["id"] for ch in page["data"]], expected[6:-1])
+    self.assertFalse(page["has_more"])
+
+    # Added objects are listed, too
+    charge = dict(self.store.charges[expected[0]], id="ch_newest", created=self.store.charges[expected[0]]["created"] + 1)
+    self.store.add(charge)
+    try:
+      self.assertEqual(self.list(fake, "/v1/charges", limit=1)["data"][0]["id"], "ch_newest")
+    finally:
+      del self.store.charges["ch_newest"]
+
+  def test_cli_over_http(self):
+    with tempfile.TemporaryDirectory() as out_dir:
+      runCli(self.cli, out_dir, fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)),
+             "download", "2023", "5")
+      expected = readOutputs(out_dir)
+
+    server = fake_stripe.serve(fake_stripe.FakeStripe(self.store), port=0)
+    try:
+      with tempfile.TemporaryDirectory() as out_dir:
+        resetCaches()
+        stripe.default_http_client = None
+        self.cli.out_dir = out_dir
+        with contextlib.redirect_stdout(io.StringIO()):
+          self.cli.StripeDatevCli().run(["stripe-datev-cli.py", "--api-base", "http://{}:{}".format(
+            *server.server_address), "download", "2023", "5"])
+        self.assertEqual(readOutputs(out_dir), expected)
+        # Receipts and invoice PDFs are downloaded from the server as well
+        self.assertGreater(len(os.listdir(os.path.join(out_dir, "pdf"))), 0)
+    finally:
+      server.shutdown()
+      server.server_close()
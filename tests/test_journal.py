@@ -0,0 +1,131 @@
+from benchmarks import fake_stripe
+from stripe_datev import journal
+from tests.helpers import NoNetworkHTTPClient, loadCli, runCli
+from tests.test_reporting import readOutputs
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import stripe
+
+
+class JournalTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv, client=None):
+    return runCli(self.cli, self.out_dir, client or fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)),
+                  *argv)
+
+  def test_latest_run_wins(self):
+    self.run_cli("download", "2023", "5")
+    self.run_cli("download", "2023", "5", "--force")
+
+    j = journal.Journal(os.path.join(self.out_dir, "journal.sqlite"))
+    runs = j.db.execute("SELECT scope, COUNT(*) FROM runs GROUP BY scope ORDER BY scope").fetchall()
+    self.assertEqual(runs, [("balance-2023-05", 2), ("revenue-2023-05", 2)])
+    total = j.db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+    self.assertEqual(len(j.records()) * 2, total)
+
+    prap = j.records(konto="990", month="2023-06")
+    self.assertGreater(len(prap), 0)
+    self.assertTrue(all(record["Konto"] == "990" and record["date"].strftime("%Y-%m") == "2023-06"
+                        for record in prap))
+    j.close()
+
+  def test_export_without_stripe(self):
+    self.run_cli("download", "2023", "5")
+    expected = readOutputs(self.out_dir)
+    datev = {name: lines for name, lines in expected.items() if name.startswith("EXTF_")}
+    shutil.rmtree(os.path.join(self.out_dir, "datev"))
+
+    self.run_cli("journal", "export", "2023", "5", client=NoNetworkHTTPClient())
+    self.assertEqual({name: lines for name, lines in readOutputs(self.out_dir).items() if name.startswith("EXTF_")},
+                     datev)
+
+    output = self.run_cli("journal", "query", "--konto", "990", client=NoNetworkHTTPClient())
+    self.assertGreater(len(output.strip().split("\n")), 1)
+    # Neither run was checkpointed
+    self.assertFalse(os.path.exists(os.path.join(self.out_dir, "runs")))
+
+  def test_monthly_totals(self):
+    self.run_cli("download", "2023", "5")
+    self.run_cli("download", "2023", "5", "--force")
+
+    j = journal.Journal(os.path.join(self.out_dir, "journal.sqlite"))
+    expected = {}
+    for record in j.records():
+      amount = journal.cents(record["Umsatz (ohne Soll/Haben-Kz)"])
+      debit, credit = (record["Konto"], record["Gegenkonto (ohne BU-Schlüssel)"])
+      if record["Soll/Haben-Kennzeichen"] == "H":
+        debit, credit = credit, debit
+      month = journal.accountingMonth(record["date"])
+      expected.setdefault((debit, month), [0, 0])[0] += amount
+      expected.setdefault((credit, month), [0, 0])[1] += amount
+    totals = j.monthlyTotals()
+    j.close()
+
+    self.assertEqual({(account, month): [debit, credit] for account, month, debit, credit in totals}, expected)
+    # Every booking debits and credits the same amount
+    self.assertEqual(sum(debit for _, _, debit, _ in totals), sum(credit for _, _, _, credit in totals))
+
+    output = self.run_cli("balances", "990", "--from", "2023-06", client=NoNetworkHTTPClient())
+    lines = output.strip().split("\n")[1:]
+    self.assertEqual([line.split()[:2] for line in lines],
+                     [["990", month] for account, month, _, _ in totals if account == "990" and month >= "2023-06"])
+
+  def test_totals_migration(self):
+    self.run_cli("download", "2023", "5")
+    path = os.path.join(self.out_dir, "journal.sqlite")
+    j = journal.Journal(path)
+    totals = j.monthlyTotals()
+    # As written before totals were kept, with an empty run
+    with j.db:
+      j.db.execute("DELETE FROM totals")
+      j.db.execute("INSERT INTO runs (scope, command, created) VALUES ('empty', NULL, '')")
+      j.db.execute("PRAGMA user_version = 0")
+    j.close()
+
+    j = journal.Journal(path)
+    self.assertEqual(j.monthlyTotals(), totals)
+    j.close()
+    # Migrated journals are not checked again, even though the empty run has no totals
+    with mock.patch.object(journal.Journal, "addTotals") as addTotals:
+      journal.Journal(path).close()
+    addTotals.assert_not_called()
+
+  def test_year_replaces_months(self):
+    self.run_cli("download", "2023", "4")
+    self.run_cli("download", "2023", "5")
+    self.run_cli("download", "2023", "0")
+
+    j = journal.Journal(os.path.join(self.out_dir, "journal.sqlite"))
+    scopes = [scope for scope, in j.db.execute("SELECT DISTINCT scope FROM runs ORDER BY scope")]
+    self.assertEqual(scopes, journal.periodScopes("balance", 2023, 0) + journal.periodScopes("revenue", 2023, 0))
+    totals, ranges = j.monthlyTotals(), j.recognitionRanges()
+    j.close()
+
+    with tempfile.TemporaryDirectory() as out_dir:
+      runCli(self.cli, out_dir, fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)),
+             "download", "2023", "0")
+      j = journal.Journal(os.path.join(out_dir, "journal.sqlite"))
+      self.assertEqual(totals, j.monthlyTotals())
+      self.assertEqual(sorted(ranges, key=repr), sorted(j.recognitionRanges(), key=repr))
+      j.close()
+
+    # A month downloaded again replaces its part of the year
+    self.run_cli("download", "2023", "5", "--force")
+    j = journal.Journal(os.path.join(self.out_dir, "journal.sqlite"))
+    self.assertEqual(totals, j.monthlyTotals())
+    j.close()
@@ -0,0 +1,96 @@
+from benchmarks import fake_stripe, synthetic
+from stripe_datev import config, opos
+from tests.helpers import CountingHTTPClient, loadCli, runCli
+from datetime import datetime, timedelta
+import random
+import shutil
+import tempfile
+import unittest
+import stripe
+
+
+def openInvoices(invoices, ref):
+  """
+  Open invoices as of ref, checked one by one.
+  """
+  ref_ts = int(ref.timestamp())
+  result = []
+  for invoice in invoices:
+    transitions = invoice.status_transitions
+    finalized_at = transitions.get("finalized_at", None)
+    if finalized_at is None or finalized_at > ref_ts:
+      continue
+    if any(transitions.get(name, None) is not None and transitions.get(name) <= ref_ts
+           for name in ["marked_uncollectible_at", "voided_at", "paid_at"]):
+      continue
+    result.append(invoice)
+  return result
+
+
+class OposTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-01:2023-06", 20)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def test_fenwick_tree(self):
+    rnd = random.Random(1)
+    values = [rnd.randint(-100, 100) for _ in range(50)]
+    tree = opos.FenwickTree(len(values))
+    for idx, value in enumerate(values):
+      tree.add(idx, value)
+    for end in range(len(values) + 1):
+      self.assertEqual(tree.prefixSum(end), sum(values[:end]))
+
+  def test_sweep_matches_single_dates(self):
+    invoices = [synthetic.toStripe(stripe.Invoice, invoice) for invoice in self.store.invoices.values()]
+    refs = [config.accounting_tz.localize(datetime(2023, 1, 1) + timedelta(days=days, seconds=-1))
+            for days in range(0, 240, 7)]
+
+    results = opos.sweep(opos.invoiceEvents(invoices), refs)
+
+    self.assertEqual([result["date"] for result in results], refs)
+    for ref, result in zip(refs, results):
+      open = openInvoices(invoices, ref)
+      self.assertEqual(result["count"], len(open))
+      self.assertEqual(result["total"], sum(invoice.total for invoice in open))
+      aging = [0] * 5
+      for invoice in open:
+        overdue = ref - datetime.fromtimestamp(invoice.due_date or invoice.created, tz=ref.tzinfo)
+        bucket = 0 if overdue < timedelta(0) else next(
+          (idx + 1 for idx, days in enumerate(opos.default_buckets) if overdue < timedelta(days=days)), 4)
+        aging[bucket] += invoice.total
+      self.assertEqual(result["aging"], aging)
+
+  def test_month_ends_in_one_listing(self):
+    client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)))
+    output = runCli(self.cli, self.out_dir, client, "opos", "--month-ends", "2023")
+    lines = output.strip().split("\n")[2:]
+
+    self.assertEqual(len(lines), 12)
+    self.assertEqual(set(client.counts), {"GET /v1/invoices"})
+    invoices = [synthetic.toStripe(stripe.Invoice, invoice) for invoice in self.store.invoices.values()]
+    for line in lines:
+      ref = config.accounting_tz.localize(datetime.strptime(line.split()[0], "%Y-%m-%d") + timedelta(days=1, seconds=-1))
+      total = sum(invoice.total for invoice in openInvoices(invoices, ref))
+      self.assertEqual(line.split()[1], format(total / 100, ",.2f"))
+
+  def test_dates_match_single_date_window(self):
+    client = fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store))
+    # More than a year after the earliest invoices, which drop out of the window
+    dates = ["2023-05-31", "2024-03-31"]
+    output = runCli(self.cli, self.out_dir, client, "opos", "--dates", *dates)
+    totals = [line.split()[1] for line in output.strip().split("\n")[2:]]
+
+    for date, total in zip(dates, totals):
+      single = runCli(self.cli, self.out_dir, client, "opos", *date.split("-"))
+      self.assertEqual(single.strip().split("\n")[-1].split()[1], total)
+    self.assertNotEqual(totals[0], totals[1])
@@ -0,0 +1,51 @@
+from stripe_datev import config, output
+from datetime import datetime, timedelta, timezone
+import decimal
+import io
+import unittest
+
+
+class OutputTest(unittest.TestCase):
+
+  def test_format_cents(self):
+    for cents in [0, 1, -1, 5, -5, 99, -99, 100, -100, 101, 123456, -123456, 10 ** 12]:
+      self.assertEqual(output.formatCents(cents), output.formatDecimal(decimal.Decimal(cents) / 100))
+    self.assertEqual(output.formatDecimal(decimal.Decimal("-0.00")), "-0,00")
+    self.assertEqual(output.formatDecimal(decimal.Decimal("1234.5")), "1234,50")
+
+  def test_format_date(self):
+    date = config.accounting_tz.localize(datetime(2023, 6, 1, 0, 30))
+    self.assertEqual(output.formatDateDatev(date), "0106")
+    # The same instant in UTC is still on May 31st, but the same Belegdatum
+    self.assertEqual(output.formatDateDatev(date.astimezone(timezone.utc)), "0106")
+    self.assertEqual(output.formatDateDatev(date - timedelta(hours=1)), "3105")
+
+  def test_rows_match_fields(self):
+    date = config.accounting_tz.localize(datetime(2023, 5, 17, 12))
+    records = [
+      {"date": date, "Buchungstext": "Only text"},
+      {"date": date, "Umsatz (ohne Soll/Haben-Kz)": "1,00", "Buchungstext": "X" * 80, "Land": "DE"},
+      {"date": date, "Buchungstext": "100% \"quoted\"", "Konto": "10001", "Gegenkonto (ohne BU-Schlüssel)": "8400",
+       "Umsatz (ohne Soll/Haben-Kz)": "5,00", "Soll/Haben-Kennzeichen": "S", "EU-Land u. UStID": "FR123"},
+      {"date": date, "Konto": "10002", "Buchungstext": "Same fields, other order", "Umsatz (ohne Soll/Haben-Kz)": "2,00"},
+    ]
+    records.append(dict(records[2], Buchungstext="Same fields again"))
+    # E.g. a charge without receipt number
+    records.append(dict(records[2], Buchungstext="No receipt number", **{"Belegfeld 1": None}))
+
+    fp = io.StringIO()
+    output.printRecords(fp, [dict(record) for record in records])
+    lines = fp.getvalue().split("\n")
+    self.assertEqual(lines[1], ";".join(output.fields))
+    self.assertEqual(lines[-1], "")
+
+    for record, line in zip(records, lines[2:-1]):
+      record = dict(record, Belegdatum="1705", Buchungstext="\"{}\"".format(record["Buchungstext"][:60]))
+      self.assertEqual(line, ";".join(record.get(f, None) or "" for f in output.fields))
+    self.assertEqual(len(lines), len(records) + 3)
+
+  def test_none_is_empty(self):
+    record = {"Konto": "10001", "E-Mail": None}
+    template, values = output.recordTemplate(record, columns=output.fields_accounts)
+    self.assertEqual(template % values(record), ";".join(
+      "10001" if f == "Konto" else "" for f in output.fields_accounts))
@@ -0,0 +1,158 @@
+from benchmarks import fake_stripe
+from stripe_datev import parquet
+from tests.helpers import loadCli, resetCaches, runCli
+from datetime import datetime
+from unittest import mock
+import decimal
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import stripe
+
+
+# Schema type -> Python type of the row values
+python_types = {
+  "string": str,
+  "cents": int,
+  "account": int,
+  "int": int,
+  "float": float,
+  "bool": bool,
+  "timestamp": datetime,
+}
+
+
+class ParquetTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv):
+    return runCli(self.cli, self.out_dir, fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)), *argv)
+
+  def test_typed_rows(self):
+    resetCaches()
+    self.assertEqual(parquet.cents(decimal.Decimal("12.34")), 1234)
+    self.assertEqual(parquet.cents(decimal.Decimal("-0.005")), 0)
+    self.assertEqual(parquet.account("8400"), 8400)
+    self.assertIsNone(parquet.account(""))
+
+    stripe.default_http_client = fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store))
+    revenue_items = self.cli.stripe_datev.invoices.createRevenueItems(
+      self.cli.stripe_datev.invoices.listFinalizedInvoices(*self.cli.StripeDatevCli().periodBounds(2023, 5)))
+    lines = self.cli.stripe_datev.invoices.to_recognized_month_csv2(revenue_items).split("\n")
+    net = lines[0].split(",").index("line_item_net")
+
+    rows = parquet.recognitionRows(revenue_items)
+    self.assertTrue(all(isinstance(row["line_item_net"], int) for row in rows))
+    self.assertEqual([row["line_item_net"] for row in rows],
+                     [int(decimal.Decimal(line.split(",")[net]) * 100) for line in lines[1:]])
+
+  def test_imports_pyarrow_lazily(self):
+    imported = subprocess.run([sys.executable, "-c", "import sys, stripe_datev.parquet; print('pyarrow' in sys.modules)"],
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    self.assertEqual(imported, "False")
+
+  def writeJson(self, dataset, rows, fp):
+    """
+    Stand-in for parquet.writeTable that checks the rows against the schema
+    and writes them as JSON.
+    """
+    columns = [column for column, _ in parquet.schemas[dataset]]
+    partition = os.path.basename(os.path.dirname(fp.name))
+    for row in rows:
+      self.assertEqual(sorted(row.keys()), sorted(columns + ["month"]))
+      self.assertEqual("month=" + row["month"], partition)
+      for column, type in parquet.schemas[dataset]:
+        self.assertTrue(row[column] is None or isinstance(row[column], python_types[type]),
+                        "{}.{}: {!r}".format(dataset, column, row[column]))
+    fp.write(json.dumps(rows, default=str).encode("utf-8"))
+
+  def readJson(self, dataset):
+    rows = []
+    root = os.path.join(self.out_dir, "parquet", dataset)
+    for partition in os.listdir(root):
+      for name in os.listdir(os.path.join(root, partition)):
+        with open(os.path.join(root, partition, name), "r", encoding="utf-8") as fp:
+          rows += json.load(fp)
+    return rows
+
+  def run_cli_without_pyarrow(self, *argv):
+    with mock.patch.object(parquet, "available", return_value=True), \
+        mock.patch.object(parquet, "writeTable", self.writeJson):
+      return self.run_cli(*argv)
+
+  def test_partitioned_rows(self):
+    self.run_cli_without_pyarrow("download", "2023", "5", "--parquet")
+    self.run_cli_without_pyarrow("download", "2023", "5", "--parquet", "--force")
+
+    root = os.path.join(self.out_dir, "parquet")
+    self.assertEqual(sorted(os.listdir(root)), sorted(parquet.schemas.keys()))
+    for dataset in parquet.schemas:
+      self.assertGreater(len(self.readJson(dataset)), 0)
+      self.assertTrue(all(name == "2023-05.parquet" for partition in os.listdir(os.path.join(root, dataset))
+                          for name in os.listdir(os.path.join(root, dataset, partition))))
+
+  def test_year_replaces_month_files(self):
+    self.run_cli_without_pyarrow("download", "2023", "5", "--parquet")
+    self.run_cli_without_pyarrow("download", "2023", "0", "--parquet")
+
+    root = os.path.join(self.out_dir, "parquet")
+    self.assertEqual(os.listdir(os.path.join(root, "invoices", "month=2023-05")), ["2023-05.parquet"])
+    ids = [row["invoice_id"] for row in self.readJson("invoices")]
+    self.assertEqual(len(ids), len(set(ids)))
+    self.assertGreater(len(os.listdir(os.path.join(root, "invoices"))), 1)
+
+  @unittest.skipIf(parquet.available(), "pyarrow is installed")
+  def test_requires_pyarrow(self):
+    with self.assertRaises(Exception):
+      self.run_cli("download", "2023", "5", "--parquet")
+
+  @unittest.skipUnless(parquet.available(), "pyarrow is not installed")
+  def test_partitioned_datasets(self):
+    import pyarrow.dataset
+
+    self.run_cli("download", "2023", "5", "--parquet")
+    self.run_cli("download", "2023", "5", "--parquet", "--force")
+
+    root = os.path.join(self.out_dir, "parquet")
+    self.assertEqual(sorted(os.listdir(root)), sorted(parquet.schemas.keys()))
+    for dataset, schema in parquet.schemas.items():
+      table = pyarrow.dataset.dataset(os.path.join(root, dataset), format="parquet", partitioning="hive").to_table()
+      self.assertEqual(table.column_names[:len(schema)], [column for column, _ in schema])
+      self.assertGreater(table.num_rows, 0)
+
+    records = pyarrow.dataset.dataset(os.path.join(root, "accounting_records"), format="parquet",
+                                      partitioning="hive").to_table().to_pylist()
+    self.assertTrue(all(isinstance(record["umsatz"], int) for record in records))
+    self.assertEqual(sum(record["umsatz"] for record in records if record["ledger"] == "revenue"),
+                     sum(parquet.cents(decimal.Decimal(record["Umsatz (ohne Soll/Haben-Kz)"].replace(",", ".")))
+                         for record in self.cli.stripe_datev.journal.Journal(
+                           os.path.join(self.out_dir, "journal.sqlite")).records(scope="revenue-2023-05")))
+
+  @unittest.skipUnless(parquet.available(), "pyarrow is not installed")
+  def test_year_replaces_months(self):
+    import pyarrow.dataset
+
+    self.run_cli("download", "2023", "5", "--parquet")
+    self.run_cli("download", "2023", "0", "--parquet")
+
+    root = os.path.join(self.out_dir, "parquet")
+    self.assertEqual(os.listdir(os.path.join(root, "invoices", "month=2023-05")), ["2023-05.parquet"])
+    ids = pyarrow.dataset.dataset(os.path.join(root, "invoices"), format="parquet",
+                                  partitioning="hive").to_table().column("invoice_id").to_pylist()
+    self.assertEqual(len(ids), len(set(ids)))
@@ -0,0 +1,120 @@
+from benchmarks import fake_stripe
+from stripe_datev import pivots
+from tests.helpers import NoNetworkHTTPClient, loadCli, runCli
+from unittest import mock
+import decimal
+import os
+import shutil
+import tempfile
+import unittest
+import stripe
+
+
+class PivotsTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-03:2023-05", 20)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv, client=None):
+    return runCli(self.cli, self.out_dir, client or fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)),
+                  *argv)
+
+  def test_pivot(self):
+    columns = {
+      "recognition_month": ["2023-05", "2023-06", "2023-05", "2023-06", "2023-07"],
+      "vat_region": ["DE", "EU", "DE", "World", "DE"],
+      "is_recurring": ["true", "true", "false", "true", "true"],
+      "amount": [1000, 250, -300, 99, 1],
+    }
+    self.assertEqual(pivots.pivot(columns, "recognition_month", "vat_region"), (
+      ["2023-05", "2023-06", "2023-07"], ["DE", "EU", "World"], [[700, 0, 0], [0, 250, 99], [1, 0, 0]]))
+    self.assertEqual(pivots.pivot(columns, "recognition_month", "vat_region", where=("is_recurring", "false")), (
+      ["2023-05"], ["DE"], [[-300]]))
+
+    if pivots.numpy is not None:
+      for rows, cols, where in pivots.reports.values():
+        if rows in columns and cols in columns:
+          vectorized = pivots.vectorize(columns)
+          self.assertEqual(pivots.pivot(vectorized, rows, cols, where=where), pivots.pivot(columns, rows, cols, where=where))
+
+  def test_reports_from_downloads(self):
+    for month in [3, 4, 5]:
+      self.run_cli("download", "2023", str(month))
+    paths = pivots.recognitionFiles(self.out_dir, [2023])
+    self.assertEqual(len(paths), 3)
+
+    by_region = {}
+    for path in paths:
+      with open(path, "r", encoding="utf-8") as fp:
+        lines = fp.read().split("\n")
+      header = lines[0].split(",")
+      for line in lines[1:]:
+        fields = dict(zip(header, line.split(",")))
+        key = (fields["recognition_month"][:7], pivots.vatRegion(fields["country"]))
+        by_region[key] = by_region.get(key, decimal.Decimal(0)) + decimal.Decimal(fields["line_item_net"])
+
+    output = self.run_cli("pivots", "2023", "--report", "vat_region", client=NoNetworkHTTPClient())
+    lines = [line.split(",") for line in output.strip().split("\n")]
+    regions = lines[0][1:-1]
+    printed = {}
+    for line in lines[1:-1]:
+      for region, amount in zip(regions, line[1:-1]):
+        if decimal.Decimal(amount) != 0:
+          printed[(line[0], region)] = decimal.Decimal(amount)
+    self.assertEqual(printed, {key: amount for key, amount in by_region.items() if amount != 0})
+    self.assertEqual(decimal.Decimal(lines[-1][-1]), sum(by_region.values()))
+
+    columns = pivots.readColumns(paths)
+    _, timing, cells = pivots.report(columns, "deferral")
+    self.assertEqual(timing, ["deferred", "recognized"])
+    self.assertEqual(sum(sum(row) for row in cells), sum(columns["amount"]))
+
+  def writeRecognitionFile(self, name, rows):
+    dir = os.path.join(self.out_dir, "monthly_recognition")
+    os.makedirs(dir, exist_ok=True)
+    with open(os.path.join(dir, name), "w", encoding="utf-8") as fp:
+      fp.write("\n".join(["invoice_date,customer_id,country,revenue_type,is_recurring,recognition_month,line_item_net"] + rows))
+    return os.path.join(dir, name)
+
+  def test_year_file_instead_of_month_files(self):
+    year_path = self.writeRecognitionFile(pivots.recognitionFileName(2023, 0), [
+      "2023-01-15,cus_1,DE,Once,false,2023-01-01,10.00", "2023-02-15,cus_1,DE,Once,false,2023-02-01,20.00"])
+    month_path = self.writeRecognitionFile(pivots.recognitionFileName(2023, 1), [
+      "2023-01-15,cus_1,DE,Once,false,2023-01-01,10.00"])
+    other_path = self.writeRecognitionFile(pivots.recognitionFileName(2024, 1), [
+      "2024-01-15,cus_1,DE,Once,false,2024-01-01,30.00"])
+    self.assertEqual(pivots.recognitionFiles(self.out_dir, [2023, 2024]), [year_path, other_path])
+    self.assertEqual(sum(pivots.readColumns([year_path, other_path])["amount"]), 6000)
+    os.remove(year_path)
+    self.assertEqual(pivots.recognitionFiles(self.out_dir, [2023]), [month_path])
+
+  def writeQuotedFile(self):
+    return self.writeRecognitionFile(pivots.recognitionFileName(2023, 5), [
+      '2023-05-15,cus_1,DE,"Subscription, yearly",true,2023-05-01,10.00',
+      '2023-05-15,cus_2,FR,"Subscription, yearly",true,2023-06-01,5.50',
+      '2023-05-20,cus_2,FR,Once,false,2023-05-01,1.25'])
+
+  def test_quoted_fields(self):
+    with mock.patch.object(pivots, "numpy", None):
+      columns = pivots.readColumns([self.writeQuotedFile()])
+    self.assertEqual(pivots.report(columns, "mrr"), (
+      ["2023-05", "2023-06"], ["Subscription, yearly"], [[1000], [550]]))
+
+  @unittest.skipIf(pivots.numpy is None, "NumPy is not installed")
+  def test_numpy_matches_fallback(self):
+    path = self.writeQuotedFile()
+    vectorized = pivots.readColumns([path])
+    self.assertIn("labels", vectorized)
+    with mock.patch.object(pivots, "numpy", None):
+      columns = pivots.readColumns([path])
+    for name in pivots.reports:
+      self.assertEqual(pivots.report(vectorized, name), pivots.report(columns, name))
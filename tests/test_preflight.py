@@ -0,0 +1,60 @@
+from benchmarks import fake_stripe
+from stripe_datev import quarantine
+from tests.helpers import CountingHTTPClient, loadCli, runCli
+import os
+import tempfile
+import unittest
+import stripe
+
+
+class PreflightTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+
+  def setUp(self):
+    self.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+    invoice = next(invoice for invoice in sorted(self.store.invoices.values(), key=lambda i: i["id"])
+                   if invoice["status"] == "paid" and invoice["created"] >= 1682899200)
+    self.customer = self.store.get(invoice["customer"])
+    del self.customer["metadata"]["accountNumber"]
+
+  def tearDown(self):
+    stripe.default_http_client = None
+
+  def download(self, *options):
+    self.client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)))
+    with tempfile.TemporaryDirectory() as out_dir:
+      runCli(self.cli, out_dir, self.client, "download", "2023", "5", *options)
+      errors_path = os.path.join(out_dir, "errors", "download-2023-05.json")
+      return quarantine.readReport(errors_path) if os.path.exists(errors_path) else None
+
+  def test_aborts_on_missing_account_number(self):
+    with self.assertRaisesRegex(Exception, "Preflight failed for 1 customer"):
+      self.download()
+    # Before the balance transactions are listed, without listing charges
+    self.assertNotIn("GET /v1/balance_transactions", self.client.counts)
+    self.assertNotIn("GET /v1/charges", self.client.counts)
+
+  def test_quarantines_missing_account_number(self):
+    report = self.download("--quarantine")
+    invoices = set(id for id, invoice in self.store.invoices.items() if invoice["customer"] == self.customer["id"])
+    quarantined = set(error["id"] for error in report["errors"] if error["stage"] == "revenue_items")
+    self.assertTrue(len(quarantined & invoices) > 0)
+    # The customer's payments are left out of the balance records
+    charges = set(id for id, charge in self.store.charges.items() if charge["customer"] == self.customer["id"])
+    balance = set(error["id"] for error in report["errors"] if error["stage"] == "balance")
+    self.assertTrue(len(balance) > 0)
+    self.assertEqual(balance,
+                     set(id for id, tx in self.store.balance_transactions.items() if tx["source"] in charges
+                         and 1682892000 <= tx["created"] < 1685570400))
+    self.assertTrue(all(error["error"].startswith("Exception: Preflight failed for customer {}".format(self.customer["id"]))
+                        for error in report["errors"]))
+    self.assertNotIn("GET /v1/charges", self.client.counts)
+
+  def test_fills_missing_account_number(self):
+    highest = max(int(cus["metadata"]["accountNumber"]) for cus in self.store.customers.values()
+                  if "accountNumber" in cus["metadata"])
+    self.download("--fill-account-numbers")
+    self.assertEqual(self.customer["metadata"]["accountNumber"], str(highest + 1))
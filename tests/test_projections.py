@@ -0,0 +1,68 @@
+from benchmarks import fake_stripe, synthetic
+from stripe_datev import config, invoices, projections
+from tests.helpers import CountingHTTPClient, resetCaches
+from datetime import datetime
+import unittest
+import stripe
+
+
+class ProjectionsTest(unittest.TestCase):
+
+  def setUp(self):
+    projections.customers_interned.clear()
+    self.api_key = stripe.api_key
+    self.store = synthetic.generate(2023, 5, 20)
+
+  def tearDown(self):
+    projections.customers_interned.clear()
+    stripe.default_http_client = None
+    stripe.api_key = self.api_key
+    resetCaches()
+
+  def projectInvoices(self):
+    return [projections.invoice(synthetic.toStripe(stripe.Invoice, self.store.expand(invoice, synthetic.invoice_expand)))
+            for invoice in self.store.invoices.values()]
+
+  def test_access_like_stripe_objects(self):
+    raw = synthetic.toStripe(stripe.Invoice, self.store.expand(next(iter(self.store.invoices.values())),
+                                                               synthetic.invoice_expand))
+    invoice = projections.invoice(raw)
+    self.assertEqual(invoice.number, raw.number)
+    self.assertEqual(invoice["total"], raw["total"])
+    self.assertEqual(invoice.status_transitions.get("finalized_at"), raw.status_transitions.get("finalized_at"))
+    self.assertEqual([line["amount"] for line in invoice.lines], [line["amount"] for line in raw.lines])
+    self.assertNotIn("unknown_field", invoice)
+    self.assertIsNone(invoice.get("unknown_field"))
+    with self.assertRaises(KeyError):
+      invoice["unknown_field"]
+    with self.assertRaises(AttributeError):
+      invoice.number = "changed"
+
+  def test_customers_interned(self):
+    invoices = self.projectInvoices()
+    by_customer = {}
+    for invoice in invoices:
+      by_customer.setdefault(invoice.customer.id, []).append(invoice.customer)
+    self.assertTrue(any(len(customers) > 1 for customers in by_customer.values()))
+    for customers in by_customer.values():
+      self.assertTrue(all(cus is customers[0] for cus in customers))
+
+  def test_only_period_invoices_projected(self):
+    store = fake_stripe.generateMonths("2023-04:2023-05", 20)
+    fromTime = config.accounting_tz.localize(datetime(2023, 5, 1))
+    toTime = config.accounting_tz.localize(datetime(2023, 6, 1))
+    # Invoices of the look-back window finalized before the period, with more lines to paginate
+    earlier = [invoice for invoice in store.invoices.values()
+               if invoice["status_transitions"]["finalized_at"] < fromTime.timestamp()]
+    self.assertGreater(len(earlier), 0)
+    for invoice in earlier:
+      invoice["lines"]["has_more"] = True
+
+    client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(store)))
+    stripe.default_http_client = client
+    stripe.api_key = "sk_test_projections"
+    listed = list(invoices.listFinalizedInvoices(fromTime, toTime))
+
+    self.assertGreater(len(listed), 0)
+    self.assertTrue(all(isinstance(invoice, projections.Invoice) for invoice in listed))
+    self.assertNotIn("GET /v1/invoices/{id}/lines", client.counts)
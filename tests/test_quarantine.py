@@ -0,0 +1,62 @@
+from benchmarks import fake_stripe
+from tests.helpers import loadCli, runCli
+import json
+import os
+import tempfile
+import unittest
+import stripe
+
+
+def readOutputLines(out_dir):
+  """
+  Output lines per file in any order, without the DATEV header that contains
+  the time of export.
+  """
+  outputs = {}
+  for dir in ["datev", "overview", "monthly_recognition"]:
+    for name in os.listdir(os.path.join(out_dir, dir)):
+      with open(os.path.join(out_dir, dir, name), "rb") as fp:
+        lines = fp.read().splitlines()
+      outputs[name] = sorted(lines[1:] if name.startswith("EXTF_") else lines)
+  return outputs
+
+
+class QuarantineTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+
+  def setUp(self):
+    self.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+    self.invoice = next(invoice for invoice in sorted(self.store.invoices.values(), key=lambda i: i["id"])
+                        if invoice["status"] == "paid" and invoice["created"] >= 1682899200)
+
+  def tearDown(self):
+    stripe.default_http_client = None
+
+  def run_cli(self, out_dir, *argv):
+    runCli(self.cli, out_dir, fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)), *argv)
+
+  def test_quarantine_and_reprocess(self):
+    with tempfile.TemporaryDirectory() as out_dir:
+      self.run_cli(out_dir, "download", "2023", "5")
+      expected = readOutputLines(out_dir)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+      # A credit note that cannot be found
+      self.invoice["post_payment_credit_notes_amount"] = 100
+      with self.assertRaises(AssertionError):
+        self.run_cli(out_dir, "download", "2023", "5")
+
+      self.run_cli(out_dir, "download", "2023", "5", "--quarantine")
+      report_path = os.path.join(out_dir, "errors", "download-2023-05.json")
+      with open(report_path, "r", encoding="utf-8") as fp:
+        report = json.load(fp)
+      self.assertEqual([(e["id"], e["stage"]) for e in report["errors"]], [(self.invoice["id"], "revenue_items")])
+      self.assertNotEqual(readOutputLines(out_dir), expected)
+
+      self.invoice["post_payment_credit_notes_amount"] = 0
+      self.run_cli(out_dir, "reprocess", report_path)
+      self.assertFalse(os.path.exists(report_path))
+      self.assertEqual(readOutputLines(out_dir), expected)
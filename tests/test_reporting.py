@@ -0,0 +1,52 @@
+from benchmarks import fake_stripe
+from tests.helpers import CountingHTTPClient, loadCli, readOutputs, resetCaches
+import os
+import tempfile
+import unittest
+import stripe
+
+
+def listPages(counts):
+  return sum(count for endpoint, count in counts.items() if endpoint.startswith("GET /") and not endpoint.endswith("}"))
+
+
+class BalanceReportTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-04:2023-05", 30)
+    # Fee descriptions the report has no column for
+    for idx, tx in enumerate(sorted(cls.store.balance_transactions.values(), key=lambda tx: tx["id"])):
+      if tx["fee_details"] and idx % 3 == 0:
+        tx["fee_details"][0]["description"] = "Stripe Billing fees"
+
+  def tearDown(self):
+    stripe.default_http_client = None
+
+  def download(self, *options):
+    resetCaches()
+    client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)))
+    stripe.default_http_client = client
+    downloads = []
+
+    class OfflineCli(self.cli.StripeDatevCli):
+      def downloadFile(self, url, filePath):
+        downloads.append((url, os.path.relpath(filePath, out_dir)))
+
+    with tempfile.TemporaryDirectory() as out_dir:
+      self.cli.out_dir = out_dir
+      OfflineCli().run(["stripe-datev-cli.py", "download", "2023", "5"] + list(options))
+      return readOutputs(out_dir), sorted(downloads), client.counts
+
+  def test_report_matches_list_api(self):
+    outputs, downloads, counts = self.download()
+    report_outputs, report_downloads, report_counts = self.download("--balance-report")
+
+    self.assertEqual(report_outputs, outputs)
+    self.assertEqual(report_downloads, downloads)
+    self.assertEqual(report_counts.get("POST /v1/reporting/report_runs", 0), 1)
+    # Fee details with the charges, no balance transaction is listed or retrieved
+    self.assertNotIn("GET /v1/balance_transactions", report_counts)
+    self.assertNotIn("GET /v1/balance_transactions/{id}", report_counts)
+    self.assertLess(listPages(report_counts), listPages(counts))
@@ -0,0 +1,39 @@
+from benchmarks import fake_stripe
+from tests.helpers import loadCli, runCli
+from tests.test_reporting import readOutputs
+import os
+import shutil
+import tempfile
+import unittest
+import stripe
+
+
+class SnapshotTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-03:2023-05", 20)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+    self.max_network_retries = stripe.max_network_retries
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    stripe.max_network_retries = self.max_network_retries
+    shutil.rmtree(self.out_dir)
+
+  def test_replay_independent_of_lookback_cache(self):
+    fake = fake_stripe.FakeStripe(self.store)
+    runCli(self.cli, self.out_dir, fake_stripe.FakeStripeHTTPClient(fake), "download", "2023", "4")
+    runCli(self.cli, self.out_dir, fake_stripe.FakeStripeHTTPClient(fake), "download", "2023", "5", "--record")
+    expected = readOutputs(self.out_dir)
+    snapshot_path = os.path.join(self.out_dir, "snapshots", os.listdir(os.path.join(self.out_dir, "snapshots"))[0])
+
+    # The look-back cache now covers May's window, replay must list it as recorded
+    runCli(self.cli, self.out_dir, fake_stripe.FakeStripeHTTPClient(fake), "download", "2023", "6")
+    runCli(self.cli, self.out_dir, None, "download", "2023", "5", "--force", "--replay", snapshot_path)
+    replayed = readOutputs(self.out_dir)
+    self.assertEqual({name: lines for name, lines in replayed.items() if "2023-05" in name},
+                     {name: lines for name, lines in expected.items() if "2023-05" in name})
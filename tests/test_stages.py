@@ -0,0 +1,56 @@
+from benchmarks import fake_stripe
+from tests.helpers import CountingHTTPClient, loadCli, runCli
+import shutil
+import tempfile
+import unittest
+import stripe
+
+
+class StagesTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+    cls.store = fake_stripe.generateMonths("2023-04:2023-05", 20)
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def download(self, *options):
+    client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)))
+    output = runCli(self.cli, self.out_dir, client, "download", "2023", "5", *options)
+    return output, client.counts
+
+  def test_rerun_skips_unchanged(self):
+    output, counts = self.download()
+    self.assertIn("GET /v1/credit_notes", counts)
+    self.assertNotIn("Skipping", output)
+
+    # The period is over and no object changed since, nothing is fetched
+    output, rerun_counts = self.download()
+    self.assertIn("Skipping download, no changes since the last one", output)
+    self.assertEqual(rerun_counts, {"GET /v1/events": 1})
+
+    # An event about an invoice of the period, without changing it
+    fake = fake_stripe.FakeStripe(self.store)
+    invoice = next(invoice for invoice in self.store.invoices.values()
+                   if invoice["status_transitions"]["finalized_at"] >= 1682892000)
+    events = set(self.store.events)
+    fake.addEvent("invoice.updated", invoice)
+    try:
+      output, rerun_counts = self.download()
+    finally:
+      for id in set(self.store.events) - events:
+        del self.store.events[id]
+    for stage in ["overview", "monthly_recognition", "datev_revenue", "datev_balance"]:
+      self.assertIn("Skipping {}, inputs unchanged".format(stage), output)
+    # The period is over, so are changes to earlier invoices within it
+    self.assertNotIn("GET /v1/credit_notes", rerun_counts)
+    self.assertLess(rerun_counts["GET /v1/invoices"], counts["GET /v1/invoices"])
+
+    _, forced_counts = self.download("--force")
+    self.assertEqual(forced_counts["GET /v1/credit_notes"], counts["GET /v1/credit_notes"])
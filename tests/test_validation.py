@@ -0,0 +1,83 @@
+from benchmarks import fake_stripe
+from stripe_datev import validation
+from tests.helpers import CountingHTTPClient, loadCli, resetCaches, runCli
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import stripe
+
+
+class ValidationTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cli = loadCli()
+
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+    self.store = fake_stripe.generateMonths("2023-05", 60)
+    # A US customer, for which being exempt is the only issue
+    ids = sorted(self.store.customers.keys(), key=lambda id: (self.store.customers[id]["address"]["country"] != "US", id))
+    self.store.customers[ids[0]]["tax_exempt"] = "exempt"
+    self.store.customers[ids[1]]["metadata"] = {}
+    self.store.customers[ids[2]]["address"] = None
+    self.ids = ids
+
+  def tearDown(self):
+    stripe.default_http_client = None
+    shutil.rmtree(self.out_dir)
+
+  def run_cli(self, *argv):
+    http_client = CountingHTTPClient(fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store)))
+    output = runCli(self.cli, self.out_dir, http_client, "validate_customers", *argv)
+    with open(os.path.join(self.out_dir, "validation", "customers.json"), "r", encoding="utf-8") as fp:
+      report = json.load(fp)
+    return output, report, http_client.counts
+
+  def issueCustomers(self, report):
+    return {issue_type: [entry["customer"] for entry in entries] for issue_type, entries in report["issues"].items()}
+
+  def test_time_slices(self):
+    self.assertEqual(validation.timeSlices(0, 10, 3), [(0, 3), (3, 6), (6, 10)])
+    self.assertEqual(validation.timeSlices(5, 6, 8), [(5, 6)])
+
+  def test_incremental(self):
+    output, report, counts = self.run_cli("--slices", "4")
+    self.assertEqual(report["validated"], len(self.store.customers))
+    self.assertIsNone(report["since"])
+    self.assertEqual(self.issueCustomers(report), {
+      "missing_account_number": [self.ids[1]],
+      "no_address": [self.ids[2]],
+      "tax_exempt": [self.ids[0]],
+    })
+    self.assertGreaterEqual(counts["GET /v1/customers"], 4)
+    self.assertEqual(output.count("Warning: customer"), 3)
+
+    # Nothing changed: nothing to list but the latest customers, no warnings repeated
+    output, incremental, counts = self.run_cli()
+    self.assertEqual(incremental["validated"], 0)
+    self.assertEqual(incremental["issues"], report["issues"])
+    self.assertNotIn("Warning", output)
+    self.assertNotIn("GET /v1/customers/{id}", counts)
+
+    # Fixed, and a new customer without address
+    resetCaches()
+    stripe.default_http_client = fake_stripe.FakeStripeHTTPClient(fake_stripe.FakeStripe(self.store))
+    stripe.Customer.modify(self.ids[1], metadata={"accountNumber": "99999"})
+    self.store.add(dict(self.store.customers[self.ids[3]], id="cus_new", created=int(time.time()), address=None))
+
+    output, report, counts = self.run_cli()
+    self.assertEqual(report["validated"], 2)
+    self.assertEqual(self.issueCustomers(report), {
+      "no_address": sorted([self.ids[2], "cus_new"]),
+      "tax_exempt": [self.ids[0]],
+    })
+    self.assertEqual(output.count("Warning: customer"), 1)
+    self.assertEqual(counts["GET /v1/customers/{id}"], 1)
+
+    output, report, _ = self.run_cli("--full")
+    self.assertEqual(report["validated"], len(self.store.customers))
+    self.assertEqual(output.count("Warning: customer"), 3)